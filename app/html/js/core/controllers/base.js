@@ -52,6 +52,7 @@ define([
             {label: 'Slam'},
             {label: 'Aruco'},
             {label: 'Pod'},
+            {label: 'Fusion'},
         ];
         // Inner helpers for prefs
         function checkRangeValidity(key) {
@@ -148,7 +149,7 @@ define([
         function formatTechnology(prefValue) {
             if (prefValue) {
                 prefValue = capitalize(prefValue);
-                if (/Slam|Aruco|Pod/.test(prefValue)) {
+                if (/Slam|Aruco|Pod|Fusion/.test(prefValue)) {
                     return prefValue;
                 }
             }
@@ -19,6 +19,8 @@ import almath
 import motion
 import vision_definitions as vd # constants
 
+import stk.logging
+
 # Special: for NAOqi OS (on Pepper and nao), pre-compiled cv2 is packaged
 # TODO add check is_a_robot?
 
@@ -97,6 +99,13 @@ DEFAULT_PARAMS = {
 
 SUBSCRIBER_ID = "com-softbankrobotics-%s" % PACKAGE_UID
 
+# Logs made for every image are rate limited to one per period
+IMAGE_LOG_PERIOD = 5.0 # in seconds
+
+class MarkerNotFound(Exception):
+    "No marker (with the requested IDs) in the image."
+    pass
+
 @qi.multiThreaded()
 class Main(object):
     def __init__(self, application, logger):
@@ -175,15 +184,15 @@ class Main(object):
             try:
                 p6D_world2target = almath.Position6D(p6Ds[ids]["world2target"])
                 t_world2target = almath.transformFromPosition6D(p6D_world2target)
-                self.logger.info("@@@ TARGET IN WORLD %s" % p6D_world2target)
+                self.logger.verbose("@@@ TARGET IN WORLD %s", p6D_world2target)
 
                 p2D_world2robot = almath.Pose2D(self.ALMotion.getRobotPosition(True))
                 t_world2robot = almath.transformFromPose2D(p2D_world2robot)
-                self.logger.info("@@@ ROBOT POSITION %s" % p2D_world2robot)
+                self.logger.verbose("@@@ ROBOT POSITION %s", p2D_world2robot)
 
                 t_robot2target = t_world2robot.inverse() * t_world2target
                 p6D_robot2target = almath.position6DFromTransform(t_robot2target)
-                self.logger.info("@@@ TARGET IN ROBOT %s" % p6D_robot2target)
+                self.logger.verbose("@@@ TARGET IN ROBOT %s", p6D_robot2target)
                 p6Ds_list[ids] = list(p6D_robot2target.toVector())
             except Exception as e:
                 pass
@@ -208,7 +217,8 @@ class Main(object):
                     self._unsubscribe(subscriber_id)
                     return p6Ds
                 except Exception as e:
-                    self.logger.warning("detect_with_try %s/%s failed: %s" % (i, params["try"], e))
+                    self.logger.every(IMAGE_LOG_PERIOD).warning(
+                        "detect_with_try %s/%s failed: %s", i, params["try"], e)
                     #qi.async(lambda:None, delay=200000).wait()
             self._unsubscribe(subscriber_id)
         if not p6Ds:
@@ -227,7 +237,8 @@ class Main(object):
                 p6Ds = self.__task(subscriber_id, params)
                 break
             except Exception as e:
-                self.logger.warning("detect_with_try %s/%s failed: %s" % (i, params["try"], e))
+                self.logger.every(IMAGE_LOG_PERIOD).warning(
+                    "detect_with_try %s/%s failed: %s", i, params["try"], e)
                 qi.async(lambda:None, delay=200000).wait()
         self._unsubscribe(subscriber_id)
         if not p6Ds:
@@ -296,7 +307,7 @@ class Main(object):
             return p6Ds
         else:
             # this is only used for async subscribers (never use with detect() calls)
-            self.logger.info("@@@@@@ ASYNC TASK!")
+            self.logger.every(IMAGE_LOG_PERIOD).info("@@@@@@ ASYNC TASK!")
             qi.async(self.___task, subscriber_id, params) \
                 .then(functools.partial(self.___task_finished, subscriber_id, params))
         # self.logger.info("__task %s done" % subscriber_id)
@@ -308,7 +319,8 @@ class Main(object):
 
     def ___task_finished(self, subscriber_id, params, future):
         if future.hasError():
-            self.logger.error("___task finished with error: %s" % future.error())
+            self.logger.every(IMAGE_LOG_PERIOD).error(
+                "___task finished with error: %s", future.error())
         elif future.hasValue():
             # self.logger.error("_on_detect_markers_finished finished with value")
             self._publish(subscriber_id, params, future.value())
@@ -316,7 +328,8 @@ class Main(object):
     def _publish(self, subscriber_id, params, p6Ds):
         # self.logger.info("_publish %s..." % subscriber_id)
         self.image_nb += 1
-        self.logger.info("@@@@@ IMAGE DONE: %s" % self.image_nb)
+        self.logger.every(IMAGE_LOG_PERIOD).info("@@@@@ IMAGE DONE: %s",
+                                                 self.image_nb)
         for _id, p6D in p6Ds.iteritems():
             seconds, micro_seconds = p6D["timestamp"]
             timestamp = seconds*10e8 + micro_seconds*10e2
@@ -368,7 +381,8 @@ class Main(object):
 
         # cv2.imwrite("/home/nao/picture.png", image)
         d = time.time()-t
-        self.logger.info("_get_image_world2camera_and_timestamp %s done %s" % (subscriber_id, d))
+        self.logger.every(IMAGE_LOG_PERIOD).info(
+            "_get_image_world2camera_and_timestamp %s done %s", subscriber_id, d)
         return image, t_world2camera, timestamp
 
     def _unsubscribe_all(self):
@@ -387,7 +401,7 @@ class Main(object):
         try:
             ids = [ int(_id) for _id in ids.flatten() ]
         except Exception as e:
-            raise Exception("No markers found")
+            raise MarkerNotFound("No markers found")
 
         # self.logger.info("@@@@@@@@@ IDs: %s" % ids)
         if ids:
@@ -426,24 +440,26 @@ class Main(object):
                     t_world2target = t_world2camera * t_camera2target * t_correction
 
                     p6D_world2target = almath.position6DFromTransform(t_world2target)
-                    self.logger.info("@@@@@@@@@ ID: %s - P6D_WORLD2TARGET: %s" % (ids[indice], p6D_world2target))
+                    self.logger.every(IMAGE_LOG_PERIOD).info(
+                        "@@@@@@@@@ ID: %s - P6D_WORLD2TARGET: %s", ids[indice],
+                        p6D_world2target)
 
                     p6Ds[ids[indice]] = {
                         "world2target": list(p6D_world2target.toVector()),
                         "timestamp": timestamp,
                     }
             else:
-                raise Exception("No markers with IDs %s found" % params["ids"])
+                raise MarkerNotFound("No markers with IDs %s found" % params["ids"])
 
         d = time.time()-t
-        self.logger.info("_detect_markers done %s" % d)
+        self.logger.every(IMAGE_LOG_PERIOD).info("_detect_markers done %s", d)
         return p6Ds
 
 if __name__ == "__main__":
     application = qi.Application()
     application.start()
 
-    logger = qi.getLogger(PACKAGE_UID)
+    logger = stk.logging.Logger(PACKAGE_UID)
     # mandatory to broadcast logs
     try:
         qicore_module = qi.module("qicore")
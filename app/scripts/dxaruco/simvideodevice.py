@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated ALVideoDevice rendering ARuco markers, for running DXAruco
+without a robot.
+
+The markers are drawn from the camera pose given to the device, using the
+camera matrix and distortion coefficients of dxaruco, so what Main detects
+can be compared to the ground truth of the scene.
+
+Must be run from the app folder (like the service itself):
+
+    python2 scripts/dxaruco/simvideodevice.py
+"""
+
+import math
+import time
+
+import numpy
+import vision_definitions as vd # constants
+
+# Also patches the path for the packaged cv2 and numpy
+import dxaruco
+
+import stk.logging
+import stk.simulation
+
+cv2 = dxaruco.cv2
+
+# Quiet zone around the markers, in fraction of the marker size
+MARKER_MARGIN = 0.25
+
+BACKGROUND_LEVEL = 90
+
+# Exposure giving the nominal brightness of the rendered frames
+REFERENCE_EXPOSURE = 400
+
+COLOR_SPACE_LAYERS = {
+    vd.kYuvColorSpace: 1,
+    vd.kBGRColorSpace: 3,
+    vd.kRGBColorSpace: 3,
+}
+
+DEFAULT_CAMERA_PARAMETERS = {
+    dxaruco.CAMERA_PARAMETERS["AutoExposition"]: 1,
+    dxaruco.CAMERA_PARAMETERS["AutoWhiteBalance"]: 1,
+    dxaruco.CAMERA_PARAMETERS["Brightness"]: 55,
+    dxaruco.CAMERA_PARAMETERS["Contrast"]: 32,
+    dxaruco.CAMERA_PARAMETERS["Saturation"]: 128,
+    dxaruco.CAMERA_PARAMETERS["Exposure"]: 800,
+}
+
+# Bottom camera of Pepper looking at the floor, robot at the world origin
+DEFAULT_CAMERA_POSE = [0.09, 0.0, 0.99, 0.0, math.radians(40), 0.0]
+
+DEFAULT_MARKERS = [
+    {"id": 128, "size": 0.20, "position": "floor", "pose": [1.2, 0.0, 0.0, 0.0]},
+    {"id": 448, "size": 0.10, "position": "floor", "pose": [0.8, 0.3, 0.0, 0.0]},
+]
+
+# Marker axes expressed in the target frame published by dxaruco
+# (x forward, z up), see the correction applied in Main._detect_markers.
+MARKER_AXES = {
+    "floor": (numpy.array([0., -1., 0.]), numpy.array([1., 0., 0.])),
+    "wall": (numpy.array([0., -1., 0.]), numpy.array([0., 0., 1.])),
+}
+
+# From NAOqi camera coordinates (x forward) to OpenCV ones (z forward)
+NAOQI_TO_OPENCV = numpy.array([
+    [0., -1., 0.],
+    [0., 0., -1.],
+    [1., 0., 0.]])
+
+def rotation_from_angles(wx, wy, wz):
+    "Rotation matrix of a Position6D (same convention as almath)"
+    cx, sx = math.cos(wx), math.sin(wx)
+    cy, sy = math.cos(wy), math.sin(wy)
+    cz, sz = math.cos(wz), math.sin(wz)
+    r_x = numpy.array([[1., 0., 0.], [0., cx, -sx], [0., sx, cx]])
+    r_y = numpy.array([[cy, 0., sy], [0., 1., 0.], [-sy, 0., cy]])
+    r_z = numpy.array([[cz, -sz, 0.], [sz, cz, 0.], [0., 0., 1.]])
+    return r_z.dot(r_y).dot(r_x)
+
+def transform_from_position6d(position6d):
+    "4x4 homogeneous matrix of a [x, y, z, wx, wy, wz] list"
+    x, y, z, wx, wy, wz = position6d
+    transform = numpy.identity(4)
+    transform[:3, :3] = rotation_from_angles(wx, wy, wz)
+    transform[:3, 3] = [x, y, z]
+    return transform
+
+class SimVideoDevice(object):
+    "Stand-in for ALVideoDevice, serving rendered frames of ARuco markers."
+    def __init__(self, markers=None, camera_pose=None, blur=0.0, noise=0.0,
+                 exposure_effect=True, dictionary=dxaruco.DEFAULT_PARAMS["dictionary"],
+                 seed=None):
+        self.markers = list(markers if markers is not None else DEFAULT_MARKERS)
+        self.camera_transform = None
+        self.set_camera_pose(camera_pose or DEFAULT_CAMERA_POSE)
+        self.blur = blur # gaussian sigma in pixels at k16VGA
+        self.noise = noise # gaussian noise standard deviation in gray levels
+        self.exposure_effect = exposure_effect
+        self.dictionary = cv2.aruco.getPredefinedDictionary(dictionary)
+        self.random = numpy.random.RandomState(seed)
+        self.subscribers = {}
+        self.parameters = {}
+        self.frame_count = 0
+        self.marker_images = {}
+
+    ###########################################
+    #            Scene                        #
+    ###########################################
+
+    def set_camera_pose(self, camera_pose):
+        "Camera pose in world, as [x, y, z, wx, wy, wz] in NAOqi conventions."
+        self.camera_transform = transform_from_position6d(camera_pose)
+
+    def get_camera_transform(self):
+        "Camera pose in world, as the 12 floats of an almath.Transform."
+        return list(self.camera_transform[:3].flatten())
+
+    def get_ground_truth(self, marker_id):
+        "World2target Position6D dxaruco should find for this marker."
+        for marker in self.markers:
+            if marker["id"] == marker_id:
+                x, y, z, theta = marker["pose"]
+                return [x, y, z, 0.0, 0.0, theta]
+        return None
+
+    ###########################################
+    #            ALVideoDevice API            #
+    ###########################################
+
+    def subscribeCamera(self, name, camera, resolution, color_space, fps):
+        "Returns a subscriber id, like ALVideoDevice."
+        if resolution not in dxaruco.CAMERA_DATAS_AT_RESOLUTION:
+            raise RuntimeError("Unsupported resolution %s" % resolution)
+        if color_space not in COLOR_SPACE_LAYERS:
+            raise RuntimeError("Unsupported color space %s" % color_space)
+        index = 0
+        subscriber_id = name
+        while subscriber_id in self.subscribers:
+            index += 1
+            subscriber_id = "%s_%s" % (name, index)
+        self.subscribers[subscriber_id] = {
+            "camera": camera,
+            "resolution": resolution,
+            "color_space": color_space,
+            "fps": fps,
+        }
+        return subscriber_id
+
+    def unsubscribe(self, subscriber_id):
+        "Removes a subscriber."
+        return self.subscribers.pop(subscriber_id, None) is not None
+
+    def getSubscribers(self):
+        "Names of the current subscribers."
+        return list(self.subscribers)
+
+    def getParameter(self, camera, parameter):
+        "Gets a camera parameter."
+        return self.parameters.get((camera, parameter),
+                                   DEFAULT_CAMERA_PARAMETERS.get(parameter, 0))
+
+    def setParameter(self, camera, parameter, value):
+        "Sets a camera parameter."
+        self.parameters[(camera, parameter)] = value
+        return True
+
+    def resetCamera(self, camera):
+        "Back to default parameters."
+        for key in list(self.parameters):
+            if key[0] == camera:
+                del self.parameters[key]
+        return True
+
+    def getImageRemote(self, subscriber_id):
+        "Renders a frame, in the ALImage layout of ALVideoDevice."
+        subscriber = self.subscribers.get(subscriber_id)
+        if not subscriber:
+            return None
+        frame = self.render(subscriber["camera"], subscriber["resolution"])
+        layers = COLOR_SPACE_LAYERS[subscriber["color_space"]]
+        if layers == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        width, height = dxaruco.CAMERA_DATAS_AT_RESOLUTION[
+                                            subscriber["resolution"]]["image_size"]
+        now = time.time()
+        seconds = int(now)
+        micro_seconds = int((now - seconds) * 1000000)
+        return [width, height, layers, subscriber["color_space"],
+                seconds, micro_seconds, frame.tostring(), subscriber["camera"],
+                0.0, 0.0, 0.0, 0.0]
+
+    ###########################################
+    #            Rendering                    #
+    ###########################################
+
+    def render(self, camera, resolution):
+        "Gray level image of the scene seen by the camera."
+        camera_datas = dxaruco.CAMERA_DATAS_AT_RESOLUTION[resolution]
+        width, height = camera_datas["image_size"]
+        frame = numpy.full((height, width), BACKGROUND_LEVEL, dtype=numpy.uint8)
+        for marker in self.markers:
+            self._draw_marker(frame, marker, camera_datas["matrix"])
+
+        scale = float(width) / dxaruco.K16VGA_RESOLUTION["x"]
+        image = frame.astype(numpy.float32)
+        if self.blur > 0:
+            sigma = self.blur * scale
+            if sigma > 0.1:
+                image = cv2.GaussianBlur(image, (0, 0), sigma)
+        if self.exposure_effect:
+            exposure = self.getParameter(camera, dxaruco.CAMERA_PARAMETERS["Exposure"])
+            image *= float(exposure) / REFERENCE_EXPOSURE
+        if self.noise > 0:
+            image += self.random.normal(0.0, self.noise, image.shape)
+        self.frame_count += 1
+        return numpy.clip(image, 0, 255).astype(numpy.uint8)
+
+    def _get_marker_image(self, marker_id):
+        "Marker bitmap with its white quiet zone (cached)."
+        if marker_id not in self.marker_images:
+            side = 120
+            margin = int(side * MARKER_MARGIN)
+            canvas = numpy.full((side + 2 * margin, side + 2 * margin), 255,
+                                dtype=numpy.uint8)
+            canvas[margin:margin + side, margin:margin + side] = \
+                cv2.aruco.drawMarker(self.dictionary, marker_id, side)
+            self.marker_images[marker_id] = canvas
+        return self.marker_images[marker_id]
+
+    def _get_corners_in_camera(self, marker):
+        "Outer corners of the quiet zone, in OpenCV camera coordinates."
+        x, y, z, theta = marker["pose"]
+        r_world2target = rotation_from_angles(0.0, 0.0, theta)
+        axis_x, axis_y = MARKER_AXES[marker["position"]]
+        axis_x = r_world2target.dot(axis_x)
+        axis_y = r_world2target.dot(axis_y)
+        half = marker["size"] * (0.5 + MARKER_MARGIN)
+        center = numpy.array([x, y, z])
+        # top left, top right, bottom right, bottom left (OpenCV order)
+        corners = [center + half * (sign_x * axis_x + sign_y * axis_y)
+                   for sign_x, sign_y in [(-1, 1), (1, 1), (1, -1), (-1, -1)]]
+        r_camera = self.camera_transform[:3, :3]
+        t_camera = self.camera_transform[:3, 3]
+        in_camera = [r_camera.T.dot(corner - t_camera) for corner in corners]
+        return numpy.array([NAOQI_TO_OPENCV.dot(point) for point in in_camera])
+
+    def _draw_marker(self, frame, marker, camera_matrix):
+        "Warp the marker bitmap in the frame (no-op if behind the camera)."
+        corners = self._get_corners_in_camera(marker)
+        if (corners[:, 2] < 0.05).any():
+            return
+        pixels, _ = cv2.projectPoints(corners, numpy.zeros(3), numpy.zeros(3),
+                                      camera_matrix, dxaruco.CAMERA_DISTORTION_COEFF)
+        pixels = pixels.reshape(4, 2).astype(numpy.float32)
+        height, width = frame.shape
+        if (pixels[:, 0].max() < 0 or pixels[:, 0].min() >= width or
+                pixels[:, 1].max() < 0 or pixels[:, 1].min() >= height):
+            return
+        image = self._get_marker_image(marker["id"])
+        side = image.shape[0] - 1
+        source = numpy.array([[0, 0], [side, 0], [side, side], [0, side]],
+                             dtype=numpy.float32)
+        homography = cv2.getPerspectiveTransform(source, pixels)
+        warped = cv2.warpPerspective(image, homography, (width, height),
+                                     flags=cv2.INTER_LINEAR)
+        mask = cv2.warpPerspective(numpy.full(image.shape, 255, dtype=numpy.uint8),
+                                   homography, (width, height),
+                                   flags=cv2.INTER_NEAREST)
+        frame[mask > 0] = warped[mask > 0]
+
+###########################################
+#   Other services needed by dxaruco.Main #
+###########################################
+
+class SimCameraMotion(object):
+    "Just enough of ALMotion for Main: the camera is where the device is."
+    def __init__(self, video_device, robot_position=None):
+        self.video_device = video_device
+        self.robot_position = robot_position or [0.0, 0.0, 0.0]
+
+    def _getSensorTransformAtTime(self, sensor_name, timestamp):
+        return self.video_device.get_camera_transform()
+
+    def getRobotPosition(self, use_sensors):
+        return list(self.robot_position)
+
+class CountingMemory(stk.simulation.SimMemory):
+    "ALMemory stand-in counting the raised events."
+    def __init__(self):
+        stk.simulation.SimMemory.__init__(self)
+        self.raised_count = 0
+
+    def raiseEvent(self, key, value):
+        self.raised_count += 1
+        stk.simulation.SimMemory.raiseEvent(self, key, value)
+
+def make_application(video_device, robot_position=None):
+    "What dxaruco.Main expects as application."
+    return stk.simulation.SimApplication(stk.simulation.SimSession({
+        "ALVideoDevice": video_device,
+        "ALMotion": SimCameraMotion(video_device, robot_position),
+        "ALMemory": CountingMemory(),
+    }))
+
+###########################################
+#            Benchmarks                   #
+###########################################
+
+def _get_pose_error(found, truth):
+    "Position (m) and yaw (rad) errors between two Position6D."
+    error_xy = math.hypot(found[0] - truth[0], found[1] - truth[1])
+    error_theta = abs(math.atan2(math.sin(found[-1] - truth[-1]),
+                                 math.cos(found[-1] - truth[-1])))
+    return error_xy, error_theta
+
+def benchmark_detect_markers(logger, frames=20, **device_kwargs):
+    "Throughput and accuracy of Main._detect_markers at every resolution."
+    device = SimVideoDevice(**device_kwargs)
+    main = dxaruco.Main(make_application(device), logger)
+    results = []
+    for resolution in dxaruco.CAMERA_RESOLUTIONS:
+        params = dict(dxaruco.DEFAULT_PARAMS)
+        params.update({"resolution": resolution,
+                       "ids": [marker["id"] for marker in device.markers]})
+        subscriber_id = main._subscribe(params)
+        durations = []
+        errors = []
+        misses = 0
+        for _ in range(frames):
+            image, t_world2camera, timestamp = \
+                main._get_image_world2camera_and_timestamp(subscriber_id, params)
+            start = time.time()
+            try:
+                p6Ds = main._detect_markers(params, image, t_world2camera, timestamp)
+            except dxaruco.MarkerNotFound:
+                p6Ds = {}
+            durations.append(time.time() - start)
+            for marker in device.markers:
+                if marker["id"] in p6Ds:
+                    errors.append(_get_pose_error(p6Ds[marker["id"]]["world2target"],
+                                                  device.get_ground_truth(marker["id"])))
+                else:
+                    misses += 1
+        main._unsubscribe(subscriber_id)
+        result = {
+            "resolution": resolution,
+            "fps": frames / max(sum(durations), 1e-9),
+            "detection_rate": 1.0 - float(misses) / (frames * len(device.markers)),
+            "error_xy": numpy.mean([err[0] for err in errors]) if errors else None,
+            "error_theta": numpy.mean([err[1] for err in errors]) if errors else None,
+        }
+        results.append(result)
+    return results
+
+def benchmark_subscribe(logger, duration=5.0, resolution=vd.kVGA, **device_kwargs):
+    "Events published per second through Main.subscribe (periodic path)."
+    device = SimVideoDevice(**device_kwargs)
+    application = make_application(device)
+    main = dxaruco.Main(application, logger)
+    memory = application.session.service("ALMemory")
+    subscriber_id = main.subscribe({
+        "resolution": resolution,
+        "ids": [marker["id"] for marker in device.markers],
+    })
+    time.sleep(duration)
+    main.unsubscribe(subscriber_id)
+    return {
+        "resolution": resolution,
+        "frames_per_second": device.frame_count / duration,
+        "events_per_second": memory.raised_count / duration,
+    }
+
+if __name__ == "__main__":
+    LOGGER = stk.logging.Logger("dx-aruco-sim")
+    for row in benchmark_detect_markers(LOGGER, blur=1.5, noise=4.0, seed=0):
+        print row
+    print benchmark_subscribe(LOGGER, blur=1.5, noise=4.0, seed=0)
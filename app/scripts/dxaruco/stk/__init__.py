@@ -0,0 +1,3 @@
+"""
+STK - A collection of libraries useful for making apps with NAOqi.
+"""
@@ -0,0 +1,197 @@
+"""
+stk.clock.py
+
+Single access point to time for apps: time, sleep, delayed calls and
+periodic tasks.
+
+By default this is the wall clock (time.time, qi.async, qi.PeriodicTask),
+but a VirtualClock can be installed with set_clock() so that simulations
+run hours of behaviour in seconds:
+
+    clock = stk.clock.VirtualClock()
+    stk.clock.set_clock(clock)
+    service = MyService(qiapp) # periodic tasks are created on the clock
+    clock.advance(3600)        # runs an hour of timers, instantly
+
+Install the clock before creating the objects that use it, as periodic
+tasks are bound to the clock that created them.
+"""
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2018, Softbank Robotics"
+
+import functools
+import heapq
+import threading
+import time as _time
+
+import qi
+
+ONE_SECOND_IN_US = 1000000
+
+class WallClock(object):
+    "Real time."
+    def time(self):
+        "Seconds since epoch."
+        return _time.time()
+
+    def sleep(self, seconds):
+        "Blocks the thread."
+        _time.sleep(seconds)
+
+    def call_later(self, seconds, callback, *args):
+        "Calls callback after a delay; returns a (cancelable) future."
+        return qi.async(functools.partial(callback, *args),
+                        delay=int(seconds * ONE_SECOND_IN_US))
+
+    def periodic_task(self):
+        "Returns a new (not started) periodic task."
+        return qi.PeriodicTask()
+
+class VirtualPeriodicTask(object):
+    "Same interface as qi.PeriodicTask, scheduled on a VirtualClock."
+    def __init__(self, clock):
+        self.clock = clock
+        self.callback = None
+        self.us_period = ONE_SECOND_IN_US
+        self.running = False
+        self.generation = 0 # invalidates the scheduled tick on stop
+
+    def setCallback(self, callback):
+        self.callback = callback
+
+    def setUsPeriod(self, us_period):
+        self.us_period = us_period
+
+    def start(self, immediate=True):
+        if not self.running:
+            self.running = True
+            self.generation += 1
+            delay = 0 if immediate else self.us_period / float(ONE_SECOND_IN_US)
+            self.clock.schedule(delay, self._tick, self.generation)
+
+    def stop(self):
+        self.running = False
+        self.generation += 1
+
+    def isRunning(self):
+        return self.running
+
+    def _tick(self, generation):
+        if self.running and generation == self.generation:
+            self.callback()
+            if self.running and generation == self.generation:
+                self.clock.schedule(self.us_period / float(ONE_SECOND_IN_US),
+                                    self._tick, generation)
+
+class VirtualClock(object):
+    """Time only moves when someone advances it (or sleeps).
+
+    Timers are run by the thread calling advance() or sleep(), in deadline
+    order, so that runs are deterministic.
+    """
+    def __init__(self, start=0.0):
+        self.now = float(start)
+        self.queue = []
+        self.counter = 0
+        self.lock = threading.RLock()
+
+    def time(self):
+        "Virtual seconds."
+        return self.now
+
+    def sleep(self, seconds):
+        "Doesn't block: time goes forward, running the timers on the way."
+        self.advance(seconds)
+
+    def schedule(self, seconds, callback, *args):
+        "Internal - add a timer; returns its entry (for cancelling)."
+        with self.lock:
+            self.counter += 1
+            entry = [self.now + max(seconds, 0.0), self.counter,
+                     functools.partial(callback, *args)]
+            heapq.heappush(self.queue, entry)
+            return entry
+
+    def call_later(self, seconds, callback, *args):
+        "Calls callback after a virtual delay; returns a (cancelable) future."
+        promise = qi.Promise(lambda promise: self._cancel(entry, promise))
+        def run():
+            try:
+                promise.setValue(callback(*args))
+            except Exception as exc:
+                promise.setError(str(exc))
+        entry = self.schedule(seconds, run)
+        return promise.future()
+
+    def _cancel(self, entry, promise):
+        "Internal - cancels a pending call_later."
+        with self.lock:
+            if entry[2] is not None:
+                entry[2] = None
+                promise.setCanceled()
+
+    def periodic_task(self):
+        "Returns a new (not started) periodic task."
+        return VirtualPeriodicTask(self)
+
+    def advance(self, seconds):
+        "Moves time forward by seconds, running due timers."
+        self.run_until(self.now + seconds)
+
+    def run_until(self, deadline):
+        "Moves time forward to deadline, running due timers."
+        while True:
+            with self.lock:
+                if not self.queue or self.queue[0][0] > deadline:
+                    self.now = max(self.now, deadline)
+                    return
+                entry = heapq.heappop(self.queue)
+                self.now = max(self.now, entry[0])
+                # Mark as done, so that a late cancel does nothing
+                callback, entry[2] = entry[2], None
+            if callback:
+                callback()
+
+    def pending(self):
+        "Number of timers waiting."
+        with self.lock:
+            return len([entry for entry in self.queue if entry[2]])
+
+###########################################
+#            Current clock                #
+###########################################
+
+_CLOCK = [WallClock()]
+
+def get_clock():
+    "The clock currently used by the app."
+    return _CLOCK[0]
+
+def set_clock(clock):
+    "Replaces the clock (e.g. by a VirtualClock); returns the old one."
+    old_clock = _CLOCK[0]
+    _CLOCK[0] = clock
+    return old_clock
+
+def time():
+    "Current time in seconds."
+    return _CLOCK[0].time()
+
+def sleep(seconds):
+    "Sleeps on the current clock."
+    _CLOCK[0].sleep(seconds)
+
+def call_later(seconds, callback, *args):
+    "Calls callback later; returns a future."
+    return _CLOCK[0].call_later(seconds, callback, *args)
+
+def periodic_task(callback=None, us_period=None):
+    "A qi.PeriodicTask-like object on the current clock."
+    task = _CLOCK[0].periodic_task()
+    if callback:
+        task.setCallback(callback)
+    if us_period:
+        task.setUsPeriod(int(us_period))
+    return task
@@ -0,0 +1,250 @@
+"""
+stk.logging.py
+
+Utility library for logging with qi.
+
+Loggers of get_logger share a single LogProvider per process, and format
+their messages only if they are logged:
+
+    logger.info("moved %.2f m in %.1f s", distance, duration)
+
+In code called very often, log at most once per period (per line of code);
+the next message says how many were dropped, and so does the last one of a
+burst, at the end of the period:
+
+    logger.every(5.0).warning("detection failed: %s", error)
+
+Messages up to INFO are logged; VERBOSE ones are opt-in (set_level), so
+that they cost nothing otherwise.
+"""
+
+__version__ = "0.1.3"
+
+__copyright__ = "Copyright 2015, Aldebaran Robotics"
+__author__ = 'ekroeger'
+__email__ = 'ekroeger@aldebaran.com'
+
+import functools
+import sys
+import threading
+import traceback
+
+import qi
+
+import stk.clock
+
+# Log levels, as in qi
+FATAL = 1
+ERROR = 2
+WARNING = 3
+INFO = 4
+VERBOSE = 5
+
+# Messages of a higher level are dropped before being formatted; qi filters
+# the others with its own level
+_LEVEL = [INFO]
+
+# The LogProvider shared by all loggers (see get_logger)
+_PROVIDER = [None]
+_PROVIDER_LOCK = threading.Lock()
+
+def set_level(level):
+    "Only log messages up to level (e.g. stk.logging.VERBOSE)."
+    _LEVEL[0] = level
+
+def get_level():
+    "Level up to which messages are logged."
+    return _LEVEL[0]
+
+def add_log_provider(session):
+    """Registers a LogProvider with LogManager, once for the whole process,
+    so that logs are visible on the robot."""
+    with _PROVIDER_LOCK:
+        if _PROVIDER[0] is not None:
+            return _PROVIDER[0]
+        try:
+            qicore = qi.module("qicore")
+            log_manager = session.service("LogManager")
+            provider = qicore.createObject("LogProvider", log_manager)
+            log_manager.addProvider(provider)
+            _PROVIDER[0] = provider
+        except RuntimeError:
+            # no qicore, we're not running on a robot, it doesn't matter
+            pass
+        except AttributeError:
+            # old version of NAOqi - logging will probably not work.
+            pass
+        return _PROVIDER[0]
+
+def get_logger(session, app_id):
+    """Returns a logger (see Logger)."""
+    add_log_provider(session)
+    return Logger(app_id)
+
+class Logger(object):
+    """A qi logger, formatting message % args only if the level is logged.
+
+    every(period) gives the same logger, limited to a message per period
+    for each line of code calling it."""
+    def __init__(self, category):
+        self.category = category
+        self.logger = qi.logging.Logger(category)
+        self.lock = threading.Lock()
+        # [time of the next message, suppressed count, last suppressed
+        # (log, message, args) or None, period], by (file, line)
+        self.call_sites = {}
+
+    @staticmethod
+    def is_enabled_for(level):
+        "Whether messages of level are logged."
+        return level <= _LEVEL[0]
+
+    def fatal(self, message, *args):
+        "Logs a fatal error."
+        self._log(FATAL, self.logger.fatal, message, args)
+
+    def error(self, message, *args):
+        "Logs an error."
+        self._log(ERROR, self.logger.error, message, args)
+
+    def warning(self, message, *args):
+        "Logs a warning."
+        self._log(WARNING, self.logger.warning, message, args)
+
+    def info(self, message, *args):
+        "Logs an information."
+        self._log(INFO, self.logger.info, message, args)
+
+    def verbose(self, message, *args):
+        "Logs a detail."
+        self._log(VERBOSE, self.logger.verbose, message, args)
+
+    def every(self, period):
+        "This logger, logging at most once per period (s) per call site."
+        return _RateLimitedLogger(self, period)
+
+    def _log(self, level, log, message, args, period=None):
+        "Internal - formats and logs the message, if it should be."
+        if level > _LEVEL[0]:
+            return
+        if period is not None:
+            # The caller of the method of _RateLimitedLogger
+            frame = sys._getframe(3)
+            suppressed = self._allow(
+                (frame.f_code.co_filename, frame.f_lineno), period,
+                (log, message, args))
+            if suppressed is None:
+                return
+        else:
+            suppressed = 0
+        self._write(log, message, args, suppressed)
+
+    @staticmethod
+    def _write(log, message, args, suppressed):
+        "Internal - formats and logs a message."
+        if args:
+            message = message % args
+        if suppressed:
+            message = "%s (%d similar messages suppressed)" % (message,
+                                                               suppressed)
+        log(message)
+
+    def _allow(self, call_site, period, entry):
+        """Internal - None if the call site must wait, otherwise the number
+        of its messages suppressed since the last one."""
+        now = stk.clock.time()
+        with self.lock:
+            state = self.call_sites.get(call_site)
+            if state is None:
+                self.call_sites[call_site] = [now + period, 0, None, period]
+                return 0
+            if now < state[0]:
+                if state[2] is None:
+                    # Summarised at the end of the period (see _flush)
+                    stk.clock.call_later(state[0] - now, self._flush,
+                                         call_site, state[0])
+                state[1] += 1
+                state[2] = entry
+                return None
+            suppressed = state[1]
+            state[0] = now + period
+            state[1] = 0
+            state[2] = None
+            state[3] = period
+            return suppressed
+
+    def _flush(self, call_site, deadline):
+        """Internal - at the end of a period, logs the last message
+        suppressed, unless a message was logged since."""
+        with self.lock:
+            state = self.call_sites.get(call_site)
+            if state is None or state[0] != deadline or state[2] is None:
+                return
+            log, message, args = state[2]
+            suppressed = state[1] - 1
+            # As if that message was logged now
+            state[0] = deadline + state[3]
+            state[1] = 0
+            state[2] = None
+        self._write(log, message, args, suppressed)
+
+class _RateLimitedLogger(object):
+    "Internal - a Logger logging at most once per period per call site."
+    def __init__(self, logger, period):
+        self.logger = logger
+        self.period = period
+
+    def fatal(self, message, *args):
+        "Logs a fatal error."
+        self._log(FATAL, self.logger.logger.fatal, message, args)
+
+    def error(self, message, *args):
+        "Logs an error."
+        self._log(ERROR, self.logger.logger.error, message, args)
+
+    def warning(self, message, *args):
+        "Logs a warning."
+        self._log(WARNING, self.logger.logger.warning, message, args)
+
+    def info(self, message, *args):
+        "Logs an information."
+        self._log(INFO, self.logger.logger.info, message, args)
+
+    def verbose(self, message, *args):
+        "Logs a detail."
+        self._log(VERBOSE, self.logger.logger.verbose, message, args)
+
+    def _log(self, level, log, message, args):
+        "Internal - see Logger._log"
+        self.logger._log(level, log, message, args, self.period)
+
+def log_exceptions(func):
+    """Catches all exceptions in decorated method, and prints them.
+
+    Attached function must be on an object with a "logger" member.
+    """
+    @functools.wraps(func)
+    def wrapped(self, *args):
+        try:
+            return func(self, *args)
+        except Exception as exc:
+            self.logger.error(traceback.format_exc())
+            raise exc
+    return wrapped
+
+
+def log_exceptions_and_return(default_value):
+    """If an exception occurs, print it and return default_value.
+
+    Attached function must be on an object with a "logger" member.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(self, *args):
+            try:
+                return func(self, *args)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+                return default_value
+        return wrapped
+    return decorator
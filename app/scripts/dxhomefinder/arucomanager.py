@@ -12,6 +12,7 @@ __email__ = 'mcaniot@softbankrobotics.com'
 import qi
 
 import json
+import threading
 
 # stk libs
 import stk.runner
@@ -24,6 +25,7 @@ import math
 import numpy
 import almath
 
+import gohomestats
 import move
 
 DEFAULT_IDS = [128, 448]
@@ -56,6 +58,12 @@ DISTANCE_FIRST_APPROACH = 1.3
 
 DISTANCE_FROM_SMALL_ARUCO = 0.61
 
+# Error of a marker detection, for estimate_home
+DETECTION_ERROR = 0.05 # in meters
+
+# Failed detections are logged at most once per period
+DETECTION_LOG_PERIOD = 5.0 # in seconds
+
 class ARucoManager(object):
     """
     Class for saving position
@@ -74,8 +82,14 @@ class ARucoManager(object):
         self.subscriber_name = []
         self.event_name = []
         self.search_future_track = None
-        self.future_sleep = None
+        # Set at the first detection of a search (see search_home)
+        self.detection_lock = threading.Lock()
+        self.detection_promise = None
         self.aruco_position_from_robot = {}
+        # Pose of the home given by the markers (see get_home_in_world) in
+        # the frame of home, when home was defined away from it (fusion
+        # mode); None when home is where the markers say
+        self.target_in_home = None
 
     ###########################################
     #            Public Method                #
@@ -93,14 +107,56 @@ class ARucoManager(object):
             self.services.PositionManager.init_position()
             self.aruco_pos_in_world = [0.0, 0.0]
             self.aruco_position_from_robot = {}
+            self.target_in_home = None
         yield stk.coroutines.Return(value)
 
+    @stk.coroutines.async_generator
+    def init_home_here(self):
+        """Home is the current position (see PositionManager.init_position):
+        records where the markers in view are from it, without moving.
+        Returns False if no marker is in view."""
+        self.target_in_home = None
+        target_in_world = yield self.get_marker_home_in_view()
+        if not target_in_world:
+            yield stk.coroutines.Return(False)
+            return
+        home_in_world = almath.Pose2D(
+                self.services.ALMotion.getRobotPosition(True))
+        target_in_home = home_in_world.inverse() * \
+                         almath.Pose2D(target_in_world)
+        self.target_in_home = list(target_in_home.toVector())
+        self.aruco_pos_in_world = [0.0, 0.0]
+        self.aruco_position_from_robot = {}
+        yield stk.coroutines.Return(True)
+
     def is_init(self):
         return self.aruco_pos_in_world != None
 
     def uninit(self):
         self.aruco_pos_in_world = None
         self.aruco_position_from_robot = {}
+        self.target_in_home = None
+
+    def get_checkpoint(self):
+        "State to keep across restarts (see restore_checkpoint)"
+        return {"pos_in_world": self.aruco_pos_in_world,
+                "target_in_home": self.target_in_home}
+
+    def restore_checkpoint(self, checkpoint):
+        "Restores the state of get_checkpoint; returns whether home is known"
+        self.aruco_pos_in_world = checkpoint.get("pos_in_world")
+        self.aruco_position_from_robot = {}
+        self.target_in_home = checkpoint.get("target_in_home")
+        return self.is_init()
+
+    def get_in_home(self, x_coord, y_coord):
+        """Position [x, y] in the frame of home, from the frame of the home
+        given by the markers"""
+        if self.target_in_home is None:
+            return [x_coord, y_coord]
+        position = almath.Pose2D(self.target_in_home) * \
+                   almath.Pose2D(x_coord, y_coord, 0.0)
+        return [position.x, position.y]
 
     def cancel(self):
         "Cancel return home"
@@ -140,10 +196,20 @@ class ARucoManager(object):
                       coord_aruco[-1] + math.pi]
 
         is_success = False
-        if self.services.PositionManager.turn_toward_position([DISTANCE_FIRST_APPROACH, 0]):
+        # Asynchronous (and stopping the robot when cancelled), so that
+        # cancelling the approach stops it right away
+        rotation_success = yield self.services.PositionManager.turn_toward_position(
+                                            [DISTANCE_FIRST_APPROACH, 0],
+                                            _async=True)
+        if rotation_success:
             x, y, theta = coord_home
             r, r_theta = self.get_polar_coord([x, y, theta])
-            if self.services.ALMotion.moveTo(r, 0, 0, MOVE_CONFIG_HIGH_SPEED):
+            translation_success = yield move.stop_on_cancel(
+                    self.services.ALMotion.moveTo(r, 0, 0,
+                                                  MOVE_CONFIG_HIGH_SPEED,
+                                                  _async=True),
+                    self.services.ALMotion.stopMove)
+            if translation_success:
                 is_success = True
                 yield self.services.PositionManager.turn_toward_position([0, 0],
                                                                          _async=True)
@@ -161,11 +227,13 @@ class ARucoManager(object):
             yield stk.coroutines.Return(None)
 
         if self.aruco_pos_in_world and not research_360_activated:
-            distance_big_aruco = self.services.PositionManager.get_dist_from_robot(0, 0)
-            distance_small_aruco = self.services.PositionManager.get_dist_from_robot(0.56, 0)
+            distance_big_aruco = self.services.PositionManager.get_dist_from_robot(
+                                            *self.get_in_home(0, 0))
+            distance_small_aruco = self.services.PositionManager.get_dist_from_robot(
+                                            *self.get_in_home(0.56, 0))
             if distance_big_aruco > 0.60:
                 aruco_future = self.services.PositionManager.turn_toward_position(\
-                                                    [0, 0],
+                                                    self.get_in_home(0, 0),
                                                     _async=True)
                 yield aruco_future
                 aruco_future = self.services.ALTracker._lookAtWithEffector(
@@ -179,7 +247,7 @@ class ARucoManager(object):
                 id_aruco = 128
             elif distance_small_aruco > 0.40:
                 aruco_future = self.services.PositionManager.turn_toward_position(\
-                                                    [1.0, 0],
+                                                    self.get_in_home(1.0, 0),
                                                     _async=True)
                 yield aruco_future
                 aruco_future = self.services.ALTracker._lookAtWithEffector(
@@ -206,17 +274,12 @@ class ARucoManager(object):
                         DEFAULT_PARAMS[id_aruco],
                         _async=True)
             if aruco_future:
-                self.logger.info(aruco_future)
-                if id_aruco in aruco_future:
-                    self.logger.info("id_aruco")
-                    self.logger.info(id_aruco)
-                else:
-                    self.logger.info("id_aruco")
+                if id_aruco not in aruco_future:
                     [id_aruco] = [tmp for tmp in [128,448] if tmp != id_aruco]
-                    self.logger.info(id_aruco)
+                self.logger.verbose("markers %s, id_aruco %s", aruco_future,
+                                    id_aruco)
 
                 if id_aruco in aruco_future:
-                    self.logger.info(aruco_future)
                     coord_aruco = aruco_future[id_aruco]
                     coord_home_pos = None
                     if len(coord_aruco) == 6:
@@ -239,7 +302,6 @@ class ARucoManager(object):
                                 y,
                                 theta
                                 ]
-                        coord_home_pos = [coord_home_pos[0], coord_home_pos[1], coord_home_pos[-1] + math.radians(-135)]
                     else:
                         theta += math.radians(135)
                         coord_home = [
@@ -247,21 +309,76 @@ class ARucoManager(object):
                                 y - DISTANCE_FROM_SMALL_ARUCO * math.sin(theta),
                                 theta
                                 ]
-                        coord_home_pos = [coord_home_pos[0] - DISTANCE_FROM_SMALL_ARUCO * math.cos(coord_home_pos[-1] + math.radians(135)),
-                                          coord_home_pos[1] - DISTANCE_FROM_SMALL_ARUCO * math.sin(coord_home_pos[-1] + math.radians(135)),
-                                          coord_home_pos[-1] + math.radians(135)]
+                    coord_home_pos = self.get_home_in_world(id_aruco,
+                                                            coord_home_pos)
                     if coord_home_pos != None:
                         self.services.PositionManager.init_position_with_coord(coord_home_pos)
                         self.aruco_pos_in_world = [0.0, 0.0]
-                    self.logger.info("coord " + repr(coord_home))
+                        if self.target_in_home is not None:
+                            # Home itself, seen from the robot
+                            coord_home = list((p2D_world2robot.inverse() *
+                                               almath.Pose2D(coord_home_pos)
+                                              ).toVector())
+                    self.logger.info("coord %r", coord_home)
                     yield stk.coroutines.Return([coord_home,
                                                     id_aruco])
                     return
         except Exception as error_msg:
-            self.logger.warning("No aruco with the id " + repr(id_aruco) + " found.")
+            self.logger.every(DETECTION_LOG_PERIOD).warning(
+                    "No aruco with the id %r found.", id_aruco)
             # Now continue at the next head angle
         yield stk.coroutines.Return(None)
 
+    def get_home_in_world(self, id_aruco, coord_aruco):
+        "Pose of home in the world frame, from the pose of a marker in it"
+        x, y, theta = coord_aruco
+        if id_aruco == 128:
+            home_in_world = [x, y, theta + math.radians(-135)]
+        else:
+            theta += math.radians(135)
+            home_in_world = [x - DISTANCE_FROM_SMALL_ARUCO * math.cos(theta),
+                             y - DISTANCE_FROM_SMALL_ARUCO * math.sin(theta),
+                             theta]
+        if self.target_in_home is None:
+            return home_in_world
+        home_in_world = almath.Pose2D(home_in_world) * \
+                        almath.Pose2D(self.target_in_home).inverse()
+        return list(home_in_world.toVector())
+
+    @stk.coroutines.async_generator
+    def estimate_home(self):
+        """[pose of home in the world frame, error in m] from the markers in
+        view, or None. Doesn't move the robot."""
+        if not self.is_init():
+            yield stk.coroutines.Return(None)
+            return
+        home_in_world = yield self.get_marker_home_in_view()
+        if home_in_world:
+            yield stk.coroutines.Return([home_in_world, DETECTION_ERROR])
+            return
+        yield stk.coroutines.Return(None)
+
+    @stk.coroutines.async_generator
+    def get_marker_home_in_view(self):
+        """Pose of home in the world frame (see get_home_in_world) from the
+        markers in view, or None. Doesn't move the robot."""
+        try:
+            markers = yield self.services.DXAruco.get_home_position_in_world(
+                    DEFAULT_PARAMS[DEFAULT_IDS[0]],
+                    _async=True)
+        except Exception as error_msg:
+            self.logger.every(DETECTION_LOG_PERIOD).info(
+                    "No marker seen: %s", error_msg)
+            markers = None
+        for id_aruco in DEFAULT_IDS:
+            if markers and id_aruco in markers:
+                coord_aruco = markers[id_aruco]
+                coord_aruco = [coord_aruco[0], coord_aruco[1], coord_aruco[-1]]
+                yield stk.coroutines.Return(
+                        self.get_home_in_world(id_aruco, coord_aruco))
+                return
+        yield stk.coroutines.Return(None)
+
     def get_polar_coord(self, coord_home):
         x , y , theta = coord_home
         r_theta = float(numpy.arctan(y/x))
@@ -270,20 +387,21 @@ class ARucoManager(object):
 
     @stk.coroutines.async_generator
     def last_move(self, x, y, theta):
-        value = yield self.services.ALMotion.moveTo(
-                                         x,
-                                         y,
-                                         0,
-                                         MOVE_CONFIG_LOW_SPEED,
-                                         _async=True)
+        value = yield move.stop_on_cancel(
+                self.services.ALMotion.moveTo(x,
+                                              y,
+                                              0,
+                                              MOVE_CONFIG_LOW_SPEED,
+                                              _async=True),
+                self.services.ALMotion.stopMove)
         if value:
-            value = yield self.services.ALMotion.moveTo(
-                                         0,
-                                         0,
-                                         almath.modulo2PI(
-                                                 theta),
-                                         MOVE_CONFIG_LOW_SPEED,
-                                         _async=True)
+            value = yield move.stop_on_cancel(
+                    self.services.ALMotion.moveTo(0,
+                                                  0,
+                                                  almath.modulo2PI(theta),
+                                                  MOVE_CONFIG_LOW_SPEED,
+                                                  _async=True),
+                    self.services.ALMotion.stopMove)
             if value:
                 self.aruco_pos_in_world = [0.0,0.0]
                 self.aruco_position_from_robot = {}
@@ -291,16 +409,26 @@ class ARucoManager(object):
         yield stk.coroutines.Return(False)
 
     @stk.coroutines.async_generator
-    def return_home(self, research_360_activated=False):
+    def return_home(self, research_360_activated=False, record=None):
+        if record is None:
+            record = gohomestats.GoHomeRecord("aruco", research_360_activated)
+        if self.target_in_home is not None:
+            value = yield self.return_home_away_from_markers(
+                                                research_360_activated, record)
+            yield stk.coroutines.Return(value)
+            return
         on_home = False
         id_aruco = None
         if self.need_approach_home() and not research_360_activated:
+            record.enter("approach")
             self.aruco_future = self.approach_home()
             yield self.aruco_future
             if not self.aruco_future.value():
                 if self.services.DXHomeFinder:
                     self.services.DXHomeFinder.reason_cant_go_home.setValue("obstacle")
                 yield stk.coroutines.Return(False)
+        record.search = research_360_activated or not self.aruco_pos_in_world
+        record.enter("find")
         self.aruco_future = self.find_home(research_360_activated)
         coord_home = yield self.aruco_future
         if coord_home:
@@ -309,32 +437,16 @@ class ARucoManager(object):
             r, r_theta = self.get_polar_coord(coord_home)
             if id_aruco == 128 or (id_aruco == 448 and r > 0.5):
                 id_aruco = 128
-                self.aruco_future = self.services.ALMotion.moveTo(
-                                                    0,
-                                                    0,
-                                                    almath.modulo2PI(
-                                                            r_theta),
-                                                    MOVE_CONFIG_LOW_SPEED,
-                                                    _async=True)
+                record.enter("move")
+                # One smooth move to the mark, with its orientation
+                self.aruco_future = move.move_to(self.session, self.logger,
+                                                 coord_home[0],
+                                                 coord_home[1],
+                                                 almath.modulo2PI(
+                                                        coord_home[-1]))
                 yield self.aruco_future
                 if self.aruco_future.value():
-                    self.aruco_future = self.services.ALMotion.moveTo(
-                                                    r,
-                                                    0,
-                                                    0,
-                                                    MOVE_CONFIG_LOW_SPEED,
-                                                    _async=True)
-                    yield self.aruco_future
-                    if self.aruco_future.value():
-                        on_home = True
-                        self.aruco_future = self.services.ALMotion.moveTo(
-                                                    0,
-                                                    0,
-                                                    almath.modulo2PI(
-                                                    coord_home[-1] - r_theta),
-                                                    MOVE_CONFIG_LOW_SPEED,
-                                                    _async=True)
-                        yield self.aruco_future
+                    on_home = True
             else:
                 on_home = True
         else:
@@ -343,12 +455,14 @@ class ARucoManager(object):
                 self.services.DXHomeFinder.reason_cant_go_home.setValue("no_target")
         if on_home:
             if id_aruco == 128:
+                record.enter("find")
                 self.aruco_future = self.find_home()
                 coord_home = yield self.aruco_future
                 if coord_home:
                     id_aruco = coord_home[1]
                     coord_home = coord_home[0]
             if coord_home and id_aruco == 448:
+                record.enter("move")
                 x, y, theta = coord_home
                 self.aruco_future = self.last_move(
                         x,
@@ -368,6 +482,30 @@ class ARucoManager(object):
                 self.services.DXHomeFinder.reason_cant_go_home.setValue("obstacle")
         yield stk.coroutines.Return(False)
 
+    @stk.coroutines.async_generator
+    def return_home_away_from_markers(self, research_360_activated, record):
+        """return_home when home was defined away from the markers (see
+        init_home_here): one move to home, as seen from the markers"""
+        record.search = research_360_activated or not self.aruco_pos_in_world
+        record.enter("find")
+        self.aruco_future = self.find_home(research_360_activated)
+        coord_home = yield self.aruco_future
+        if not coord_home:
+            if self.services.DXHomeFinder:
+                self.services.DXHomeFinder.reason_cant_go_home.setValue("no_target")
+            yield stk.coroutines.Return(False)
+            return
+        coord_home = coord_home[0]
+        record.enter("move")
+        self.aruco_future = move.move_to(self.session, self.logger,
+                                         coord_home[0],
+                                         coord_home[1],
+                                         almath.modulo2PI(coord_home[-1]))
+        value = yield self.aruco_future
+        if not value and self.services.DXHomeFinder:
+            self.services.DXHomeFinder.reason_cant_go_home.setValue("obstacle")
+        yield stk.coroutines.Return(value)
+
     @stk.coroutines.async_generator
     def search_routine(self):
         angle_to_do = 50
@@ -386,17 +524,26 @@ class ARucoManager(object):
                         1,
                         _async=True)
                 yield self.search_future_track
-            self.search_future_track = self.services.ALMotion.moveTo(0, 0, math.radians(angle_to_do), _async=True)
+            self.search_future_track = move.stop_on_cancel(
+                    self.services.ALMotion.moveTo(0, 0,
+                                                  math.radians(angle_to_do),
+                                                  _async=True),
+                    self.services.ALMotion.stopMove)
             yield self.search_future_track
 
     @stk.coroutines.public_async_generator
     @stk.logging.log_exceptions
     def search_home(self):
         self.logger.info("search home")
+        with self.detection_lock:
+            self.detection_promise = qi.Promise()
+            detection_future = self.detection_promise.future()
         # launch aruco search
         self.subscribe_aruco_list(DEFAULT_PARAMS_LIST)
         try:
-            self.search_future = self.search_routine()
+            # Looks around until a code is seen
+            self.search_future = stk.coroutines.cancel_on(
+                    self.search_routine(), detection_future)
             yield self.search_future
         except Exception as error_msg:
             self.logger.warning(error_msg)
@@ -407,7 +554,11 @@ class ARucoManager(object):
     def aruco_detected(self, value):
         json_value = json.loads(value)
         self.aruco_position_from_robot[json_value["id_aruco"]] = json_value["world2target"]
-        self.cancel_all_future_search_home()
+        # Stops the search (see search_home)
+        with self.detection_lock:
+            promise, self.detection_promise = self.detection_promise, None
+        if promise:
+            promise.setValue(json_value["id_aruco"])
 
     def subscribe_aruco_list(self, aruco_list):
         if not self.services.DXAruco:
@@ -450,21 +601,12 @@ class ARucoManager(object):
 
 
     def cancel_all_future_search_home(self):
+        # Cancelling the search stops what it is doing
         try:
             if self.search_future:
                 self.search_future.cancel()
         except Exception as error_msg:
             self.logger.warning(error_msg)
-        try:
-            if self.future_sleep:
-                self.future_sleep.cancel()
-        except Exception as error_msg:
-            self.logger.warning(error_msg)
-        try:
-            if self.search_future_track:
-                self.search_future_track.cancel()
-        except Exception as error_msg:
-            self.logger.warning(error_msg)
 
     def cancel_search_home(self):
         self.cancel_all_future_search_home()
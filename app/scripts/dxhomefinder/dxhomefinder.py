@@ -17,6 +17,10 @@ __email__ = 'ekroeger@softbankrobotics.com and mcaniot@softbankrobotics.com'
 # Import qi
 import qi
 
+# Basic libs
+import json
+import os
+
 # stk libs
 import stk.runner
 import stk.events
@@ -28,6 +32,7 @@ import stk.coroutines
 import slammanager as slamm
 import podmanager as podm
 import arucomanager as arucom
+import gohomestats
 
 import math
 
@@ -37,6 +42,36 @@ DEFAULT_ENGAGE_DISTANCE = 1.0
 
 PACKAGE_ID = "home-finder"
 
+# Checkpoint of the home for warm restarts, kept outside of the package so
+# that it survives a reinstall
+if stk.runner.is_on_robot():
+    PATH_CHECKPOINT_FILE = ("/home/nao/.local/share/proactive-mobility/"
+                            "homefinder.json")
+else:
+    PATH_CHECKPOINT_FILE = "data/homefinder.json"
+
+CHECKPOINT_VERSION = 1
+
+# A checkpoint is restored only if the odometric error is under that
+RESTORE_MAX_ERROR = 0.5 # in meters
+
+# In fusion mode, all these finders look for home at the same time; home is
+# defined once, where the robot is (see __init_fusion_home)
+FUSION_MODE = "fusion"
+FUSION_FINDERS = ["pod", "aruco", "slam"]
+
+# Finders recording home from what they see (see init_home_here)
+FUSION_IN_VIEW_FINDERS = ["pod", "aruco"]
+
+# The first estimate of home under that error drives the return
+FUSION_MAX_ERROR = 0.3 # in meters
+
+# Time given to the finders to estimate where home is
+FUSION_TIMEOUT = 10.0 # in seconds
+
+# Under that distance, home is already in view
+FUSION_MIN_TURN_DISTANCE = 0.6 # in meters
+
 @qi.multiThreaded() # TODO: take this out once this doesn't have time.sleep
 class DXHomeFinder(object):
     "NAOqi service example (set/get on a simple value)."
@@ -67,10 +102,15 @@ class DXHomeFinder(object):
             "aruco": self.aruco_manager
         }
 
-        # Mode : simple, slam, qrcode, pod
+        # Mode : slam, aruco, pod, or fusion (all of them)
         self.mode = "slam"
         # future_movement
         self.future_movement = None
+        # How going home went, by technology
+        self.stats = gohomestats.GoHomeStats()
+
+        # Warm restart
+        self.__restore_checkpoint()
 
     ##################################
     # Configuration
@@ -80,29 +120,39 @@ class DXHomeFinder(object):
     def set_current_pos_as_home(self):
         "Home must be current position."
         self.position_manager.init_position()
-        self.future_movement = self.finders[self.mode].init_home()
-        yield self.future_movement
-        init_value = self.future_movement.value()
-        if init_value:
-            self.position_manager.init_position()
+        if self.mode == FUSION_MODE:
+            self.future_movement = self.__init_fusion_home()
+            init_value = yield self.future_movement
+        else:
+            self.future_movement = self.finders[self.mode].init_home()
+            init_value = yield self.future_movement
+            if init_value:
+                self.position_manager.init_position()
+        self.__save_checkpoint()
         yield stk.coroutines.Return(init_value)
 
     ##################
     # Actions
     
     def is_init(self):
-        return self.finders[self.mode].is_init()
+        return any(finder.is_init() for finder in self.__get_finders())
 
     def uninit(self):
-        return self.finders[self.mode].uninit()
+        value = None
+        for finder in self.__get_finders():
+            value = finder.uninit()
+        self.__save_checkpoint()
+        return value
 
     def set_mode(self, mode):
-        "Change the navigation mode. (slam, aruco, pod)"
+        "Change the navigation mode. (slam, aruco, pod, fusion)"
         if mode.lower() != self.mode:
-            self.finders[self.mode].uninit()
+            for finder in self.__get_finders():
+                finder.uninit()
             self.mode = mode.lower()
             self.future_movement = None
             self.logger.info("change the mode for : " + repr(mode))
+            self.__save_checkpoint()
         else:
             self.logger.info("same mode as before : " + repr(mode))
         return self.mode
@@ -115,17 +165,37 @@ class DXHomeFinder(object):
         if not self.going_home.value():
             self.reason_cant_go_home.setValue("unknown")
             self.going_home.setValue(True)
-            if self.finders[self.mode].is_init():
-                self.future_movement = self.finders[self.mode].return_home(research_360_activated)
-                yield self.future_movement
-                value = self.future_movement.value()
-                if not value and not research_360_activated and self.reason_cant_go_home.value() == "no_target":
-                    self.future_movement = self.finders[self.mode].return_home(True)
+            # Obstacles are needed to go around them (see PositionManager)
+            self.position_manager.start_sampling(self.APP_ID)
+            try:
+                name = self.mode
+                if self.mode == FUSION_MODE:
+                    self.future_movement = self.__find_best_finder()
+                    name = yield self.future_movement
+                finder = self.finders.get(name)
+                if finder and finder.is_init():
+                    self.future_movement = self.__return_home(name, research_360_activated)
                     yield self.future_movement
                     value = self.future_movement.value()
-                if value:
-                    self.logger.info(repr(value))
-                    self.position_manager.init_position()
+                    if not value and not research_360_activated and self.reason_cant_go_home.value() == "no_target":
+                        self.future_movement = self.__return_home(name, True)
+                        yield self.future_movement
+                        value = self.future_movement.value()
+                    if not value and self.reason_cant_go_home.value() == "obstacle":
+                        # Go around the obstacles seen, and try again
+                        self.future_movement = self.position_manager.follow_route_home(_async=True)
+                        yield self.future_movement
+                        if self.future_movement.value():
+                            self.reason_cant_go_home.setValue("unknown")
+                            self.future_movement = self.__return_home(name, research_360_activated)
+                            yield self.future_movement
+                            value = self.future_movement.value()
+                    if value:
+                        self.logger.info(repr(value))
+                        self.position_manager.init_position()
+                    self.__save_checkpoint()
+            finally:
+                self.position_manager.stop_sampling(self.APP_ID)
             self.going_home.setValue(False)
             self.future_movement = None
         yield stk.coroutines.Return(value)
@@ -139,8 +209,78 @@ class DXHomeFinder(object):
         except Exception as error_msg:
             self.logger.warning(error_msg)
         self.future_movement = None
-        self.finders[self.mode].cancel()
-        
+        for finder in self.__get_finders():
+            finder.cancel()
+
+    ##################################
+    # Fusion of the finders
+
+    @qi.nobind
+    def __get_finders(self):
+        "Finders used by the current mode"
+        if self.mode == FUSION_MODE:
+            return [self.finders[name] for name in FUSION_FINDERS]
+        return [self.finders[self.mode]]
+
+    @stk.coroutines.async_generator
+    def __init_fusion_home(self):
+        """Defines home here for all the finders, without moving: those not
+        seeing their station or markers from here are left out"""
+        # Both look at the same time; the slam turns around, so it goes last
+        self.future_movement = stk.coroutines.gather(
+                [self.finders[name].init_home_here()
+                 for name in FUSION_IN_VIEW_FINDERS])
+        values = yield self.future_movement
+        self.future_movement = self.finders["slam"].init_home()
+        values.append((yield self.future_movement))
+        for name, value in zip(FUSION_IN_VIEW_FINDERS + ["slam"], values):
+            if not value:
+                self.logger.info("Home defined without %s", name)
+                self.finders[name].uninit()
+        yield stk.coroutines.Return(any(values))
+
+    @stk.coroutines.async_generator
+    def __find_best_finder(self):
+        """Name of the finder that should drive the return, after updating
+        home with the first confident estimate of all finders"""
+        names = [name for name in FUSION_FINDERS
+                 if self.finders[name].is_init()]
+        if not names:
+            yield stk.coroutines.Return(None)
+            return
+        # Face home, so that the cameras may see the station or the marker
+        distance = self.position_manager.get_dist_from_robot(0, 0)
+        if distance > FUSION_MIN_TURN_DISTANCE:
+            yield self.position_manager.turn_toward_position([0, 0],
+                                                             _async=True)
+            if self.services.ALTracker:
+                yield self.services.ALTracker._lookAtWithEffector(
+                        [distance, 0, 0], 2, 2, 0.1, 0, _async=True)
+        estimate = yield self.__get_first_confident_estimate(names)
+        if estimate:
+            name, home_in_world, error = estimate
+            self.logger.info("Home found by %s (error %.2f m)", name, error)
+            self.position_manager.init_position_with_coord(home_in_world)
+            yield stk.coroutines.Return(name)
+            return
+        # Nobody is sure: the first finder will look around by itself
+        yield stk.coroutines.Return(names[0])
+
+    @stk.coroutines.async_generator
+    def __get_first_confident_estimate(self, names):
+        """[name, home in world, error] of the first finder to estimate home
+        under FUSION_MAX_ERROR, or None; the others are cancelled"""
+        first = yield stk.coroutines.with_timeout(
+                stk.coroutines.first_completed(
+                        [self.finders[name].estimate_home() for name in names],
+                        lambda estimate: bool(estimate) and
+                                         estimate[1] <= FUSION_MAX_ERROR),
+                FUSION_TIMEOUT)
+        if first:
+            index, estimate = first
+            yield stk.coroutines.Return([names[index]] + list(estimate))
+            return
+        yield stk.coroutines.Return(None)
 
     ##################################
     # Info (helps decide what to do next)
@@ -166,6 +306,54 @@ class DXHomeFinder(object):
     def get_mode(self):
         return self.mode
 
+    def get_stats(self):
+        """Statistics of the last go home of each technology (see
+        gohomestats): durations of the phases, success rate, reasons of the
+        failures, residual error and expected time to home."""
+        return self.stats.get_all_stats()
+
+    def recommend_mode(self):
+        "Technologies, by expected time to home here (fastest first)."
+        return self.stats.rank_modes(FUSION_FINDERS)
+
+    def set_verbose_logs(self, enabled):
+        """Logs the verbose messages too (see stk.logging), for debugging;
+        they are dropped by default."""
+        stk.logging.set_level(stk.logging.VERBOSE if enabled
+                              else stk.logging.INFO)
+        self.logger.info("Verbose logs: %s", bool(enabled))
+        return bool(enabled)
+
+    def start_rpc_profiling(self, log_period):
+        """Profiles the calls made to other services (see stk.services), and
+        logs a summary every log_period seconds (0 for never)."""
+        stk.services.enable_profiling(self.logger, log_period)
+        self.logger.info("Profiling service calls")
+        return True
+
+    def stop_rpc_profiling(self):
+        "Stops profiling the calls made to other services."
+        if stk.services.disable_profiling():
+            self.logger.info("Stopped profiling service calls")
+            return True
+        return False
+
+    def get_rpc_profile(self):
+        """Calls made to other services since profiling started, by
+        "Service.method": count, latencies, histogram and callers."""
+        profiler = stk.services.get_profiler()
+        return profiler.dump() if profiler else {}
+
+    @stk.coroutines.async_generator
+    def __return_home(self, name, research_360_activated):
+        "return_home of a finder, recorded in the statistics"
+        record = gohomestats.GoHomeRecord(name, research_360_activated)
+        value = yield self.finders[name].return_home(research_360_activated,
+                                                     record)
+        record.finish(value, self.reason_cant_go_home.value())
+        self.stats.add(record)
+        yield stk.coroutines.Return(value)
+
     ####################################################
     # Life cycle
 
@@ -173,8 +361,71 @@ class DXHomeFinder(object):
     @qi.nobind
     def on_stop(self):
         "Cleanup (add yours if needed)"
+        self.__save_checkpoint()
+        self.stop_rpc_profiling()
         self.logger.info("DXHomeFinder finished.")
 
+    ####################################################
+    # Checkpoint (warm restart)
+
+    @qi.nobind
+    def __save_checkpoint(self):
+        "Save mode, finders and odometry reference, to restore on restart"
+        try:
+            checkpoint = {
+                "version": CHECKPOINT_VERSION,
+                "mode": self.mode,
+                "finders": dict((name, finder.get_checkpoint())
+                                for name, finder in self.finders.items()),
+                "odometry": self.position_manager.get_odometry_reference(),
+                "stats": self.stats.to_list(),
+            }
+            folder = os.path.dirname(PATH_CHECKPOINT_FILE)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+            temp_path = PATH_CHECKPOINT_FILE + ".tmp"
+            with open(temp_path, 'w') as file:
+                file.write(json.dumps(checkpoint, separators=(",", ":")))
+                file.flush()
+                os.fsync(file.fileno())
+            os.rename(temp_path, PATH_CHECKPOINT_FILE)
+        except Exception as error_msg:
+            self.logger.warning("Cannot save checkpoint: %s", error_msg)
+
+    @qi.nobind
+    def __restore_checkpoint(self):
+        "Restore the last checkpoint, if odometry still agrees with it"
+        if not os.path.exists(PATH_CHECKPOINT_FILE):
+            return False
+        try:
+            with open(PATH_CHECKPOINT_FILE, 'r') as file:
+                checkpoint = json.loads(file.read())
+            if checkpoint.get("version") != CHECKPOINT_VERSION:
+                raise ValueError("unknown version %s" % checkpoint.get("version"))
+            # Statistics are about the venue: kept even if home is not
+            self.stats.load_list(checkpoint.get("stats", []))
+            mode = checkpoint["mode"]
+            if mode not in self.finders and mode != FUSION_MODE:
+                raise ValueError("unknown mode %s" % mode)
+            finder_checkpoints = checkpoint["finders"]
+            if not any(state.get("pos_in_world") is not None
+                       for state in finder_checkpoints.values()):
+                self.logger.info("Checkpoint without home, nothing to restore.")
+                return False
+            if not self.position_manager.restore_odometry_reference(
+                    checkpoint["odometry"], RESTORE_MAX_ERROR):
+                return False
+        except (IOError, ValueError, KeyError, TypeError,
+                AttributeError) as error_msg:
+            self.logger.warning("Invalid checkpoint: %s", error_msg)
+            return False
+        self.mode = mode
+        for name, finder in self.finders.items():
+            finder.restore_checkpoint(finder_checkpoints.get(name, {}))
+        self.logger.info("Restored checkpoint, mode %s, home known: %s",
+                         self.mode, self.is_init())
+        return True
+
 ####################
 # Setup and Run
 ####################
@@ -0,0 +1,167 @@
+"""
+Go home statistics: how long returning home takes with each technology,
+and how it fails.
+
+Every return_home call fills a GoHomeRecord (phase durations, outcome,
+residual error), and GoHomeStats keeps the last records of each technology
+to aggregate them, and to rank technologies by expected time to home.
+"""
+# pylint: disable=E1101
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2018, Softbank Robotics"
+
+# Basic libs
+import collections
+
+# stk libs
+import stk.clock
+
+PHASES = ["approach", "find", "move"]
+
+# Records kept per technology
+ROLLING_WINDOW = 50
+
+# Technologies with fewer records are ranked after the others
+MIN_RECORDS = 3
+
+class GoHomeRecord(object):
+    "What happened during one return_home call."
+    def __init__(self, mode=None, search=False):
+        self.mode = mode
+        self.search = search
+        self.approach = False
+        self.durations = dict((phase, 0.0) for phase in PHASES)
+        self.success = None
+        self.reason = None
+        self.residual_error = None # in meters
+        self.start_time = stk.clock.time()
+        self.end_time = None
+        self.phase = None
+        self.phase_start_time = None
+
+    def enter(self, phase):
+        "Ends the current phase (if any) and starts phase."
+        self.__end_phase()
+        if phase == "approach":
+            self.approach = True
+        self.phase = phase
+        self.phase_start_time = stk.clock.time()
+
+    def finish(self, success, reason=None):
+        "Ends the record, with the reason of a failure."
+        self.__end_phase()
+        self.success = bool(success)
+        self.reason = None if success else reason
+        self.end_time = stk.clock.time()
+
+    def get_duration(self):
+        "Seconds from start to finish (or now)."
+        end_time = self.end_time if self.end_time is not None \
+                   else stk.clock.time()
+        return end_time - self.start_time
+
+    def to_dict(self):
+        "The record, as a dictionary."
+        return {
+            "mode": self.mode,
+            "search": self.search,
+            "approach": self.approach,
+            "durations": dict(self.durations),
+            "duration": self.get_duration(),
+            "success": self.success,
+            "reason": self.reason,
+            "residual_error": self.residual_error,
+        }
+
+    def __end_phase(self):
+        "Internal - adds the time of the current phase to its duration."
+        if self.phase is not None:
+            self.durations[self.phase] += (stk.clock.time() -
+                                           self.phase_start_time)
+            self.phase = None
+
+def _mean(values):
+    "Mean of values, or None if there are none."
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return sum(values) / float(len(values))
+
+class GoHomeStats(object):
+    "Last records of each technology, and their aggregates."
+    def __init__(self, window=ROLLING_WINDOW):
+        self.window = window
+        self.records = {}
+
+    def add(self, record):
+        "Adds a finished record (as a GoHomeRecord or its dictionary)."
+        if isinstance(record, GoHomeRecord):
+            record = record.to_dict()
+        if record["mode"] not in self.records:
+            self.records[record["mode"]] = collections.deque(
+                                                    maxlen=self.window)
+        self.records[record["mode"]].append(record)
+
+    def get_stats(self, mode):
+        "Aggregates of the last records of mode."
+        records = list(self.records.get(mode, []))
+        count = len(records)
+        successes = [record for record in records if record["success"]]
+        reasons = collections.Counter(record["reason"] for record in records
+                                      if not record["success"])
+        stats = {
+            "count": count,
+            "success_rate": len(successes) / float(count) if count else None,
+            "reasons": dict(reasons),
+            "approach_rate": _mean([float(record["approach"])
+                                    for record in records]),
+            "search_rate": _mean([float(record["search"])
+                                  for record in records]),
+            "mean_duration": _mean([record["duration"]
+                                    for record in records]),
+            "mean_success_duration": _mean([record["duration"]
+                                            for record in successes]),
+            "mean_durations": dict((phase, _mean(
+                [record["durations"][phase] for record in records]))
+                                   for phase in PHASES),
+            "mean_residual_error": _mean([record["residual_error"]
+                                          for record in successes]),
+            "expected_time_to_home": None,
+        }
+        if count:
+            # Attempts until success (smoothed, so that it is never 0) times
+            # the time of an attempt
+            success_probability = (len(successes) + 1.0) / (count + 2.0)
+            stats["expected_time_to_home"] = (stats["mean_duration"] /
+                                              success_probability)
+        return stats
+
+    def get_all_stats(self):
+        "Aggregates of every technology, by technology."
+        return dict((mode, self.get_stats(mode)) for mode in self.records)
+
+    def rank_modes(self, modes):
+        """modes sorted by expected time to home, fastest first.
+
+        Modes with less than MIN_RECORDS records keep their order, last."""
+        known = []
+        unknown = []
+        for mode in modes:
+            stats = self.get_stats(mode)
+            if stats["count"] >= MIN_RECORDS:
+                known.append((stats["expected_time_to_home"], mode))
+            else:
+                unknown.append(mode)
+        return [mode for _, mode in sorted(known)] + unknown
+
+    def to_list(self):
+        "All records, to save them."
+        return [record for records in self.records.values()
+                for record in records]
+
+    def load_list(self, records):
+        "Adds saved records (see to_list)."
+        for record in records:
+            self.add(record)
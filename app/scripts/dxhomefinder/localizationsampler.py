@@ -0,0 +1,198 @@
+"""
+Localization sampler: the pose of the robot in the map of ALNavigation.
+
+ALNavigation has no event for its localization, so getRobotPositionInMap is
+read on demand and the last sample (pose, uncertainty and timestamp) is
+cached. Readers get the cached sample when it is fresh. A periodic task
+reads it only while someone waits for a condition on the next samples, or
+holds the sampling (see start_sampling):
+
+    sampler.wait_for(sampler.pose_changed(0.5), timeout=10.0)
+    sampler.wait_for(sampler.uncertainty_below(0.3), timeout=5.0)
+"""
+# pylint: disable=E1101
+
+__version__ = "0.1.1"
+
+__copyright__ = "Copyright 2018, Softbank Robotics"
+
+# Basic libs
+import math
+import threading
+
+import qi
+import almath
+
+# stk libs
+import stk.clock
+
+SAMPLE_PERIOD = 0.2 # in seconds
+
+# A cached sample older than that is read again from ALNavigation
+SAMPLE_MAX_AGE = 0.5 # in seconds
+
+ONE_SECOND_IN_US = 1000000
+
+class LocalizationSample(object):
+    "Pose [x, y, theta] in the map, its uncertainty (m) and timestamp (s)."
+    def __init__(self, timestamp, pose, uncertainty):
+        self.timestamp = timestamp
+        self.pose = pose
+        self.uncertainty = uncertainty
+
+    def get_age(self):
+        "Seconds since the sample was taken."
+        return stk.clock.time() - self.timestamp
+
+class LocalizationSampler(object):
+    "Caches getRobotPositionInMap, and resolves waiters on each sample."
+    def __init__(self, services, sample_period=SAMPLE_PERIOD):
+        self.services = services
+        self.lock = threading.Lock()
+        self.sample = None
+        self.waiters = []
+        self.holders = set()
+        self.task = stk.clock.periodic_task(self.update,
+                                            sample_period * ONE_SECOND_IN_US)
+        self.task_lock = threading.Lock()
+        self.task_running = False
+
+    def start_sampling(self, holder):
+        """Samples periodically, until every holder called stop_sampling;
+        only needed while the robot moves with the localization (going
+        home)."""
+        with self.lock:
+            self.holders.add(holder)
+        self.__update_task()
+
+    def stop_sampling(self, holder):
+        "Stops sampling, if no other holder needs it (see start_sampling)"
+        with self.lock:
+            self.holders.discard(holder)
+        self.__update_task()
+
+    def stop(self):
+        "Stops sampling for every holder and forgets the cached sample."
+        with self.lock:
+            self.holders.clear()
+            self.sample = None
+        self.__update_task()
+
+    def update(self):
+        "Reads the pose from ALNavigation; returns the new sample or None."
+        get_position = self.services.method("ALNavigation",
+                                            "getRobotPositionInMap")
+        if get_position is None:
+            return None
+        try:
+            position = get_position()
+        except RuntimeError:
+            # Not localized (yet)
+            return None
+        pose = [float(value) for value in position[0]]
+        uncertainty = position[1][:2] if len(position) > 1 else []
+        sample = LocalizationSample(
+                stk.clock.time(), pose,
+                max(uncertainty) if uncertainty else float("inf"))
+        satisfied = []
+        with self.lock:
+            self.sample = sample
+            waiting = []
+            for waiter in self.waiters:
+                if waiter[0](sample):
+                    satisfied.append(waiter)
+                else:
+                    waiting.append(waiter)
+            self.waiters = waiting
+        for _, promise, timer in satisfied:
+            if timer:
+                timer.cancel()
+            promise.setValue(sample)
+        if satisfied:
+            # Not from the task itself: stopping it waits for this call
+            stk.clock.call_later(0, self.__update_task)
+        return sample
+
+    def get_sample(self, max_age=SAMPLE_MAX_AGE):
+        "Cached sample if fresh enough, otherwise a new one (or None)."
+        with self.lock:
+            sample = self.sample
+        if sample is not None and sample.get_age() <= max_age:
+            return sample
+        return self.update()
+
+    def get_pose(self, max_age=SAMPLE_MAX_AGE):
+        "Pose [x, y, theta] in the map, or None if not localized."
+        sample = self.get_sample(max_age)
+        return sample.pose if sample else None
+
+    def wait_for(self, condition, timeout=None):
+        """Future of the first next sample for which condition(sample) is true
+
+        Its value is None if there is no such sample before timeout."""
+        waiter = [condition, None, None]
+        def cancel_waiter(promise):
+            "Cancelling the future removes the waiter"
+            if self.__remove_waiter(waiter):
+                if waiter[2]:
+                    waiter[2].cancel()
+                promise.setCanceled()
+        promise = qi.Promise(cancel_waiter)
+        waiter[1] = promise
+        with self.lock:
+            self.waiters.append(waiter)
+        self.__update_task()
+        if timeout is not None:
+            waiter[2] = stk.clock.call_later(timeout, self.__expire, waiter)
+        return promise.future()
+
+    def wait_for_update(self, timeout=None):
+        "Future of the next sample."
+        return self.wait_for(lambda sample: True, timeout)
+
+    def pose_changed(self, distance, angle=None):
+        "Condition: moved by more than distance (m) or angle (rad) from now."
+        reference = self.get_pose()
+        def condition(sample):
+            "True once away from the reference pose"
+            if reference is None:
+                return True
+            if math.hypot(sample.pose[0] - reference[0],
+                          sample.pose[1] - reference[1]) > distance:
+                return True
+            return angle is not None and abs(almath.modulo2PI(
+                sample.pose[2] - reference[2])) > angle
+        return condition
+
+    @staticmethod
+    def uncertainty_below(max_uncertainty):
+        "Condition: localized with an uncertainty under max_uncertainty (m)."
+        return lambda sample: sample.uncertainty < max_uncertainty
+
+    def __update_task(self):
+        "Internal - runs the task only while there are waiters or holders."
+        with self.task_lock:
+            with self.lock:
+                needed = bool(self.waiters or self.holders)
+            if needed and not self.task_running:
+                self.task.start(True)
+            elif not needed and self.task_running:
+                self.task.stop()
+            self.task_running = needed
+
+    def __remove_waiter(self, waiter):
+        "Internal - removes a waiter; returns False if already resolved."
+        with self.lock:
+            for index, other in enumerate(self.waiters):
+                if other is waiter:
+                    del self.waiters[index]
+                    break
+            else:
+                return False
+        self.__update_task()
+        return True
+
+    def __expire(self, waiter):
+        "Internal - resolves a waiter with None at its timeout."
+        if self.__remove_waiter(waiter):
+            waiter[1].setValue(None)
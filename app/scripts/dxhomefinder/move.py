@@ -7,9 +7,16 @@ __copyright__ = "Copyright 2017, Softbank Robotics"
 __author__ = 'mcaniot'
 __email__ = 'mcaniot@softbankrobotics.com'
 
+import collections
+import math
+import random
+import threading
+
 import almath
 import qi
 
+import stk.clock
+
 CONFIGURATIONS = {
     "full_speed" : {
         "acc": 0.30,
@@ -22,9 +29,58 @@ CONFIGURATIONS = {
 }
 
 ONE_SEC_TIME = 1000000
+
+# The move fails if the robot did not move at all for that long
+STALL_TIMEOUT = 1.0 # in seconds
+
+# Move checks the distance that often, extrapolating from the commanded
+# velocity between odometry samples
+TICK_PERIOD = 0.01 # in seconds
+
+# Move samples odometry that often (0 for every tick)
+ODOMETRY_PERIOD = 0.1 # in seconds
+
+# Move is stalled when it goes slower than that ratio of the commanded
+# velocity (checked only when commanding at least STALL_MIN_VELOCITY)
+STALL_VELOCITY_RATIO = 0.25
+STALL_MIN_VELOCITY = 0.05 # in m/s
+
+# Limits of TrajectoryMove (same as the managers' MOVE_CONFIG_LOW_SPEED)
+TRAJECTORY_CONFIG = {
+    "MaxVelXY": 0.15, # in m/s
+    "MaxAccXY": 0.15, # in m/s^2
+    "MaxVelTheta": 0.5, # in rad/s
+    "MaxAccTheta": 0.325, # in rad/s^2
+}
+
+# TrajectoryMove sends a new velocity that often
+CONTROL_PERIOD = 0.05 # in seconds
+
+# TrajectoryMove is done when that close to the target
+TRAJECTORY_TOLERANCE_XY = 0.03 # in meters
+TRAJECTORY_TOLERANCE_THETA = 0.03 # in radians
+
+# Under that distance to the target, the heading turns from the direction
+# of the target to the final heading
+BLEND_DISTANCE = 0.5 # in meters
+
+# Slowest velocities, so that the end of the profile is not endless
+MIN_VEL_XY = 0.02 # in m/s
+MIN_VEL_THETA = 0.05 # in rad/s
+
+# For stall detection, a rotation counts as the move of a point at that
+# distance from the center of the robot, and less than that is no move
+STALL_RADIUS = 0.3 # in meters
+STALL_DISTANCE = 0.005 # in meters
+
+# ALMotion/MoveFailed is raised again and again while blocked; it is logged
+# at most once per period
+MOVE_FAILED_LOG_PERIOD = 2.0 # in seconds
+
 @qi.singleThreaded()
 class Move(object):
-    def __init__(self, session, logger, distance_to_do, slow_down_distance):
+    def __init__(self, session, logger, distance_to_do, slow_down_distance,
+                 odometry_period=ODOMETRY_PERIOD):
         # services declaration
         self.services = ["ALMotion", "ALMemory"]
         self.session = session
@@ -40,13 +96,22 @@ class Move(object):
         self.promise = None
         self.robot_position_begin = None
         self.error_odom = 0.3
-        self.last_distance = 0
-        self.cpt = 0
         self.slow_down_distance = slow_down_distance
+        self.odometry_period = odometry_period
         self.mode = "full_speed"
-        self.task = qi.PeriodicTask()
+        # Velocity profile, see __predict_distance
+        self.commanded_velocity = 0.0
+        self.acceleration = 0.0
+        self.predicted_velocity = 0.0
+        self.predicted_distance = 0.0
+        self.last_tick_time = None
+        # Last odometry sample, see __sample_odometry
+        self.measured_distance = 0.0
+        self.measured_time = None
+        self.stall_start_time = None
+        self.task = stk.clock.periodic_task()
         self.task.setCallback(self.move_routine)
-        self.task.setUsPeriod(int(0.01*ONE_SEC_TIME))  # check every 0.1s
+        self.task.setUsPeriod(int(TICK_PERIOD * ONE_SEC_TIME))
         self.check_variables()
 
     def check_variables(self):
@@ -61,9 +126,15 @@ class Move(object):
         self.future = None
         self.promise = None
         self.robot_position_begin = None
-        self.last_distance = 0
-        self.cpt = 0
         self.mode = "full_speed"
+        self.commanded_velocity = 0.0
+        self.acceleration = 0.0
+        self.predicted_velocity = 0.0
+        self.predicted_distance = 0.0
+        self.last_tick_time = stk.clock.time()
+        self.measured_distance = 0.0
+        self.measured_time = self.last_tick_time
+        self.stall_start_time = None
 
     def run(self):
         self.logger.info("run")
@@ -77,66 +148,107 @@ class Move(object):
         return self.promise.future()
 
     def move_routine(self):
-        robot_position = almath.Pose2D(self.ALMotion.getRobotPosition(True))
-        if self.robot_position_begin:
-            distance_moved = self.robot_position_begin.distance(robot_position)
-            self.cpt = 0
+        if self.robot_position_begin and self.promise:
+            now = stk.clock.time()
+            self.__predict_distance(now)
+            if now - self.measured_time >= self.odometry_period:
+                self.__sample_odometry(now)
+                if not self.promise:
+                    return
+            distance_moved = self.predicted_distance
             if distance_moved >= self.distance_to_do:
                 self.mode = "end_move"
                 self._stop()
             elif (distance_moved <= (self.distance_to_do - self.slow_down_distance)) and self.mode != "low_speed":
                 if self.mode == "full_speed":
-                    self.future = self.ALMotion.move(CONFIGURATIONS[self.mode]["vcc"],0,0, _async=True)
+                    self.__command_velocity(self.mode)
                     self.mode = "full_speed_started"
             else :
                 if self.mode  == "full_speed_started":
                     self.mode = "low_speed"
                 if self.mode == "low_speed":
-                    self.future = self.ALMotion.move(CONFIGURATIONS[self.mode]["vcc"],0,0, _async=True)
+                    self.__command_velocity(self.mode)
                     self.mode = "low_speed_started"
 
-            if self.last_distance == distance_moved:
-                self.cpt += 1
-                if self.cpt >= 100:
-                    self.reason = "can't move during 1 seconds"
-                    self._stop()
+    def __command_velocity(self, configuration):
+        "Sends the velocity of a configuration, and follows its profile"
+        self.commanded_velocity = CONFIGURATIONS[configuration]["vcc"]
+        self.acceleration = CONFIGURATIONS[configuration]["acc"]
+        self.future = self.ALMotion.move(self.commanded_velocity, 0, 0,
+                                         _async=True)
+
+    def __predict_distance(self, now):
+        "Distance moved, extrapolated from the commanded velocity profile"
+        duration = now - self.last_tick_time
+        self.last_tick_time = now
+        velocity = self.predicted_velocity
+        self.predicted_velocity = approach(velocity, self.commanded_velocity,
+                                           self.acceleration * duration)
+        self.predicted_distance += \
+            (velocity + self.predicted_velocity) / 2 * duration
+
+    def __sample_odometry(self, now):
+        "Corrects the predicted distance, and checks for stalls"
+        robot_position = almath.Pose2D(self.ALMotion.getRobotPosition(True))
+        distance_moved = self.robot_position_begin.distance(robot_position)
+        duration = now - self.measured_time
+        if duration > 0:
+            expected_velocity = \
+                (self.predicted_distance - self.measured_distance) / duration
+            measured_velocity = \
+                (distance_moved - self.measured_distance) / duration
+            if expected_velocity >= STALL_MIN_VELOCITY and \
+                    measured_velocity < STALL_VELOCITY_RATIO * expected_velocity:
+                if self.stall_start_time is None:
+                    self.stall_start_time = self.measured_time
             else:
-                self.last_distance = distance_moved
+                self.stall_start_time = None
+        self.measured_distance = distance_moved
+        self.measured_time = now
+        self.predicted_distance = distance_moved
+        if self.stall_start_time is not None and \
+                now - self.stall_start_time >= STALL_TIMEOUT:
+            self.reason = "can't move during %s seconds" % STALL_TIMEOUT
+            self._stop()
 
     def _is_target_reached(self):
-        self.logger.info("_is_target_reached")
+        self.logger.verbose("_is_target_reached")
         robot_position = almath.Pose2D(self.ALMotion.getRobotPosition(True))
         if self.robot_position_begin:
             distance_moved = self.robot_position_begin.distance(robot_position)
             if abs(distance_moved-self.distance_to_do) < self.error_odom:
-                self.logger.info("target reached")
+                self.logger.verbose("target reached")
                 return True
-        self.logger.info("target not reached")
+        self.logger.verbose("target not reached")
         return False
 
     def _is_reason_available(self):
-        self.logger.info("_is_reason_available")
+        self.logger.verbose("_is_reason_available")
         if self.reason:
             return self._raise_move_failed(self.reason)
         return self._raise_move_failed("Unknown reason, move failed")
 
     def _raise_move_failed(self, reason):
-        self.logger.warning("%s, move failed" % reason)
+        self.logger.warning("%s, move failed", reason)
 
     def _on_move_failed(self, reason):
-        self.logger.info("_on_move_failed %s" % reason)
+        self.logger.every(MOVE_FAILED_LOG_PERIOD).info("_on_move_failed %s",
+                                                       reason)
         if not self.reason:
-            self.logger.info("@@@ reason: %s" % reason)
+            self.logger.info("@@@ reason: %s", reason)
             self.reason = reason
         self._stop()
 
     def _cancel(self, _):
-        self.logger.info("_cancel")
+        self.logger.verbose("_cancel")
         self._stop()
-        self.logger.info("end _cancel")
+        self.logger.verbose("end _cancel")
 
 
     def _stop(self):
+        promise, self.promise = self.promise, None
+        if not promise:
+            return
         try:
             if self.future:
                 self.future.cancel()
@@ -144,10 +256,346 @@ class Move(object):
             self.logger.warning(error_msg)
         self.ALMotion.move(0, 0, 0)
         self.ALMotion.stopMove(_async = True)
+        self.commanded_velocity = 0.0
         self.task.stop()
         self.move_failed_subscriber.signal.disconnect(self.signal_id)
         if self._is_target_reached():
-            self.promise.setValue(True)
+            promise.setValue(True)
         else:
             self._is_reason_available()
-            self.promise.setValue(False)
\ No newline at end of file
+            promise.setValue(False)
+
+
+def normalize_angle(angle):
+    "Angle in ]-pi, pi]"
+    return math.atan2(math.sin(angle), math.cos(angle))
+
+def approach(value, target, max_step):
+    "value moved toward target by at most max_step"
+    return value + max(-max_step, min(max_step, target - value))
+
+@qi.singleThreaded()
+class TrajectoryMove(object):
+    """Goes to x, y, theta (in the robot frame) in one smooth motion.
+
+    Instead of turning, going straight and turning again (with a stop
+    between each), the robot is driven with ALMotion.move toward the
+    target, turning to face it while moving, then to the final heading
+    when getting close. Like Move, run() returns a future that is True if
+    the target was reached, False if the move failed (MoveFailed, stall),
+    and that stops the robot when cancelled.
+    """
+    def __init__(self, session, logger, x_coord, y_coord, theta, config=None):
+        self.session = session
+        self.logger = logger
+        for service_name in ["ALMotion", "ALMemory"]:
+            self.session.waitForService(service_name)
+            setattr(self, service_name, self.session.service(service_name))
+        self.target_in_robot = [float(x_coord), float(y_coord), float(theta)]
+        self.config = dict(TRAJECTORY_CONFIG)
+        self.config.update(config or {})
+        self.move_failed_subscriber = self.ALMemory.subscriber(
+                                                    "ALMotion/MoveFailed")
+        self.signal_id = None
+        self.promise = None
+        self.reason = None
+        self.target = None
+        self.velocity = [0.0, 0.0]
+        self.last_progress_position = None
+        self.last_progress_time = None
+        self.task = stk.clock.periodic_task(
+                self.move_routine, int(CONTROL_PERIOD * ONE_SEC_TIME))
+
+    def run(self):
+        "Starts moving; returns a future (see the class)."
+        self.logger.info("run trajectory to %s", self.target_in_robot)
+        self.promise = qi.Promise(self._cancel)
+        self.reason = None
+        self.velocity = [0.0, 0.0]
+        self.last_progress_time = stk.clock.time()
+        start = almath.Pose2D(self.ALMotion.getRobotPosition(True))
+        self.last_progress_position = start
+        self.target = start * almath.Pose2D(self.target_in_robot)
+        self.signal_id = self.move_failed_subscriber.signal.connect(
+                                                        self._on_move_failed)
+        self.task.start(True)
+        return self.promise.future()
+
+    def move_routine(self):
+        "Sends the velocity toward the target, or stops if done or stalled."
+        if not self.promise:
+            return
+        robot_position = almath.Pose2D(self.ALMotion.getRobotPosition(True))
+        error = robot_position.inverse() * self.target
+        dist = math.hypot(error.x, error.y)
+        angle_error = normalize_angle(error.theta)
+        if dist < TRAJECTORY_TOLERANCE_XY and \
+                abs(angle_error) < TRAJECTORY_TOLERANCE_THETA:
+            self._stop()
+            return
+        # Stall: did not move at all for STALL_TIMEOUT
+        moved = self.last_progress_position.distance(robot_position) + \
+            abs(normalize_angle(robot_position.theta -
+                                self.last_progress_position.theta)) * \
+            STALL_RADIUS
+        now = stk.clock.time()
+        if moved > STALL_DISTANCE:
+            self.last_progress_position = robot_position
+            self.last_progress_time = now
+        elif now - self.last_progress_time >= STALL_TIMEOUT:
+            self.reason = "can't move during %s seconds" % STALL_TIMEOUT
+            self._stop()
+            return
+        self.ALMotion.move(*self._get_velocity(error, dist, angle_error))
+
+    def _get_velocity(self, error, dist, angle_error):
+        "Velocity in the robot frame, from the error to the target."
+        bearing = math.atan2(error.y, error.x)
+        if dist < TRAJECTORY_TOLERANCE_XY:
+            speed_target = 0.0
+            heading_error = angle_error
+        else:
+            # Face where we go, then blend in the final heading
+            weight = min(dist / BLEND_DISTANCE, 1.0)
+            heading_error = normalize_angle(
+                    angle_error + weight * normalize_angle(
+                                                bearing - angle_error))
+            # Braking distance, and slower while not facing the target
+            speed_target = min(self.config["MaxVelXY"],
+                               math.sqrt(2 * self.config["MaxAccXY"] * dist))
+            speed_target = max(speed_target * (1 + math.cos(bearing)) / 2,
+                               MIN_VEL_XY)
+        omega_target = min(self.config["MaxVelTheta"],
+                           math.sqrt(2 * self.config["MaxAccTheta"] *
+                                     abs(heading_error)))
+        if abs(heading_error) > TRAJECTORY_TOLERANCE_THETA / 2:
+            omega_target = max(omega_target, MIN_VEL_THETA)
+        else:
+            omega_target = 0.0
+        omega_target = math.copysign(omega_target, heading_error)
+        speed, omega = self.velocity
+        speed = approach(speed, speed_target,
+                         self.config["MaxAccXY"] * CONTROL_PERIOD)
+        if speed_target == MIN_VEL_XY:
+            speed = max(speed, MIN_VEL_XY)
+        omega = approach(omega, omega_target,
+                         self.config["MaxAccTheta"] * CONTROL_PERIOD)
+        self.velocity = [speed, omega]
+        if dist > 0:
+            return [speed * error.x / dist, speed * error.y / dist, omega]
+        return [0.0, 0.0, omega]
+
+    def _is_target_reached(self):
+        robot_position = almath.Pose2D(self.ALMotion.getRobotPosition(True))
+        error = robot_position.inverse() * self.target
+        return math.hypot(error.x, error.y) < 2 * TRAJECTORY_TOLERANCE_XY and \
+            abs(normalize_angle(error.theta)) < 2 * TRAJECTORY_TOLERANCE_THETA
+
+    def _on_move_failed(self, reason):
+        self.logger.every(MOVE_FAILED_LOG_PERIOD).info("_on_move_failed %s",
+                                                       reason)
+        if not self.reason:
+            self.reason = reason
+        self._stop()
+
+    def _cancel(self, _):
+        self.logger.verbose("_cancel")
+        self.reason = self.reason or "cancelled"
+        self._stop()
+
+    def _stop(self):
+        promise, self.promise = self.promise, None
+        if not promise:
+            return
+        self.task.stop()
+        self.ALMotion.move(0, 0, 0)
+        self.ALMotion.stopMove(_async=True)
+        self.move_failed_subscriber.signal.disconnect(self.signal_id)
+        if self._is_target_reached():
+            promise.setValue(True)
+        else:
+            self.logger.warning("%s, move failed",
+                                self.reason or "Unknown reason")
+            promise.setValue(False)
+
+def stop_on_cancel(future, stop):
+    """Future of future (e.g. of ALMotion.moveTo), that calls stop when
+    cancelled.
+
+    Cancelling an ALMotion or ALNavigation future doesn't stop the robot:
+    stop is e.g. ALMotion.stopMove, or ALNavigation.stopNavigateTo."""
+    lock = threading.Lock()
+    done = []
+    def settle():
+        "True for the first one setting the promise"
+        with lock:
+            if done:
+                return False
+            done.append(True)
+            return True
+    def on_cancel(promise):
+        "Stop first, so that the robot is stationary once cancelled"
+        if settle():
+            stop()
+            try:
+                future.cancel()
+            except RuntimeError:
+                # Not cancelable
+                pass
+            promise.setCanceled()
+    def on_done(finished):
+        "Forward the result"
+        if not settle():
+            return
+        if finished.isCanceled():
+            promise.setCanceled()
+        elif finished.hasError():
+            promise.setError(finished.error())
+        else:
+            promise.setValue(finished.value())
+    promise = qi.Promise(on_cancel)
+    future.addCallback(on_done)
+    return promise.future()
+
+def move_to(session, logger, x_coord, y_coord, theta, config=None):
+    "Goes to x, y, theta with a TrajectoryMove; returns its future."
+    return TrajectoryMove(session, logger, x_coord, y_coord, theta,
+                          config).run()
+
+###########################################
+#            Benchmark                    #
+###########################################
+
+def benchmark_return_home(cycles=100, max_distance=3.0, seed=0):
+    """Returns home from random places, in simulation (see simmotion.py).
+
+    Compares the managers' turn, go straight, turn with moveTo, to one
+    TrajectoryMove. Returns the mean return times (simulated) and errors.
+    """
+    import simmotion
+    import stk.simulation
+    rand = random.Random(seed)
+    clock = stk.clock.VirtualClock()
+    old_clock = stk.clock.set_clock(clock)
+    motion = simmotion.SimMotion(clock=clock, rate=100.0, seed=seed)
+    session = stk.simulation.SimSession({
+        "ALMotion": motion,
+        "ALMemory": motion.memory,
+    })
+    config = [[key, value] for key, value in TRAJECTORY_CONFIG.items()]
+    logger = _QuietLogger()
+    results = {}
+    motion.start()
+    try:
+        for strategy in ["move_to", "trajectory"]:
+            times, errors_xy = [], []
+            for _ in range(cycles):
+                motion.reset([rand.uniform(-max_distance, max_distance),
+                              rand.uniform(-max_distance, max_distance),
+                              rand.uniform(-math.pi, math.pi)])
+                start = clock.time()
+                # Home is the true origin, seen in the odometry frame
+                home = simmotion.relative(motion.odometry_origin,
+                                          [0.0, 0.0, 0.0])
+                home_in_robot = simmotion.relative(
+                        motion.getRobotPosition(True), home)
+                if strategy == "move_to":
+                    r_theta = math.atan2(home_in_robot[1], home_in_robot[0])
+                    motion.moveTo(0, 0, r_theta, config)
+                    motion.moveTo(math.hypot(home_in_robot[0],
+                                             home_in_robot[1]), 0, 0, config)
+                    motion.moveTo(0, 0, normalize_angle(
+                                        home_in_robot[2] - r_theta), config)
+                else:
+                    future = move_to(session, logger, *home_in_robot)
+                    while not future.isFinished():
+                        clock.advance(CONTROL_PERIOD)
+                times.append(clock.time() - start)
+                x_coord, y_coord, _ = motion.get_true_pose()
+                errors_xy.append(math.hypot(x_coord, y_coord))
+            results[strategy] = {
+                "mean_return_time": sum(times) / cycles,
+                "mean_error_xy": sum(errors_xy) / cycles,
+            }
+    finally:
+        motion.stop()
+        stk.clock.set_clock(old_clock)
+    return results
+
+def benchmark_move(cycles=50, seed=0):
+    """Straight Moves in simulation, with odometry every tick or not.
+
+    Compares sampling odometry on every tick (100 Hz, like Move did), to
+    ODOMETRY_PERIOD with extrapolation. Returns, for each, the mean number
+    of getRobotPosition calls per second, and stop errors (in odometry).
+    """
+    import simmotion
+    import stk.simulation
+    clock = stk.clock.VirtualClock()
+    old_clock = stk.clock.set_clock(clock)
+    motion = simmotion.SimMotion(clock=clock, rate=100.0, seed=seed)
+    counting_motion = _CountingProxy(motion)
+    session = stk.simulation.SimSession({
+        "ALMotion": counting_motion,
+        "ALMemory": motion.memory,
+    })
+    results = {}
+    motion.start()
+    try:
+        for odometry_period in [0, ODOMETRY_PERIOD]:
+            rand = random.Random(seed)
+            counting_motion.counts.clear()
+            duration, errors = 0.0, []
+            for _ in range(cycles):
+                motion.reset()
+                distance = rand.uniform(0.5, 3.0)
+                start = clock.time()
+                future = Move(session, _QuietLogger(), distance, 1.5,
+                              odometry_period).run()
+                while not future.isFinished():
+                    clock.advance(TICK_PERIOD)
+                duration += clock.time() - start
+                x_coord, y_coord, _ = motion.getRobotPosition(True)
+                errors.append(abs(math.hypot(x_coord, y_coord) - distance))
+            results[odometry_period] = {
+                "position_calls_per_second":
+                    counting_motion.counts["getRobotPosition"] / duration,
+                "mean_stop_error": sum(errors) / cycles,
+                "max_stop_error": max(errors),
+            }
+    finally:
+        motion.stop()
+        stk.clock.set_clock(old_clock)
+    return results
+
+class _CountingProxy(object):
+    "Internal - counts the calls to a service, and makes them synchronous."
+    def __init__(self, service):
+        self.service = service
+        self.counts = collections.Counter()
+
+    def __getattr__(self, name):
+        method = getattr(self.service, name)
+        def call(*args, **kwargs):
+            self.counts[name] += 1
+            is_async = kwargs.pop("_async", False)
+            result = method(*args, **kwargs)
+            if is_async:
+                promise = qi.Promise()
+                promise.setValue(result)
+                return promise.future()
+            return result
+        return call
+
+class _QuietLogger(object):
+    "Internal - logger for the benchmarks."
+    def every(self, period):
+        "Same logger (see stk.logging.Logger.every)."
+        return self
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+if __name__ == "__main__":
+    print benchmark_return_home()
+    print benchmark_move()
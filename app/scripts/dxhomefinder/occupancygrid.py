@@ -0,0 +1,338 @@
+"""
+Local occupancy grid around home, and a grid planner for the way home.
+
+The grid is in the home frame (see PositionManager). Obstacles come from
+the platform lasers and sonars (robot frame points, see
+get_sensor_points) and from the ALMotion/MoveFailed safety stops.
+Evidence of obstacles fades with time (half life), so that people and
+chairs that moved are forgotten, and laser rays clear the cells they go
+through.
+
+plan_route finds a path with A* on the grid, with obstacles inflated by
+the radius of the robot, and returns it as a few straight waypoints.
+"""
+# pylint: disable=E1101
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2018, Softbank Robotics"
+
+# Basic libs
+import heapq
+import math
+import random
+import timeit
+import numpy as np
+
+# Platform sensors in ALMemory, read in one getListData
+LASER_KEY = ("Device/SubDeviceList/Platform/LaserSensor/%s/Horizontal/"
+             "Seg%02d/%s/Sensor/Value")
+LASER_SEGMENTS = 15
+LASER_KEYS = [LASER_KEY % (side, segment, axis)
+              for side in ["Front", "Left", "Right"]
+              for segment in range(1, LASER_SEGMENTS + 1)
+              for axis in ["X", "Y"]]
+SONAR_KEYS = ["Device/SubDeviceList/Platform/Front/Sonar/Sensor/Value",
+              "Device/SubDeviceList/Platform/Back/Sonar/Sensor/Value"]
+SENSOR_KEYS = LASER_KEYS + SONAR_KEYS
+
+# Sonars, in the robot frame: x position and direction (approximate)
+SONARS = [(0.07, 1.0), (-0.07, -1.0)]
+
+# Readings outside of that are "nothing seen"
+MIN_SENSOR_RANGE = 0.1 # in meters
+MAX_SENSOR_RANGE = 3.0 # in meters
+
+# Default grid: 8m x 8m around home
+GRID_SIZE = 8.0 # in meters
+GRID_RESOLUTION = 0.05 # in meters
+
+# Evidence halves every that long
+HALF_LIFE = 60.0 # in seconds
+
+# Evidence added by a sensor hit, removed by a ray going through the cell
+HIT_EVIDENCE = 0.4
+MISS_EVIDENCE = 0.2
+
+# Cells with more evidence than that are obstacles
+OCCUPIED_THRESHOLD = 0.5
+
+# Obstacles are grown by that much for planning (robot radius and margin)
+ROBOT_RADIUS = 0.35 # in meters
+
+# Moves between 8 neighbours (row, column), with their cost
+NEIGHBOURS = [(d_row, d_col, math.hypot(d_row, d_col))
+              for d_row in (-1, 0, 1) for d_col in (-1, 0, 1)
+              if d_row or d_col]
+
+def get_sensor_points(values):
+    """Obstacle points in the robot frame, from the values of SENSOR_KEYS.
+
+    Returns an (N, 2) array of x, y."""
+    values = np.array([np.inf if value is None else value
+                       for value in values], dtype=float)
+    laser = values[:len(LASER_KEYS)].reshape((-1, 2))
+    sonars = values[len(LASER_KEYS):]
+    points = [laser]
+    for (x_position, direction), distance in zip(SONARS, sonars):
+        points.append([[x_position + direction * distance, 0.0]])
+    points = np.concatenate(points)
+    ranges = np.hypot(points[:, 0], points[:, 1])
+    valid = (ranges > MIN_SENSOR_RANGE) & (ranges < MAX_SENSOR_RANGE)
+    return points[valid]
+
+class OccupancyGrid(object):
+    "Fading evidence of obstacles on a square grid centered on home."
+    def __init__(self, size=GRID_SIZE, resolution=GRID_RESOLUTION,
+                 half_life=HALF_LIFE):
+        self.resolution = float(resolution)
+        self.cells = int(round(size / self.resolution))
+        self.origin = -self.cells * self.resolution / 2.0
+        self.half_life = half_life
+        self.evidence = np.zeros((self.cells, self.cells), dtype=np.float32)
+        self.last_update = None
+
+    def clear(self):
+        "Forgets all obstacles."
+        self.evidence[:] = 0.0
+
+    def to_cells(self, points):
+        "Row, column of (N, 2) points, and whether they are in the grid."
+        points = np.asarray(points, dtype=float).reshape((-1, 2))
+        cols = np.floor((points[:, 0] - self.origin) /
+                        self.resolution).astype(int)
+        rows = np.floor((points[:, 1] - self.origin) /
+                        self.resolution).astype(int)
+        inside = (rows >= 0) & (rows < self.cells) & \
+                 (cols >= 0) & (cols < self.cells)
+        return rows, cols, inside
+
+    def to_points(self, rows, cols):
+        "Centers of cells, as an (N, 2) array."
+        return np.column_stack([
+            self.origin + (np.asarray(cols) + 0.5) * self.resolution,
+            self.origin + (np.asarray(rows) + 0.5) * self.resolution])
+
+    def decay(self, now):
+        "Fades the evidence up to now."
+        if self.last_update is not None and now > self.last_update:
+            self.evidence *= 0.5 ** ((now - self.last_update) / self.half_life)
+        if self.last_update is None or now > self.last_update:
+            self.last_update = now
+
+    def add_obstacles(self, points, now, evidence=HIT_EVIDENCE):
+        "Adds evidence at (N, 2) points (home frame)."
+        self.decay(now)
+        rows, cols, inside = self.to_cells(points)
+        np.add.at(self.evidence, (rows[inside], cols[inside]), evidence)
+        np.clip(self.evidence, 0.0, 1.0, out=self.evidence)
+
+    def add_scan(self, position, points, now):
+        """Adds sensor hits seen from position (home frame).
+
+        The cells between the robot and the hits are cleared a bit."""
+        points = np.asarray(points, dtype=float).reshape((-1, 2))
+        if not len(points):
+            self.decay(now)
+            return
+        position = np.asarray(position, dtype=float)
+        rays = points - position
+        lengths = np.hypot(rays[:, 0], rays[:, 1])
+        steps = int(math.ceil(lengths.max() / (self.resolution / 2)))
+        if steps > 1:
+            # Samples along the rays, stopping a cell before the hit
+            fractions = np.linspace(0.0, 1.0, steps, endpoint=False)
+            keep = fractions[None, :] * lengths[:, None] < \
+                lengths[:, None] - self.resolution
+            samples = position + fractions[None, :, None] * rays[:, None, :]
+            rows, cols, inside = self.to_cells(samples[keep])
+            cleared = np.zeros(self.evidence.shape, dtype=bool)
+            cleared[rows[inside], cols[inside]] = True
+            self.decay(now)
+            self.evidence[cleared] = np.maximum(
+                    self.evidence[cleared] - MISS_EVIDENCE, 0.0)
+        self.add_obstacles(points, now)
+
+    def get_occupied(self, threshold=OCCUPIED_THRESHOLD):
+        "Boolean array of the obstacle cells."
+        return self.evidence >= threshold
+
+    def get_obstacle_points(self, threshold=OCCUPIED_THRESHOLD):
+        "Centers of the obstacle cells, as an (N, 2) array."
+        rows, cols = np.nonzero(self.get_occupied(threshold))
+        return self.to_points(rows, cols)
+
+    def get_blocked(self, radius=ROBOT_RADIUS,
+                    threshold=OCCUPIED_THRESHOLD):
+        "Cells where the center of the robot can't be (inflated obstacles)."
+        return inflate(self.get_occupied(threshold),
+                       int(math.ceil(radius / self.resolution)))
+
+def inflate(occupied, radius):
+    "Grows the true cells of a boolean array by radius cells (a disc)."
+    if radius <= 0 or not occupied.any():
+        return occupied.copy()
+    height, width = occupied.shape
+    padded = np.zeros((height + 2 * radius, width + 2 * radius), dtype=bool)
+    padded[radius:radius + height, radius:radius + width] = occupied
+    blocked = np.zeros_like(occupied)
+    for d_row in range(-radius, radius + 1):
+        for d_col in range(-radius, radius + 1):
+            if d_row * d_row + d_col * d_col <= radius * radius:
+                blocked |= padded[radius + d_row:radius + d_row + height,
+                                  radius + d_col:radius + d_col + width]
+    return blocked
+
+def find_path(blocked, start, goal):
+    """A* on a grid, between (row, col) cells; returns the cells or None.
+
+    The start and goal cells are considered free."""
+    height, width = blocked.shape
+    # Flat cells, with a blocked border so that neighbours need no checks
+    padded_width = width + 2
+    padded = np.ones((height + 2, padded_width), dtype=bool)
+    padded[1:-1, 1:-1] = blocked
+    is_blocked = padded.ravel().tolist()
+    def to_index(cell):
+        "Flat index of a (row, col) cell."
+        return (cell[0] + 1) * padded_width + cell[1] + 1
+    start_index, goal_index = to_index(start), to_index(goal)
+    is_blocked[start_index] = is_blocked[goal_index] = False
+    goal_row, goal_col = divmod(goal_index, padded_width)
+    steps = [(d_row * padded_width + d_col, cost)
+             for d_row, d_col, cost in NEIGHBOURS]
+    diagonal_extra = math.sqrt(2) - 1
+    costs = {start_index: 0.0}
+    parents = {}
+    queue = [(0.0, 0.0, start_index)]
+    while queue:
+        _, cost, index = heapq.heappop(queue)
+        if index == goal_index:
+            path = [index]
+            while index in parents:
+                index = parents[index]
+                path.append(index)
+            path.reverse()
+            return [(cell // padded_width - 1, cell % padded_width - 1)
+                    for cell in path]
+        if cost > costs[index]:
+            continue
+        for offset, step in steps:
+            neighbour = index + offset
+            if is_blocked[neighbour]:
+                continue
+            new_cost = cost + step
+            if new_cost < costs.get(neighbour, float("inf")):
+                costs[neighbour] = new_cost
+                parents[neighbour] = index
+                # Octile distance to the goal
+                row, col = divmod(neighbour, padded_width)
+                d_row, d_col = abs(row - goal_row), abs(col - goal_col)
+                if d_row < d_col:
+                    d_row, d_col = d_col, d_row
+                heapq.heappush(queue, (new_cost + d_row +
+                                       diagonal_extra * d_col,
+                                       new_cost, neighbour))
+    return None
+
+def is_line_free(blocked, start, end):
+    "No blocked cell on the segment between two (row, col) cells."
+    steps = max(abs(end[0] - start[0]), abs(end[1] - start[1])) * 2 + 1
+    rows = np.rint(np.linspace(start[0], end[0], steps)).astype(int)
+    cols = np.rint(np.linspace(start[1], end[1], steps)).astype(int)
+    # The ends may be in obstacles (see find_path)
+    return not blocked[rows[1:-1], cols[1:-1]].any()
+
+def simplify_path(blocked, path):
+    "Keeps the cells of the path needed to go in straight lines."
+    waypoints = [path[0]]
+    index = 0
+    while index < len(path) - 1:
+        # Farthest cell in sight
+        next_index = len(path) - 1
+        while next_index > index + 1 and \
+                not is_line_free(blocked, path[index], path[next_index]):
+            next_index -= 1
+        waypoints.append(path[next_index])
+        index = next_index
+    return waypoints
+
+def plan_route(grid, start, goal, radius=ROBOT_RADIUS):
+    """Waypoints from start to goal (x, y in the grid frame).
+
+    Returns the list of [x, y] after start (ending with goal), only
+    [goal] if the straight line is free, or None if there is no route."""
+    blocked = grid.get_blocked(radius)
+    # Straight lines may graze the inflated obstacles by a cell
+    blocked_lines = grid.get_blocked(radius - grid.resolution)
+    rows, cols, inside = grid.to_cells([start, goal])
+    if not inside.all():
+        # Outside of the grid: nothing known, go straight
+        return [list(goal)]
+    start_cell, goal_cell = (rows[0], cols[0]), (rows[1], cols[1])
+    if is_line_free(blocked_lines, start_cell, goal_cell):
+        return [list(goal)]
+    path = find_path(blocked, start_cell, goal_cell)
+    if path is None:
+        return None
+    waypoints = simplify_path(blocked_lines, path)[1:-1]
+    route = [list(point) for point in grid.to_points(
+                                [cell[0] for cell in waypoints],
+                                [cell[1] for cell in waypoints])]
+    return route + [list(goal)]
+
+###########################################
+#            Benchmark                    #
+###########################################
+
+def make_synthetic_grid(obstacles=20, seed=0, size=GRID_SIZE,
+                        resolution=GRID_RESOLUTION):
+    "Grid with random walls and boxes, and a free circle around home."
+    rand = random.Random(seed)
+    grid = OccupancyGrid(size, resolution)
+    for _ in range(obstacles):
+        x_coord = rand.uniform(-size / 2, size / 2)
+        y_coord = rand.uniform(-size / 2, size / 2)
+        if math.hypot(x_coord, y_coord) < 1.0:
+            continue
+        length = rand.uniform(0.2, 1.5)
+        angle = rand.uniform(0, math.pi)
+        fractions = np.linspace(0, 1, int(length / resolution) + 1)
+        points = np.column_stack([x_coord + fractions * length * math.cos(angle),
+                                  y_coord + fractions * length * math.sin(angle)])
+        grid.add_obstacles(points, 0.0, 1.0)
+    return grid
+
+def benchmark_planner(count=20, obstacles=20, seed=0):
+    """Routes home from random free places on synthetic grids.
+
+    Returns the mean planning time (in ms), how many routes needed a
+    detour, and how many starts had no route."""
+    rand = random.Random(seed)
+    durations = []
+    detours = 0
+    no_route = 0
+    for index in range(count):
+        grid = make_synthetic_grid(obstacles, seed + index)
+        blocked = grid.get_blocked()
+        while True:
+            start = [rand.uniform(-3, 3), rand.uniform(-3, 3)]
+            rows, cols, _ = grid.to_cells([start])
+            if not blocked[rows[0], cols[0]]:
+                break
+        timer = timeit.default_timer()
+        route = plan_route(grid, start, [0.0, 0.0])
+        durations.append(timeit.default_timer() - timer)
+        if route is None:
+            no_route += 1
+        elif len(route) > 1:
+            detours += 1
+    return {
+        "mean_planning_ms": 1000 * sum(durations) / count,
+        "max_planning_ms": 1000 * max(durations),
+        "detours": detours,
+        "no_route": no_route,
+    }
+
+if __name__ == "__main__":
+    print benchmark_planner()
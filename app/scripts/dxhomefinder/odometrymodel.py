@@ -0,0 +1,191 @@
+"""
+Odometry error model: how uncertain the odometric pose of the robot is.
+
+The pose covariance (x, y, theta in the home frame) is propagated from the
+deltas of ALMotion._getCumulatedDisplacement: every metre translated and
+every radian rotated adds noise, and the heading uncertainty spreads into
+xy as the robot moves forward.
+
+The noise parameters can be fitted to the results of measure.py with:
+
+python odometrymodel.py ../../stats/data/ColinMaillardScenario_*.csv
+
+which writes them to data/odometry_model.json (read by PositionManager).
+"""
+# pylint: disable=E1101
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2018, Softbank Robotics"
+
+# Basic libs
+import csv
+import json
+import math
+import sys
+import numpy as np
+
+# Noise added per metre translated and per radian rotated (variances)
+DEFAULT_PARAMETERS = {
+    "translation_xy": 0.0004,    # in m^2 per m
+    "rotation_xy": 0.0001,       # in m^2 per rad
+    "rotation_theta": 0.0009,    # in rad^2 per rad
+    "translation_theta": 0.0001, # in rad^2 per m
+}
+
+# Errors are given at that many standard deviations (~95%)
+N_SIGMA = 2.0
+
+def load_parameters(path):
+    "Parameters saved by calibrate, or the defaults if there is no file."
+    parameters = dict(DEFAULT_PARAMETERS)
+    try:
+        with open(path, 'r') as parameters_file:
+            saved = json.load(parameters_file)
+        parameters.update((key, max(float(saved[key]), 0.0))
+                          for key in DEFAULT_PARAMETERS if key in saved)
+    except (IOError, ValueError, TypeError):
+        pass
+    return parameters
+
+class OdometryErrorModel(object):
+    "Covariance of the odometric pose, updated from cumulated displacements."
+    def __init__(self, parameters=None):
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        if parameters:
+            self.parameters.update(parameters)
+        self.covariance = np.zeros((3, 3))
+        self.reference = None
+        self.theta = 0.0
+
+    def reset(self, cumulated_displacement, theta=0.0, covariance=None):
+        "Starts again from a known pose (no uncertainty, by default)."
+        self.reference = [float(value) for value in cumulated_displacement]
+        self.theta = float(theta)
+        if covariance is None:
+            self.covariance = np.zeros((3, 3))
+        else:
+            self.covariance = np.array(covariance, dtype=float).reshape((3, 3))
+
+    def update(self, cumulated_displacement, theta):
+        """Adds the displacement since last update.
+
+        theta is the current heading of the robot in the home frame.
+        """
+        cumulated_displacement = [float(value)
+                                  for value in cumulated_displacement]
+        if self.reference is None:
+            self.reset(cumulated_displacement, theta)
+            return
+        delta = [abs(new - old) for new, old in
+                 zip(cumulated_displacement, self.reference)]
+        self.reference = cumulated_displacement
+        # Average heading over the step
+        heading = math.atan2(math.sin(self.theta) + math.sin(theta),
+                             math.cos(self.theta) + math.cos(theta))
+        self.theta = float(theta)
+        translation = math.hypot(delta[0], delta[1])
+        rotation = delta[2]
+        if not translation and not rotation:
+            return
+        # Moving forward with a wrong heading is an error in xy
+        jacobian = np.identity(3)
+        jacobian[0, 2] = -translation * math.sin(heading)
+        jacobian[1, 2] = translation * math.cos(heading)
+        params = self.parameters
+        noise_xy = (params["translation_xy"] * translation +
+                    params["rotation_xy"] * rotation)
+        noise_theta = (params["rotation_theta"] * rotation +
+                       params["translation_theta"] * translation)
+        self.covariance = (jacobian.dot(self.covariance).dot(jacobian.T) +
+                           np.diag([noise_xy, noise_xy, noise_theta]))
+
+    def get_error(self):
+        "Error in xy (m) and theta (rad), at N_SIGMA (never negative)."
+        variance_xy = max(np.linalg.eigvalsh(self.covariance[:2, :2]))
+        variance_theta = self.covariance[2, 2]
+        return [N_SIGMA * math.sqrt(max(float(variance_xy), 0.0)),
+                N_SIGMA * math.sqrt(max(float(variance_theta), 0.0))]
+
+    def get_covariance(self):
+        "Covariance of x, y, theta, as a list of lists."
+        return self.covariance.tolist()
+
+###########################################
+#            Calibration                  #
+###########################################
+
+def get_travel(row):
+    """Translation (m) and rotation (rad) of a measure.py attempt.
+
+    Returns None for attempts that did not come back by odometry."""
+    if "advance" in row:
+        # ColinMaillardScenario: turn, advance, turn, and back the same way
+        if row.get("strategy") != "odometry":
+            return None
+        translation = 2 * abs(float(row["advance"]))
+        rotation = 2 * (abs(float(row["direction"])) +
+                        abs(float(row["move_theta"])))
+    elif "move_x" in row:
+        # MoveScenario: move, turn, and back the same way
+        translation = 2 * math.hypot(float(row["move_x"]),
+                                     float(row["move_y"]))
+        rotation = 2 * abs(float(row["move_theta"]))
+    else:
+        # DummyScenario: measure noise only
+        translation, rotation = 0.0, 0.0
+    return translation, rotation
+
+def calibrate(rows):
+    """Fits the parameters to measure.py results (dicts of a csv file).
+
+    Squared errors are regressed on translation and rotation, with a
+    constant for the noise of the measure itself. Parameters that can't be
+    fitted keep their default value.
+    """
+    samples = []
+    for row in rows:
+        try:
+            travel = get_travel(row)
+            if travel is None:
+                continue
+            error_xy = (float(row["error_x"]) ** 2 +
+                        float(row["error_y"]) ** 2)
+            error_theta = float(row["error_theta"]) ** 2
+        except (KeyError, ValueError):
+            continue
+        samples.append(list(travel) + [error_xy, error_theta])
+    parameters = dict(DEFAULT_PARAMETERS)
+    if len(samples) < 3:
+        return parameters
+    samples = np.array(samples)
+    inputs = np.column_stack([np.ones(len(samples)), samples[:, 0],
+                              samples[:, 1]])
+    if np.linalg.matrix_rank(inputs) < 3:
+        return parameters
+    fit_xy = np.linalg.lstsq(inputs, samples[:, 2], rcond=None)[0]
+    fit_theta = np.linalg.lstsq(inputs, samples[:, 3], rcond=None)[0]
+    # The xy error is on two axes
+    parameters["translation_xy"] = max(float(fit_xy[1]) / 2, 0.0)
+    parameters["rotation_xy"] = max(float(fit_xy[2]) / 2, 0.0)
+    parameters["translation_theta"] = max(float(fit_theta[1]), 0.0)
+    parameters["rotation_theta"] = max(float(fit_theta[2]), 0.0)
+    return parameters
+
+def calibrate_from_csv(paths):
+    "Fits the parameters to csv files written by measure.py."
+    rows = []
+    for path in paths:
+        with open(path, 'rb') as csvfile:
+            rows.extend(csv.DictReader(csvfile))
+    return calibrate(rows)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "usage: python odometrymodel.py measures.csv [...]"
+        sys.exit(1)
+    PARAMETERS = calibrate_from_csv(sys.argv[1:])
+    print json.dumps(PARAMETERS, indent=4, sort_keys=True)
+    with open("data/odometry_model.json", 'w') as model_file:
+        json.dump(PARAMETERS, model_file, indent=4, sort_keys=True)
+    print "Saved to data/odometry_model.json"
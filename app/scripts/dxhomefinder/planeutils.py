@@ -1,5 +1,9 @@
 """
 Library for 2D manipulation
+
+Positions are complex numbers, and orientations unit complex numbers.
+Pose is one pose, PoseArray is N poses as numpy arrays (for working on
+whole trajectories or candidate points at once).
 """
 # pylint: disable=E1101
 
@@ -12,6 +16,7 @@ __email__ = 'mcaniot@softbankrobotics.com'
 # Basic libs
 import cmath
 import math
+import timeit
 import numpy as np
 
 ###########################################
@@ -24,10 +29,7 @@ def coords_to_pos(x_coord, y_coord):
 
 def pos_to_coords(pos):
     "Transform pose to x, y coordinate"
-    r_value, p_value = cmath.polar(pos)
-    x_coord = r_value*np.cos(p_value)
-    y_coord = r_value*np.sin(p_value)
-    return x_coord, y_coord
+    return pos.real, pos.imag
 
 def unit_vector(angle_in_rad):
     "Return unit vertor of angle"
@@ -50,40 +52,22 @@ class Pose(object):
     """
     Object Pose for 2D manipulation
     """
-    def __init__(self, **kwargs):
+    __slots__ = ("x_coord", "y_coord", "theta", "pos", "orientation")
+
+    def __init__(self, x_coord=None, y_coord=None, theta=None, pos=None,
+                 orientation=None):
         # Arguments are x, y, theta, pos and orientation.
         # But you can construct this class with only x,y and theta or
         # pos and orientation.
-
-        # internal variables
-        if "x_coord" in kwargs:
-            self.x_coord = kwargs["x_coord"]
-        else:
-            self.x_coord = None
-
-        if "y_coord" in kwargs:
-            self.y_coord = kwargs["y_coord"]
-        else:
-            self.y_coord = None
-
-        if "theta" in kwargs:
-            self.theta = kwargs["theta"]
-        else:
-            self.theta = None
-
-        if "pos" in kwargs:
-            self.pos = kwargs["pos"]
-        elif self.x_coord != None and self.y_coord != None:
-            self.pos = coords_to_pos(self.x_coord, self.y_coord)
-        else:
-            self.pos = None
-
-        if "orientation" in kwargs:
-            self.orientation = kwargs["orientation"]
-        elif self.theta != None:
-            self.orientation = unit_vector(self.theta)
-        else:
-            self.orientation = None
+        self.x_coord = x_coord
+        self.y_coord = y_coord
+        self.theta = theta
+        if pos is None and x_coord is not None and y_coord is not None:
+            pos = x_coord + y_coord * 1j
+        self.pos = pos
+        if orientation is None and theta is not None:
+            orientation = cmath.exp(1j * theta)
+        self.orientation = orientation
 
     ###########################################
     #            Public Method                #
@@ -119,3 +103,124 @@ class Pose(object):
 
     def __str__(self):
         return "pos = %s, orient = %s" % (self.pos, self.orientation)
+
+class PoseArray(object):
+    """
+    N poses for 2D manipulation, as numpy arrays.
+
+    Same operations as Pose, on all poses at once; arguments can be a
+    single pose / position, or as many as there are poses.
+    """
+    __slots__ = ("pos", "orientation")
+
+    def __init__(self, pos, orientation):
+        self.pos = np.asarray(pos, dtype=complex)
+        self.orientation = np.asarray(orientation, dtype=complex)
+
+    @classmethod
+    def from_coords(cls, x_coords, y_coords, thetas=0.0):
+        "Poses from arrays of x, y and theta (theta 0 for points)"
+        x_coords = np.asarray(x_coords, dtype=float)
+        y_coords = np.asarray(y_coords, dtype=float)
+        thetas = np.broadcast_to(np.asarray(thetas, dtype=float),
+                                 x_coords.shape)
+        return cls(x_coords + 1j * y_coords, np.exp(1j * thetas))
+
+    @classmethod
+    def from_poses(cls, poses):
+        "Poses from a list of Pose"
+        return cls([pose.pos for pose in poses],
+                   [pose.orientation for pose in poses])
+
+    ###########################################
+    #            Public Method                #
+    ###########################################
+
+    def get_relative(self, poses):
+        "Expects poses (Pose or PoseArray) in same referential as myself"
+        return PoseArray((poses.pos - self.pos) / self.orientation,
+                         poses.orientation / self.orientation)
+
+    def get_relative_pos(self, pos):
+        "Get relative pos (one or an array)"
+        return (pos - self.pos) / self.orientation
+
+    def get_absolute_pos(self, pos):
+        "Pos (one or an array) relative to the poses, in their referential"
+        return self.pos + self.orientation * pos
+
+    def get_dists(self, pos):
+        "Distances between the poses and a position (one or an array)"
+        return np.abs(pos - self.pos)
+
+    def get_bearings(self, pos):
+        "Angles of a position (one or an array), seen from the poses"
+        return np.angle(self.get_relative_pos(pos))
+
+    def get_coords(self):
+        "x, y and theta arrays"
+        return self.pos.real, self.pos.imag, np.angle(self.orientation)
+
+    ###########################################
+    #            Private Method               #
+    ###########################################
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return PoseArray(self.pos[index], self.orientation[index])
+        return Pose(pos=complex(self.pos[index]),
+                    orientation=complex(self.orientation[index]))
+
+###########################################
+#            Benchmark                    #
+###########################################
+
+def benchmark_pose_array(count=1000, repeat=5):
+    """Time per pose of relative transforms, distances and bearings, with
+    Pose one at a time vs PoseArray. Returns seconds per pose for both."""
+    rand = np.random.RandomState(0)
+    coords = rand.uniform(-3, 3, size=(count, 3))
+    frame = Pose(x_coord=0.5, y_coord=-0.2, theta=0.3)
+    target = coords_to_pos(1.0, 1.0)
+    poses = [Pose(x_coord=x, y_coord=y, theta=theta)
+             for x, y, theta in coords]
+    pose_array = PoseArray.from_coords(coords[:, 0], coords[:, 1],
+                                       coords[:, 2])
+    frame_array = PoseArray.from_poses([frame])
+
+    def with_pose():
+        result = []
+        for pose in poses:
+            relative = frame.get_relative(pose)
+            result.append((relative.pos, relative.orientation,
+                           get_pos_to_pos_dist(pose.pos, target),
+                           get_pos_theta(pose.get_relative_pos(target))))
+        return result
+
+    def with_pose_array():
+        relative = frame_array.get_relative(pose_array)
+        return (relative.pos, relative.orientation,
+                pose_array.get_dists(target), pose_array.get_bearings(target))
+
+    # Both must give the same results
+    expected = np.array(with_pose())
+    got = with_pose_array()
+    for column in range(4):
+        assert np.allclose(expected[:, column], got[column])
+
+    time_pose = min(timeit.repeat(with_pose, number=1, repeat=repeat))
+    time_pose_array = min(timeit.repeat(with_pose_array, number=1,
+                                        repeat=repeat))
+    return {
+        "count": count,
+        "pose_per_item": time_pose / count,
+        "pose_array_per_item": time_pose_array / count,
+        "speedup": time_pose / time_pose_array,
+    }
+
+if __name__ == "__main__":
+    for COUNT in (10, 100, 1000, 10000):
+        print benchmark_pose_array(COUNT)
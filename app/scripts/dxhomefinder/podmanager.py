@@ -25,6 +25,10 @@ import stk.services
 import stk.logging
 import stk.coroutines
 
+# Internal libs
+import gohomestats
+import move
+
 MOVE_CONFIG_LOW_SPEED = [["MaxVelXY", 0.15],["MaxAccXY", 0.15],["MaxVelTheta",0.5],["MaxAccTheta",0.325],["MaxJerkXY",0.5],["MaxJerkTheta",1.0]]
 
 MOVE_CONFIG_HIGH_SPEED = [["MaxVelXY", 0.25],["MaxAccXY", 0.3]]
@@ -33,6 +37,19 @@ DISTANCE_FIRST_APPROACH = 1.0
 
 DISTANCE_FROM_POD = 0.7
 
+# Time given to lookForStation when facing the pod: at least the fixed wait
+# it replaces, more when far or when the pod may not be where odometry says
+LOOK_FOR_STATION_MIN_TIMEOUT = 5.0 # in seconds
+LOOK_FOR_STATION_TIME_PER_METER = 1.0 # in seconds per meter
+LOOK_FOR_STATION_TIME_PER_ERROR = 4.0 # in seconds per meter of error
+LOOK_FOR_STATION_MAX_TIMEOUT = 10.0 # in seconds
+
+# The search looks around by itself; this is only a safety
+SEARCH_TIMEOUT = 120.0 # in seconds
+
+# Error of a station detection, for estimate_home
+DETECTION_ERROR = 0.05 # in meters
+
 class PodManager(object):
     """
     Class for saving position
@@ -47,12 +64,12 @@ class PodManager(object):
         self.look_for_station_future = None
         self.pod_future = None
         self.search_future = None
-        self.future_sleep = None
         self.search_future_track = None
-        self.task = qi.PeriodicTask()
-        self.task.setCallback(self.pod_detected)
-        self.task.setUsPeriod(100000) # 100ms
+        self.station_future = None
         self.pod_position_from_robot = None
+        # Pose of the station in the frame of home, when home was defined
+        # away from it (fusion mode); None when home is the station itself
+        self.target_in_home = None
 
     ###########################################
     #            Public Method                #
@@ -83,12 +100,12 @@ class PodManager(object):
         except Exception as error_msg:
             self.logger.warning(error_msg)
         try:
-            if self.future_sleep:
-                self.future_sleep.cancel()
+            if self.station_future:
+                self.station_future.cancel()
         except Exception as error_msg:
             self.logger.warning(error_msg)
         self.pod_future = None
-        self.future_sleep = None
+        self.station_future = None
         self.services.ALRecharge.stopAll()
         self.services.ALMotion.killMove()
         self.cancel_search_home()
@@ -104,14 +121,65 @@ class PodManager(object):
             self.services.PositionManager.init_position()
             self.pod_pos_in_world = [0.0, 0.0]
             self.pod_position_from_robot = None
+            self.target_in_home = None
         yield stk.coroutines.Return(value)
 
+    @stk.coroutines.async_generator
+    def init_home_here(self):
+        """Home is the current position (see PositionManager.init_position):
+        records where the station in view is from it, without moving.
+        Returns False if the station is not in view."""
+        self.target_in_home = None
+        yield self.services.ALRecharge.setUseTrackerSearcher(False, _async=True)
+        self.station_future = self.look_for_station(
+                                self.get_look_for_station_timeout(0.0))
+        coord_pod = yield self.station_future
+        if not (coord_pod and coord_pod[1] and len(coord_pod[1]) == 3):
+            yield stk.coroutines.Return(False)
+            return
+        home_in_world = almath.Pose2D(
+                self.services.ALMotion.getRobotPosition(True))
+        target_in_home = home_in_world.inverse() * almath.Pose2D(coord_pod[1])
+        self.target_in_home = list(target_in_home.toVector())
+        self.pod_pos_in_world = [0.0, 0.0]
+        self.pod_position_from_robot = None
+        yield stk.coroutines.Return(True)
+
     def is_init(self):
         return self.pod_pos_in_world != None
 
     def uninit(self):
         self.pod_pos_in_world = None
         self.pod_position_from_robot = None
+        self.target_in_home = None
+
+    def get_checkpoint(self):
+        "State to keep across restarts (see restore_checkpoint)"
+        return {"pos_in_world": self.pod_pos_in_world,
+                "target_in_home": self.target_in_home}
+
+    def restore_checkpoint(self, checkpoint):
+        "Restores the state of get_checkpoint; returns whether home is known"
+        self.pod_pos_in_world = checkpoint.get("pos_in_world")
+        self.pod_position_from_robot = None
+        self.target_in_home = checkpoint.get("target_in_home")
+        return self.is_init()
+
+    def get_home_in_world(self, coord_pod):
+        "Pose of home in the world frame, from the pose of the station in it"
+        if self.target_in_home is None:
+            return list(coord_pod)
+        home_in_world = almath.Pose2D(coord_pod) * \
+                        almath.Pose2D(self.target_in_home).inverse()
+        return list(home_in_world.toVector())
+
+    def get_in_home(self, x_coord, y_coord):
+        "Position [x, y] in the frame of home, from the frame of the station"
+        if self.target_in_home is None:
+            return [x_coord, y_coord]
+        position = almath.Pose2D(self.target_in_home) * \
+                   almath.Pose2D(x_coord, y_coord, 0.0)
+        return [position.x, position.y]
 
     def need_approach_home(self):
         if self.services.PositionManager:
@@ -140,10 +208,20 @@ class PodManager(object):
                       coord_pod[-1] + math.pi]
 
         is_success = False
-        if self.services.PositionManager.turn_toward_position([DISTANCE_FIRST_APPROACH, 0]):
+        # Asynchronous (and stopping the robot when cancelled), so that
+        # cancelling the approach stops it right away
+        rotation_success = yield self.services.PositionManager.turn_toward_position(
+                                            [DISTANCE_FIRST_APPROACH, 0],
+                                            _async=True)
+        if rotation_success:
             x, y, theta = coord_home
             r, r_theta = self.get_polar_coord([x, y, theta])
-            if self.services.ALMotion.moveTo(r, 0, 0, MOVE_CONFIG_HIGH_SPEED):
+            translation_success = yield move.stop_on_cancel(
+                    self.services.ALMotion.moveTo(r, 0, 0,
+                                                  MOVE_CONFIG_HIGH_SPEED,
+                                                  _async=True),
+                    self.services.ALMotion.stopMove)
+            if translation_success:
                 is_success = True
                 yield self.services.PositionManager.turn_toward_position([0, 0],
                                                                          _async=True)
@@ -157,10 +235,12 @@ class PodManager(object):
         if not self.services.PositionManager:
             yield stk.coroutines.Return(None)
         if self.pod_pos_in_world and not research_360_activated:
-            pod_future = self.services.PositionManager.turn_toward_position([-1.0, 0],
-                                                                     _async=True)
+            pod_future = self.services.PositionManager.turn_toward_position(
+                                            self.get_in_home(-1.0, 0),
+                                            _async=True)
             yield pod_future
-            distance_pod = self.services.PositionManager.get_dist_from_robot(-0.70,0)
+            distance_pod = self.services.PositionManager.get_dist_from_robot(
+                                            *self.get_in_home(-0.70, 0))
             pod_future = self.services.ALTracker._lookAtWithEffector(
                     [distance_pod, 0, 0],
                     2,
@@ -178,19 +258,28 @@ class PodManager(object):
             self.logger.info(repr(pod_future.value()))
         else:
             yield self.services.ALRecharge.setUseTrackerSearcher(False, _async=True)
-            pod_future = qi.async(self.services.ALRecharge.lookForStation)
-            self.future_sleep = stk.coroutines.sleep(5)
-            yield self.future_sleep
-            if pod_future.isRunning():
-                self.services.ALRecharge.stopAll()
-                yield stk.coroutines.Return(None)
+            # Done as soon as the station is seen
+            self.station_future = self.look_for_station(
+                                    self.get_look_for_station_timeout(
+                                        distance_pod))
+            pod_future = self.station_future
+            yield pod_future
         if pod_future:
             coord_pod = pod_future.value()
             if coord_pod and coord_pod[1] and len(coord_pod[1]) == 3:
                 p2D_world2robot = almath.Pose2D(self.services.ALMotion.getRobotPosition(True))
                 coord_pod = coord_pod[1]
-                self.services.PositionManager.init_position_with_coord(coord_pod)
+                home_in_world = self.get_home_in_world(coord_pod)
+                self.services.PositionManager.init_position_with_coord(
+                                                            home_in_world)
                 self.pod_pos_in_world = [0.0, 0.0]
+                if self.target_in_home is not None:
+                    # Home itself, seen from the robot
+                    home_in_robot = p2D_world2robot.inverse() * \
+                                    almath.Pose2D(home_in_world)
+                    yield stk.coroutines.Return(
+                            list(home_in_robot.toVector()))
+                    return
                 p2D_world2target = almath.Pose2D(coord_pod)
                 t_world2robot = almath.transformFromPose2D(p2D_world2robot)
                 t_world2target = almath.transformFromPose2D(p2D_world2target)
@@ -205,6 +294,25 @@ class PodManager(object):
         yield stk.coroutines.Return(None)
 
 
+    @stk.coroutines.async_generator
+    def estimate_home(self):
+        """[pose of home in the world frame, error in m] from the station in
+        view, or None. Doesn't move the robot."""
+        if not self.is_init() or not self.services.PositionManager:
+            yield stk.coroutines.Return(None)
+            return
+        distance_pod = self.services.PositionManager.get_dist_from_robot(0, 0)
+        yield self.services.ALRecharge.setUseTrackerSearcher(False, _async=True)
+        self.station_future = self.look_for_station(
+                                self.get_look_for_station_timeout(
+                                    distance_pod))
+        coord_pod = yield self.station_future
+        if coord_pod and coord_pod[1] and len(coord_pod[1]) == 3:
+            yield stk.coroutines.Return([self.get_home_in_world(coord_pod[1]),
+                                         DETECTION_ERROR])
+            return
+        yield stk.coroutines.Return(None)
+
     def get_polar_coord(self, coord_home):
         x , y , theta = coord_home
         r_theta = float(numpy.arctan(y/x))
@@ -214,19 +322,20 @@ class PodManager(object):
     @stk.coroutines.async_generator
     @stk.logging.log_exceptions
     def last_move(self, x, y, theta):
-        value = yield self.services.ALMotion.moveTo(
-                                         x,
-                                         y,
-                                         0,
-                                         MOVE_CONFIG_LOW_SPEED,
-                                         _async=True)
+        value = yield move.stop_on_cancel(
+                self.services.ALMotion.moveTo(x,
+                                              y,
+                                              0,
+                                              MOVE_CONFIG_LOW_SPEED,
+                                              _async=True),
+                self.services.ALMotion.stopMove)
         if value:
-            value = yield self.services.ALMotion.moveTo(
-                                         0,
-                                         0,
-                                         almath.modulo2PI(
-                                                 theta),
-                                         _async=True)
+            value = yield move.stop_on_cancel(
+                    self.services.ALMotion.moveTo(0,
+                                                  0,
+                                                  almath.modulo2PI(theta),
+                                                  _async=True),
+                    self.services.ALMotion.stopMove)
             if value:
                 self.pod_pos_in_world = [0.0,0.0]
                 self.pod_position_from_robot = None
@@ -234,51 +343,44 @@ class PodManager(object):
         yield stk.coroutines.Return(False)
 
     @stk.coroutines.async_generator
-    def return_home(self, research_360_activated=False):
+    def return_home(self, research_360_activated=False, record=None):
+        if record is None:
+            record = gohomestats.GoHomeRecord("pod", research_360_activated)
+        if self.target_in_home is not None:
+            value = yield self.return_home_away_from_station(
+                                                research_360_activated, record)
+            yield stk.coroutines.Return(value)
+            return
         on_home = False
         if self.need_approach_home() and not research_360_activated:
+            record.enter("approach")
             self.pod_future = self.approach_home()
             yield self.pod_future
             if not self.pod_future.value():
                 if self.services.DXHomeFinder:
                     self.services.DXHomeFinder.reason_cant_go_home.setValue("obstacle")
                 yield stk.coroutines.Return(False)
+        record.search = research_360_activated or not self.pod_pos_in_world
+        record.enter("find")
         self.pod_future = self.find_home(research_360_activated)
         coord_home = yield self.pod_future
         if coord_home:
             r, r_theta = self.get_polar_coord(coord_home)
             if r > 0.5:
+                record.enter("move")
                 x, y, theta = coord_home
                 x += 0.3 * math.cos(theta)
                 y += 0.3 * math.sin(theta)
-                r, r_theta = self.get_polar_coord([x, y, theta])
-                self.pod_future = self.services.ALMotion.moveTo(
-                                                    0,
-                                                    0,
-                                                    almath.modulo2PI(
-                                                            r_theta),
-                                                    MOVE_CONFIG_LOW_SPEED,
-                                                    _async=True)
+                # One smooth move, facing away from the pod at the end
+                self.pod_future = move.move_to(self.session, self.logger,
+                                               x,
+                                               y,
+                                               almath.modulo2PI(
+                                                    coord_home[-1] + math.pi))
                 yield self.pod_future
                 if self.pod_future.value():
-                    self.pod_future = self.services.ALMotion.moveTo(
-                                                    r,
-                                                    0,
-                                                    0,
-                                                    MOVE_CONFIG_LOW_SPEED,
-                                                    _async=True)
-                    yield self.pod_future
-                    if self.pod_future.value():
-                        on_home = True
-                        self.pod_future = self.services.ALMotion.moveTo(
-                                                    0,
-                                                    0,
-                                                    almath.modulo2PI(
-                                                    coord_home[-1] - r_theta + math.pi),
-                                                    MOVE_CONFIG_LOW_SPEED,
-                                                    _async=True)
-                        yield self.pod_future
-                        coord_home = None
+                    on_home = True
+                    coord_home = None
             else:
                 on_home = True
         else:
@@ -287,9 +389,11 @@ class PodManager(object):
                 self.services.DXHomeFinder.reason_cant_go_home.setValue("no_target")
         if on_home:
             if not coord_home:
+                record.enter("find")
                 self.pod_future = self.find_home()
                 coord_home = yield self.pod_future
             if coord_home:
+                record.enter("move")
                 x, y, theta = coord_home
                 self.pod_future = self.last_move(
                         x,
@@ -309,6 +413,29 @@ class PodManager(object):
                 self.services.DXHomeFinder.reason_cant_go_home.setValue("obstacle")
         yield stk.coroutines.Return(False)
 
+    @stk.coroutines.async_generator
+    def return_home_away_from_station(self, research_360_activated, record):
+        """return_home when home was defined away from the station (see
+        init_home_here): one move to home, as seen from the station"""
+        record.search = research_360_activated or not self.pod_pos_in_world
+        record.enter("find")
+        self.pod_future = self.find_home(research_360_activated)
+        coord_home = yield self.pod_future
+        if not coord_home:
+            if self.services.DXHomeFinder:
+                self.services.DXHomeFinder.reason_cant_go_home.setValue("no_target")
+            yield stk.coroutines.Return(False)
+            return
+        record.enter("move")
+        self.pod_future = move.move_to(self.session, self.logger,
+                                       coord_home[0],
+                                       coord_home[1],
+                                       almath.modulo2PI(coord_home[-1]))
+        value = yield self.pod_future
+        if not value and self.services.DXHomeFinder:
+            self.services.DXHomeFinder.reason_cant_go_home.setValue("obstacle")
+        yield stk.coroutines.Return(value)
+
     @stk.coroutines.async_generator
     def search_routine(self):
         angle_to_do = 50
@@ -327,40 +454,57 @@ class PodManager(object):
                         1,
                         _async=True)
                 yield self.search_future_track
-            self.search_future_track = self.services.ALMotion.moveTo(0, 0, math.radians(angle_to_do), _async=True)
+            self.search_future_track = move.stop_on_cancel(
+                    self.services.ALMotion.moveTo(0, 0,
+                                                  math.radians(angle_to_do),
+                                                  _async=True),
+                    self.services.ALMotion.stopMove)
             yield self.search_future_track
 
     @stk.coroutines.public_async_generator
     @stk.logging.log_exceptions
     def search_home(self):
         yield self.services.ALRecharge.setUseTrackerSearcher(False, _async=True)
-        self.look_for_station_future = None
-        self.look_for_station_future = qi.async(self.services.ALRecharge.lookForStation)
-        if self.task and self.task.isRunning():
-            self.task.stop()
-        self.task.start(True)
-        try:
-            self.search_future = self.search_routine()
-            yield self.search_future
-        except Exception as error_msg:
-            self.logger.warning(error_msg)
-        self.cancel_search_home()
+        self.pod_position_from_robot = None
+        # Look around while looking for the station, until it is seen
+        self.station_future = self.look_for_station(SEARCH_TIMEOUT, True)
+        self.pod_position_from_robot = yield self.station_future
         yield stk.coroutines.Return(self.pod_position_from_robot)
 
-    def pod_detected(self):
-        try:
-            if not self.look_for_station_future.isRunning():
-                self.pod_position_from_robot = self.look_for_station_future.value()
-                self.cancel_search_home()
-        except Exception as error_msg:
-            pass
-        
+    @qi.nobind
+    def get_look_for_station_timeout(self, distance):
+        "Time to give lookForStation, from the distance and odometric error"
+        error_xy = self.services.PositionManager.get_odometric_position_error()[0]
+        timeout = (LOOK_FOR_STATION_MIN_TIMEOUT +
+                   LOOK_FOR_STATION_TIME_PER_METER * distance +
+                   LOOK_FOR_STATION_TIME_PER_ERROR * error_xy)
+        return min(timeout, LOOK_FOR_STATION_MAX_TIMEOUT)
+
+    @qi.nobind
+    @stk.coroutines.async_generator
+    def look_for_station(self, timeout, search=False):
+        """lookForStation result, as soon as it arrives
+
+        With search, the head and base look around (search_routine) at the
+        same time. The value is None if the station is not seen before
+        timeout (or the end of the search); cancelling stops everything."""
+        # lookForStation keeps going when its future is cancelled
+        self.look_for_station_future = move.stop_on_cancel(
+                self.services.ALRecharge.lookForStation(_async=True),
+                self.services.ALRecharge.stopAll)
+        futures = [self.look_for_station_future]
+        if search:
+            self.search_future = self.search_routine()
+            futures.append(self.search_future)
+        # The first one done stops the others
+        first = yield stk.coroutines.with_timeout(
+                stk.coroutines.first_completed(futures), timeout)
+        if first and first[0] == 0:
+            yield stk.coroutines.Return(first[1])
+            return
+        yield stk.coroutines.Return(None)
 
     def cancel_search_home(self):
-        try:
-            self.task.stop()
-        except Exception as error_msg:
-            self.logger.warning(error_msg)
         try:
             if self.search_future:
                 self.search_future.cancel()
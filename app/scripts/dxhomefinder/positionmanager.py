@@ -19,32 +19,92 @@ import almath
 import json
 import math
 import os
-import time
+import threading
 
 # stk libs
 import stk.runner
+import stk.clock
 import stk.events
 import stk.services
 import stk.logging
 import stk.coroutines
 
 # Internal libs
+import move
+import occupancygrid
+import odometrymodel
 import planeutils as pu
+import trajectory
 
 # Package ID
 PACKAGE_ID = "proactive-mobility"
 if stk.runner.is_on_robot():
     PATH_POSITION_FILE = ("/home/nao/.local/share/PackageManager/apps/" +
                          PACKAGE_ID + "/scripts/dxhomefinder/data/positions.txt")
+    PATH_ODOMETRY_MODEL_FILE = ("/home/nao/.local/share/PackageManager/apps/" +
+                PACKAGE_ID + "/scripts/dxhomefinder/data/odometry_model.json")
 else:
     PATH_POSITION_FILE = "data/positions.txt"
+    PATH_ODOMETRY_MODEL_FILE = "data/odometry_model.json"
+
+# Trajectory of the robot, kept outside of the package (see trajectory.py)
+if stk.runner.is_on_robot():
+    PATH_TRAJECTORY_FILE = ("/home/nao/.local/share/proactive-mobility/"
+                            "trajectory.bin")
+else:
+    PATH_TRAJECTORY_FILE = "data/trajectory.bin"
+
+# A saved position older than that is not trusted anymore
+POSITION_FILE_VALIDITY = 60 * 10 # in seconds
+
+# Relocalization is needed at least that often
+RELOC_PERIOD = 60 * 10 # in seconds
+
+# Reads of the position closer than that share the same odometry sample
+SNAPSHOT_TTL = 0.1 # in seconds
+
+# The position file is rewritten at most that often (and on stop)
+SAVE_PERIOD = 5.0 # in seconds
+
+# The position is saved again only once it moved more than that
+POSITION_SAVE_DISTANCE = 0.01 # in meters
+POSITION_SAVE_ANGLE = math.radians(1) # in radians
+
+# An unchanged position is saved again that often, so that the file stays
+# valid (see POSITION_FILE_VALIDITY)
+POSITION_REFRESH_PERIOD = POSITION_FILE_VALIDITY / 2 # in seconds
+
+# Version of the position file format (files without version are 1)
+POSITION_FILE_VERSION = 2
+
+# The trajectory is sampled that often (0 for not at all), while sampling
+# (see start_sampling)
+TRAJECTORY_PERIOD = 1.0 # in seconds
+
+# Samples kept in memory (an hour, at the default period)
+TRAJECTORY_CAPACITY = 3600
+
+# Trajectory files are rotated over that size, keeping that many old ones
+TRAJECTORY_FILE_MAX_SIZE = 1024 * 1024 # in bytes
+TRAJECTORY_FILE_BACKUPS = 4
+
+# Obstacles around home are read from the sensors that often, while
+# sampling (see start_sampling)
+OBSTACLE_PERIOD = 0.5 # in seconds
+
+# Obstacles are forgotten when home moves more than that
+HOME_MOVED_DISTANCE = 0.3 # in meters
+HOME_MOVED_ANGLE = math.radians(10) # in radians
+
+ONE_SECOND_IN_US = 1000000
 
 class PositionManager(object):
     """
     Class for saving position
     """
     APP_ID = "com.softbankrobotics.PositionManager"
-    def __init__(self, qiapp):
+    def __init__(self, qiapp, save_period=SAVE_PERIOD,
+                 trajectory_period=TRAJECTORY_PERIOD):
         self.qiapp = qiapp
         self.session = qiapp.session
         self.events = stk.events.EventHelper(self.session)
@@ -56,6 +116,25 @@ class PositionManager(object):
         self.session.waitForService("ALMemory")
         self.session.waitForService("ALPreferenceManager")
 
+        # Last odometry sample (see __recalculate_position)
+        self.position_lock = threading.RLock()
+        self.last_sample_time = None
+        self.snapshot = None
+
+        # Uncertainty of the position (see odometrymodel.py)
+        self.odometry_model = odometrymodel.OdometryErrorModel(
+                odometrymodel.load_parameters(PATH_ODOMETRY_MODEL_FILE))
+
+        # Obstacles around home, see __update_obstacles
+        self.obstacle_lock = threading.Lock()
+        self.obstacle_grid = occupancygrid.OccupancyGrid()
+
+        # Position file is written behind, see __flush_position
+        self.save_lock = threading.Lock()
+        self.position_dirty = False
+        self.saved_robot_in_home = None
+        self.last_save_time = None
+
         # Position of the robot initial
         xw0, yw0, thetaw0 = self.services.ALMotion.getRobotPosition(True)
         self.home_frame = pu.Pose(x_coord=xw0, y_coord=yw0, theta=thetaw0)
@@ -68,15 +147,44 @@ class PositionManager(object):
             if not os.path.exists(folder):
                 os.makedirs(folder)
             self.__save_position_in_file()
+        self.__check_position_file()
+
+        # periodic task
+        self.save_task = stk.clock.periodic_task(self.__flush_position,
+                                                 save_period * ONE_SECOND_IN_US)
+
+        # Trajectory, in memory and in files
+        self.trajectory = trajectory.TrajectoryBuffer(TRAJECTORY_CAPACITY)
+        self.trajectory_file = trajectory.TrajectoryFile(
+                PATH_TRAJECTORY_FILE, TRAJECTORY_FILE_MAX_SIZE,
+                TRAJECTORY_FILE_BACKUPS)
+        self.trajectory_task = stk.clock.periodic_task(
+                                                self.__sample_trajectory)
+        self.trajectory_period = 0
+
+        # Obstacles, from the sensors
+        self.obstacle_task = stk.clock.periodic_task(
+                self.__update_obstacles, OBSTACLE_PERIOD * ONE_SECOND_IN_US)
+
+        # Who needs the sampling (see start_sampling)
+        self.sampling_lock = threading.Lock()
+        self.sampling_holders = set()
 
         # Save the time for checking if we need to relocalize or not
         # We need to relocalize each X minutes for safety and being
         # sur to know where we are.
-        self.last_time_reloc = time.time()
+        self.last_time_reloc = stk.clock.time()
 
         # periodic task
         self.relative_cumulated_displacement = almath.Pose2D(
                 self.services.ALMotion._getCumulatedDisplacement())
+        self.odometry_model.reset(
+                self.relative_cumulated_displacement.toVector(),
+                pu.get_pos_theta(self.robot_in_home.orientation))
+
+        # Last, as tasks may tick right away
+        self.set_trajectory_period(trajectory_period)
+        self.save_task.start(False)
 
     ###########################################
     #            Public Method                #
@@ -88,12 +196,203 @@ class PositionManager(object):
         self.logger.info("cancel")
 
     def get_odometric_position_error(self):
+        "Error in xy (m) and theta (rad) of the position, see odometrymodel"
+        with self.position_lock:
+            self.__recalculate_position()
+            return self.odometry_model.get_error()
+
+    def get_position_uncertainty(self):
+        """Uncertainty of the position, from the odometry error model.
+
+        Returns a dictionary with:
+         - error_xy, error_theta: error in m and rad, at odometrymodel.N_SIGMA
+           standard deviations
+         - covariance: covariance of x, y, theta in the home frame
+         - n_sigma: number of standard deviations of the errors
+        """
+        with self.position_lock:
+            self.__recalculate_position()
+            error_xy, error_theta = self.odometry_model.get_error()
+            return {
+                "error_xy": error_xy,
+                "error_theta": error_theta,
+                "covariance": self.odometry_model.get_covariance(),
+                "n_sigma": odometrymodel.N_SIGMA,
+            }
+
+    def get_odometry_reference(self):
+        """Home frame and odometry state, to restore after a restart.
+
+        See restore_odometry_reference."""
+        cumulated_displacement = almath.Pose2D(
+                self.services.ALMotion._getCumulatedDisplacement())
+        with self.position_lock:
+            return {
+                "home_frame": list(self.__pose_to_coords(self.home_frame)),
+                "error_reference": list(
+                        self.relative_cumulated_displacement.toVector()),
+                "cumulated_displacement": list(
+                        cumulated_displacement.toVector()),
+                "covariance": self.odometry_model.get_covariance(),
+                "model_reference": list(self.odometry_model.reference),
+            }
+
+    def restore_odometry_reference(self, reference, max_error):
+        """Restores what get_odometry_reference returned, if still valid.
+
+        The odometry must not have been reset since (e.g. by a NAOqi
+        restart), and the odometric error must stay under max_error (in m).
+        Returns whether the reference was restored.
+        """
         cumulated_displacement = almath.Pose2D(
                 self.services.ALMotion._getCumulatedDisplacement())
-        last_cumulated_displasment = cumulated_displacement - self.relative_cumulated_displacement
-        error_xy = last_cumulated_displasment.norm() * 0.03
-        error_theta = last_cumulated_displasment.theta * 0.01
-        return [ error_xy, error_theta ]
+        saved_displacement = almath.Pose2D(reference["cumulated_displacement"])
+        if cumulated_displacement.norm() + 1e-3 < saved_displacement.norm() or \
+                abs(cumulated_displacement.theta) + 1e-3 < \
+                abs(saved_displacement.theta):
+            self.logger.info("Odometry was reset, reference not restored.")
+            return False
+        error_reference = almath.Pose2D(reference["error_reference"])
+        # Propagate the saved uncertainty up to now
+        x_coord, y_coord, theta = reference["home_frame"]
+        home_frame = pu.Pose(x_coord=x_coord, y_coord=y_coord, theta=theta)
+        x_robot, y_robot, theta_robot = (
+                                self.services.ALMotion.getRobotPosition(True))
+        theta_in_home = pu.get_pos_theta(home_frame.get_relative(
+                pu.Pose(x_coord=x_robot, y_coord=y_robot,
+                        theta=theta_robot)).orientation)
+        odometry_model = odometrymodel.OdometryErrorModel(
+                                            self.odometry_model.parameters)
+        odometry_model.reset(reference.get("model_reference",
+                                           error_reference.toVector()),
+                             theta_in_home, reference.get("covariance"))
+        odometry_model.update(cumulated_displacement.toVector(),
+                              theta_in_home)
+        error_xy, _ = odometry_model.get_error()
+        if error_xy > max_error:
+            self.logger.info("Odometric error too big (%s m), reference not "
+                             "restored.", error_xy)
+            return False
+        with self.position_lock:
+            old_home_frame = self.home_frame
+            self.home_frame = home_frame
+            self.__check_home_moved(old_home_frame)
+            self.relative_cumulated_displacement = error_reference
+            self.odometry_model = odometry_model
+            self.__invalidate_position()
+            self.__recalculate_position()
+        self.__save_position_in_file()
+        return True
+
+    def set_trajectory_period(self, period):
+        """Samples the trajectory every period seconds (0 for not at all),
+        while sampling (see start_sampling)"""
+        with self.sampling_lock:
+            self.trajectory_task.stop()
+            self.trajectory_period = period
+            if period > 0:
+                self.trajectory_task.setUsPeriod(
+                                        int(period * ONE_SECOND_IN_US))
+                if self.sampling_holders:
+                    self.trajectory_task.start(True)
+
+    def start_sampling(self, holder):
+        """Samples the obstacles and the trajectory, until every holder
+        called stop_sampling; only needed when the robot may move
+        (wandering, going home)."""
+        with self.sampling_lock:
+            if not self.sampling_holders:
+                self.obstacle_task.start(True)
+                if self.trajectory_period > 0:
+                    self.trajectory_task.start(True)
+            self.sampling_holders.add(holder)
+
+    def stop_sampling(self, holder):
+        "Stops sampling, if no other holder needs it (see start_sampling)"
+        with self.sampling_lock:
+            if holder not in self.sampling_holders:
+                return
+            self.sampling_holders.discard(holder)
+            if not self.sampling_holders:
+                self.obstacle_task.stop()
+                self.trajectory_task.stop()
+
+    def get_trajectory(self, start_time, end_time):
+        """Samples in memory between start_time and end_time (timestamps).
+
+        Each sample is [timestamp, x, y, theta, error_xy, error_theta], with
+        the pose in the home frame. An end_time of 0 means until now.
+        """
+        samples = self.trajectory.get_window(start_time, end_time or None)
+        return samples.tolist()
+
+    def get_recent_trajectory(self, duration):
+        "Samples in memory of the last duration seconds (see get_trajectory)"
+        return self.get_trajectory(stk.clock.time() - duration, 0)
+
+    def export_trajectory(self, path, start_time, end_time):
+        """Saves the samples of the trajectory files to path.
+
+        The file is numpy (.npy) or csv (any other extension). An end_time
+        of 0 means until now. Returns the number of samples saved.
+        """
+        self.trajectory_file.flush()
+        samples = trajectory.load_trajectory(self.trajectory_file.get_paths())
+        timestamps = samples[:, 0]
+        in_window = timestamps >= start_time
+        if end_time:
+            in_window &= timestamps <= end_time
+        samples = samples[in_window]
+        trajectory.save_trajectory(samples, path)
+        return len(samples)
+
+    def get_obstacles(self):
+        "Obstacles around home, as a list of [x, y] in the home frame"
+        with self.obstacle_lock:
+            self.obstacle_grid.decay(stk.clock.time())
+            return self.obstacle_grid.get_obstacle_points().tolist()
+
+    def plan_route_home(self):
+        """Route from the robot to home avoiding the obstacles seen.
+
+        Returns the waypoints [x, y] in the home frame, ending with home
+        ([[0, 0]] if the straight line is free), or [] if there is none.
+        """
+        x_robot, y_robot, _ = self.get_robot_pos()
+        with self.obstacle_lock:
+            self.obstacle_grid.decay(stk.clock.time())
+            route = occupancygrid.plan_route(self.obstacle_grid,
+                                             [x_robot, y_robot], [0.0, 0.0])
+        if route is None:
+            self.logger.info("No route home")
+            return []
+        return [[float(x_coord), float(y_coord)] for x_coord, y_coord in route]
+
+    @stk.coroutines.public_async_generator
+    @stk.logging.log_exceptions
+    def follow_route_home(self):
+        """Goes around the obstacles on the way home.
+
+        Drives to the waypoints of plan_route_home, up to the last one
+        before home (from which home is in a straight line). Returns False
+        if there is no detour to do, or if a move failed.
+        """
+        route = self.plan_route_home()
+        if len(route) < 2:
+            yield stk.coroutines.Return(False)
+        self.logger.info("Route home: %s", route)
+        for x_coord, y_coord in route[:-1]:
+            self.__recalculate_position()
+            target = self.robot_in_home.get_relative_pos(
+                                        pu.coords_to_pos(x_coord, y_coord))
+            x_target, y_target = pu.pos_to_coords(target)
+            # Face where we go
+            value = yield move.move_to(self.session, self.logger,
+                                       x_target, y_target,
+                                       pu.get_pos_theta(target))
+            if not value:
+                yield stk.coroutines.Return(False)
+        yield stk.coroutines.Return(True)
 
     def get_angle(self, position):
         "Get angle between the robot and a position in 2D Map"
@@ -145,37 +444,86 @@ class PositionManager(object):
     def get_robot_pos(self):
         "Get the position of the robot in frame home"
         self.__recalculate_position()
-        x_robot, y_robot, theta_robot = self.robot_in_home.get_coord()
-        theta_robot = self.get_orientation()
+        x_robot, y_robot, _ = self.robot_in_home.get_coord()
+        theta_robot = pu.get_pos_theta(self.robot_in_home.orientation)
         return x_robot, y_robot, theta_robot
 
+    def get_snapshot(self):
+        """Everything about the robot position, from one odometry sample.
+
+        Returns a dictionary with:
+         - x, y, theta: robot pose in the home frame
+         - distance_to_home: distance between robot and home
+         - angle_from_home: direction of the robot, seen from home
+         - bearing_to_home: direction of home, seen from the robot
+         - error_xy, error_theta: odometric error (see
+           get_position_uncertainty)
+         - covariance: covariance of x, y, theta
+         - timestamp: time of the odometry sample
+        Calls within SNAPSHOT_TTL of each other get the same snapshot.
+        """
+        with self.position_lock:
+            self.__recalculate_position()
+            if self.snapshot is None:
+                x_robot, y_robot, _ = self.robot_in_home.get_coord()
+                error_xy, error_theta = self.odometry_model.get_error()
+                home_in_robot = self.robot_in_home.get_relative_pos(
+                                                    pu.coords_to_pos(0, 0))
+                self.snapshot = {
+                    "x": x_robot,
+                    "y": y_robot,
+                    "theta": pu.get_pos_theta(self.robot_in_home.orientation),
+                    "distance_to_home": float(
+                            pu.get_pos_dist(self.robot_in_home.pos)),
+                    "angle_from_home": pu.get_pos_theta(
+                                                    self.robot_in_home.pos),
+                    "bearing_to_home": pu.get_pos_theta(home_in_robot),
+                    "error_xy": float(error_xy),
+                    "error_theta": float(error_theta),
+                    "covariance": self.odometry_model.get_covariance(),
+                    "timestamp": self.last_sample_time,
+                }
+            return dict(self.snapshot)
+
     def init_position(self):
         "Init to position [0, 0]"
         # Initialize last time reloc
-        self.last_time_reloc = time.time()
+        self.last_time_reloc = stk.clock.time()
 
         # Get the robot position in world frame and initialize home frame
         # At this position
         xw0, yw0, thetaw0 = self.services.ALMotion.getRobotPosition(True)
+        old_home_frame = self.home_frame
         self.home_frame = pu.Pose(x_coord=xw0, y_coord=yw0, theta=thetaw0)
+        self.__check_home_moved(old_home_frame)
         self.robot_in_home = pu.Pose(x_coord=0, y_coord=0, theta=0)
         self.relative_cumulated_displacement = almath.Pose2D(
                 self.services.ALMotion._getCumulatedDisplacement())
+        self.odometry_model.reset(
+                self.relative_cumulated_displacement.toVector(),
+                pu.get_pos_theta(self.robot_in_home.orientation))
+        self.__invalidate_position()
         # Save position in file
         self.__save_position_in_file()
 
     def init_position_with_coord(self, coord):
         "Init Position of the robot at the coordinate give in argument"
         # Initialize last time reloc
-        self.last_time_reloc = time.time()
+        self.last_time_reloc = stk.clock.time()
 
         # Get the robot position in world frame and initialize home frame
         # At this position
         xw0, yw0, thetaw0 = coord
+        old_home_frame = self.home_frame
         self.home_frame = pu.Pose(x_coord=xw0, y_coord=yw0, theta=thetaw0)
+        self.__check_home_moved(old_home_frame)
         self.robot_in_home = self.home_frame.get_relative(self.home_frame)
         self.relative_cumulated_displacement = almath.Pose2D(
                 self.services.ALMotion._getCumulatedDisplacement())
+        self.odometry_model.reset(
+                self.relative_cumulated_displacement.toVector(),
+                pu.get_pos_theta(self.robot_in_home.orientation))
+        self.__invalidate_position()
         # Save position in file
         self.__save_position_in_file()
 
@@ -189,9 +537,27 @@ class PositionManager(object):
     def on_stop(self):
         "Cleanup"
         self.logger.info("Application finished.")
+        self.save_task.stop()
+        self.trajectory_task.stop()
+        self.obstacle_task.stop()
         self.__recalculate_position()
+        self.__flush_position()
+        self.trajectory_file.close()
         self.events.clear()
 
+    @stk.events.on("ALMotion/MoveFailed")
+    def on_move_failed(self, value):
+        "A safety stop: there is an obstacle where the robot wanted to go"
+        try:
+            x_coord, y_coord = value[2][:2]
+        except (TypeError, IndexError, ValueError):
+            return
+        obstacle = self.home_frame.get_relative_pos(
+                                        pu.coords_to_pos(x_coord, y_coord))
+        with self.obstacle_lock:
+            self.obstacle_grid.add_obstacles([pu.pos_to_coords(obstacle)],
+                                             stk.clock.time(), 1.0)
+
     @stk.coroutines.public_async_generator
     def reset_angle(self):
         "Reset angle of the base in 0"
@@ -214,11 +580,13 @@ class PositionManager(object):
 
             # For returning at the orientation you just need to rotate to
             # -robot_orientation_in_rad
-            value = yield self.services.ALMotion.moveTo(
+            value = yield move.stop_on_cancel(
+                    self.services.ALMotion.moveTo(
                                 0.0,
                                 0.0,
                                 -float(robot_orientation_in_rad),
-                                _async=True)
+                                _async=True),
+                    self.services.ALMotion.stopMove)
 
             # For initialize the tracking, with that the robot look in front
             # and forget the last face tracked
@@ -265,9 +633,11 @@ class PositionManager(object):
                                                             2,
                                                             1,
                                                             _async=True)
-        future_rotation = self.services.ALMotion.moveTo(0.0,
+        future_rotation = move.stop_on_cancel(
+                self.services.ALMotion.moveTo(0.0,
                                 0.0,
-                                angle_to_obj_in_rad, _async=True)
+                                angle_to_obj_in_rad, _async=True),
+                self.services.ALMotion.stopMove)
         yield future_rotation
         rotation_success = future_rotation.value()
         angle_condition = (angle_to_obj_in_deg > -1 and
@@ -300,11 +670,13 @@ class PositionManager(object):
         # The distance between the robot and the object is superior at 10cm
         if dist >= 0.1 and success_rotation.value():
             # Move to the target position
-            translation_success = yield self.services.ALNavigation.navigateTo(
+            translation_success = yield move.stop_on_cancel(
+                    self.services.ALNavigation.navigateTo(
                                                     dist,
                                                     0.0,
                                                     0.0,
-                                                    _async=True)
+                                                    _async=True),
+                    self.services.ALNavigation.stopNavigateTo)
             yield stk.coroutines.Return(translation_success)
         else:
             self.logger.info("end navigate_in_map : value True")
@@ -336,11 +708,13 @@ class PositionManager(object):
         # The distance between the robot and the object is superior at 10cm
         if dist >= 0.1 and success_rotation.value():
             # Move to the target position
-            translation_success = yield self.services.ALMotion.moveTo(
+            translation_success = yield move.stop_on_cancel(
+                    self.services.ALMotion.moveTo(
                                                     dist,
                                                     0.0,
                                                     0.0,
-                                                    _async=True)
+                                                    _async=True),
+                    self.services.ALMotion.stopMove)
             yield stk.coroutines.Return(translation_success)
         else:
             self.logger.info("end navigate_in_map : value True")
@@ -353,6 +727,7 @@ class PositionManager(object):
     def stop(self):
         "Standard way of stopping the application."
         self.__recalculate_position()
+        self.__flush_position()
         self.qiapp.stop()
 
     ###########################################
@@ -363,58 +738,202 @@ class PositionManager(object):
     def __load_position_in_file(self):
         "Load the position from the file on the robot"
         json_data = None
-        with open(PATH_POSITION_FILE, 'r') as file:
-            json_data_str = file.read()
-            if json_data_str:
-                json_data = json.loads(json_data_str)
+        try:
+            with open(PATH_POSITION_FILE, 'r') as file:
+                json_data_str = file.read()
+                if json_data_str:
+                    json_data = json.loads(json_data_str)
+            if json_data and (stk.clock.time() - json_data["timestamp"]) < POSITION_FILE_VALIDITY:
+                self.home_frame, self.robot_in_home = \
+                    self.__decode_position(json_data)
+                self.__invalidate_position()
+                self.__save_position_in_file()
+            else:
+                self.init_position()
+        except (ValueError, KeyError, TypeError, IndexError) as exc:
+            self.logger.warning("Corrupted position file, ignored: %s", exc)
+            self.init_position()
 
-        if json_data and (time.time() - json_data["timestamp"]) < 60*10:
-            self.home_frame = pu.Pose(pos=complex(
+    @qi.nobind
+    def __decode_position(self, json_data):
+        "Home frame and robot in home poses from the content of the file"
+        if json_data.get("version", 1) == 1:
+            # Complex numbers, as their repr strings
+            home_frame = pu.Pose(pos=complex(
                                     json_data["home_frame"]['pos']),
                                     orientation=complex(
                                     json_data["home_frame"]['orientation']))
-            self.robot_in_home = pu.Pose(pos=complex(
+            robot_in_home = pu.Pose(pos=complex(
                                   json_data["robot_in_home"]['pos']),
                                   orientation=complex(
                                   json_data["robot_in_home"]['orientation']))
-            self.__save_position_in_file()
+        elif json_data["version"] == POSITION_FILE_VERSION:
+            # [x, y, theta] lists
+            home_frame, robot_in_home = [
+                pu.Pose(pos=pu.coords_to_pos(float(x_coord), float(y_coord)),
+                        orientation=pu.unit_vector(float(theta)))
+                for x_coord, y_coord, theta in (json_data["home_frame"],
+                                                json_data["robot_in_home"])]
         else:
-            self.init_position()
+            raise ValueError("Unknown version %s" % json_data["version"])
+        for pose in (home_frame, robot_in_home):
+            values = [pose.pos.real, pose.pos.imag,
+                      pose.orientation.real, pose.orientation.imag]
+            if any(math.isinf(value) or math.isnan(value) for value in values):
+                raise ValueError("Invalid pose %s" % pose)
+        return home_frame, robot_in_home
+
+    @qi.nobind
+    def __encode_position(self):
+        "Content of the position file (compact, versioned)"
+        with self.position_lock:
+            poses = [self.home_frame, self.robot_in_home]
+            json_data = {
+                "version": POSITION_FILE_VERSION,
+                "timestamp": round(stk.clock.time(), 3),
+            }
+        for name, pose in zip(["home_frame", "robot_in_home"], poses):
+            json_data[name] = [round(value, 6)
+                               for value in self.__pose_to_coords(pose)]
+        return json.dumps(json_data, separators=(",", ":"))
+
+    @qi.nobind
+    def __check_position_file(self):
+        "Read back check: the file must give back the position we have"
+        try:
+            with open(PATH_POSITION_FILE, 'r') as file:
+                home_frame, robot_in_home = self.__decode_position(
+                                                        json.loads(file.read()))
+            for saved, current in ((home_frame, self.home_frame),
+                                   (robot_in_home, self.robot_in_home)):
+                if abs(saved.pos - current.pos) > 1e-3 or \
+                        abs(saved.orientation - current.orientation) > 1e-3:
+                    raise ValueError("%s instead of %s" % (saved, current))
+        except (IOError, ValueError, KeyError, TypeError) as exc:
+            self.logger.error("Position file check failed: %s", exc)
+            return False
+        return True
 
     @qi.nobind
     def __need_reloc(self):
         "Check if the robot need reloc"
-        if time.time() - self.last_time_reloc > 60*10:
+        if stk.clock.time() - self.last_time_reloc > RELOC_PERIOD:
             return True
         else:
             return False
 
+    @qi.nobind
+    def __pose_to_coords(self, pose):
+        "x, y, theta of a planeutils pose"
+        return (float(pose.pos.real), float(pose.pos.imag),
+                float(pu.get_pos_theta(pose.orientation)))
+
+    @qi.nobind
+    def __check_home_moved(self, old_home_frame):
+        "Forget the obstacles if the home frame moved"
+        new_in_old = old_home_frame.get_relative(self.home_frame)
+        if pu.get_pos_dist(new_in_old.pos) > HOME_MOVED_DISTANCE or \
+                abs(pu.get_pos_theta(new_in_old.orientation)) > \
+                HOME_MOVED_ANGLE:
+            with self.obstacle_lock:
+                self.obstacle_grid.clear()
+
+    @qi.nobind
+    def __update_obstacles(self):
+        "Add what the lasers and sonars see to the obstacles (one RPC)"
+        try:
+            values = self.services.method("ALMemory", "getListData")(
+                                                occupancygrid.SENSOR_KEYS)
+        except RuntimeError:
+            # No such keys, e.g. on a virtual robot
+            return
+        points = occupancygrid.get_sensor_points(values)
+        with self.position_lock:
+            self.__recalculate_position()
+            robot_in_home = pu.PoseArray.from_poses([self.robot_in_home])
+        # From the robot frame to the home frame, all at once
+        points_in_home = robot_in_home.get_absolute_pos(
+                points[:, 0] + 1j * points[:, 1])
+        with self.obstacle_lock:
+            self.obstacle_grid.add_scan(
+                    pu.pos_to_coords(robot_in_home.pos[0]),
+                    zip(points_in_home.real, points_in_home.imag),
+                    stk.clock.time())
+
+    @qi.nobind
+    def __invalidate_position(self):
+        "Next read of the position will sample odometry again"
+        with self.position_lock:
+            self.last_sample_time = None
+            self.snapshot = None
+
     @qi.nobind
     def __recalculate_position(self):
-        "Recalculate actual position of the robot"
-        x_coord, y_coord, theta = (
-                                self.services.ALMotion.getRobotPosition(True))
-        # Robot position in the world frame
-        robot_in_world = pu.Pose(x_coord=x_coord,
-                                 y_coord=y_coord,
-                                 theta=theta)
-        # Robot in the home frame
-        self.robot_in_home = self.home_frame.get_relative(robot_in_world)
-        # Save in a file on the robot
-        self.__save_position_in_file()
+        "Recalculate actual position of the robot (at most every SNAPSHOT_TTL)"
+        with self.position_lock:
+            now = stk.clock.time()
+            if self.last_sample_time is not None and \
+                    now - self.last_sample_time < SNAPSHOT_TTL:
+                return
+            x_coord, y_coord, theta = self.services.method(
+                    "ALMotion", "getRobotPosition")(True)
+            # Robot position in the world frame
+            robot_in_world = pu.Pose(x_coord=x_coord,
+                                     y_coord=y_coord,
+                                     theta=theta)
+            # Robot in the home frame
+            self.robot_in_home = self.home_frame.get_relative(robot_in_world)
+            # Uncertainty grows with the distance travelled since
+            self.odometry_model.update(
+                    self.services.method("ALMotion",
+                                         "_getCumulatedDisplacement")(),
+                    pu.get_pos_theta(self.robot_in_home.orientation))
+            self.last_sample_time = now
+            self.snapshot = None
+            # Saved in a file on the robot later if it moved, see
+            # __flush_position
+            if self.saved_robot_in_home is None:
+                self.position_dirty = True
+            else:
+                moved = self.saved_robot_in_home.get_relative(
+                                                        self.robot_in_home)
+                if pu.get_pos_dist(moved.pos) > POSITION_SAVE_DISTANCE or \
+                        abs(pu.get_pos_theta(moved.orientation)) > \
+                        POSITION_SAVE_ANGLE:
+                    self.position_dirty = True
+
+    @qi.nobind
+    def __flush_position(self):
+        "Save the position in the file, if it changed since last save"
+        if self.position_dirty or self.last_save_time is None or \
+                stk.clock.time() - self.last_save_time > \
+                POSITION_REFRESH_PERIOD:
+            self.__save_position_in_file()
+        self.trajectory_file.flush()
+
+    @qi.nobind
+    def __sample_trajectory(self):
+        "Add the current position to the trajectory"
+        snapshot = self.get_snapshot()
+        sample = [snapshot[field] for field in trajectory.FIELDS]
+        self.trajectory.append(sample)
+        self.trajectory_file.append(sample)
 
     @qi.nobind
     def __save_position_in_file(self):
-        "Save the position in the file on the robot"
-        with open(PATH_POSITION_FILE, 'w') as file:
-            json_data = {}
-            json_data["timestamp"] = time.time()
-            json_data["home_frame"] = {'pos' : repr(self.home_frame.pos),
-                            'orientation': repr(self.home_frame.orientation)}
-            json_data["robot_in_home"] = {
-                    'pos' : repr(self.robot_in_home.pos),
-                    'orientation': repr(self.robot_in_home.orientation)}
-            file.write(json.dumps(json_data))
+        "Save the position in the file on the robot (atomically)"
+        with self.save_lock:
+            self.position_dirty = False
+            with self.position_lock:
+                self.saved_robot_in_home = self.robot_in_home
+            self.last_save_time = stk.clock.time()
+            temp_path = PATH_POSITION_FILE + ".tmp"
+            with open(temp_path, 'w') as file:
+                file.write(self.__encode_position())
+                file.flush()
+                os.fsync(file.fileno())
+            # A crash leaves either the old file or the new one, never half
+            os.rename(temp_path, PATH_POSITION_FILE)
 
 ####################
 # Setup and Run
@@ -0,0 +1,600 @@
+"""
+Simulated ALMotion, for running the home finders without a robot.
+
+Velocity commands (move, moveTo) are integrated at a fixed rate on a
+simulated clock, which can run faster than real time. The odometry seen
+through getRobotPosition drifts away from the true pose with a configurable
+scale, bias and noise model, and obstacles stop the robot with an
+"ALMotion/MoveFailed" event, like the safety of the real robot.
+"""
+# pylint: disable=E1101
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2018, Softbank Robotics"
+
+# Import qi
+import qi
+
+# Basic libs
+import functools
+import math
+import random
+import threading
+import time
+
+# stk libs
+import stk.clock
+import stk.coroutines
+import stk.simulation
+
+DEFAULT_MAX_VELOCITY = {
+    "MaxVelXY": 0.35, # m/s
+    "MaxVelTheta": 1.0, # rad/s
+}
+
+GOAL_TOLERANCE_XY = 0.005 # m
+GOAL_TOLERANCE_THETA = 0.005 # rad
+
+# Systematic odometry errors: relative error on translations and rotations,
+# and heading drift per meter travelled.
+DEFAULT_DRIFT = {
+    "scale_xy": 0.02,
+    "scale_theta": 0.01,
+    "theta_per_meter": 0.01,
+}
+
+# Random odometry errors, standard deviations per sqrt(meter) / sqrt(rad)
+DEFAULT_NOISE = {
+    "xy": 0.005,
+    "theta": 0.005,
+}
+
+def normalize_angle(angle):
+    "Angle in ]-pi, pi]"
+    return math.atan2(math.sin(angle), math.cos(angle))
+
+def compose(pose, delta):
+    "Pose2D composition (pose * delta), as [x, y, theta] lists"
+    x, y, theta = pose
+    return [x + delta[0] * math.cos(theta) - delta[1] * math.sin(theta),
+            y + delta[0] * math.sin(theta) + delta[1] * math.cos(theta),
+            normalize_angle(theta + delta[2])]
+
+def relative(pose, other):
+    "Pose of other in the frame of pose (pose.inverse() * other)"
+    x, y, theta = pose
+    d_x, d_y = other[0] - x, other[1] - y
+    return [d_x * math.cos(theta) + d_y * math.sin(theta),
+            -d_x * math.sin(theta) + d_y * math.cos(theta),
+            normalize_angle(other[2] - theta)]
+
+def qi_method(func):
+    """Like a proxy method: supports the _async keyword argument.
+
+    On a clock, asynchronous calls are made right away (no thread), and
+    return a finished future."""
+    @functools.wraps(func)
+    def wrapped(self, *args, **kwargs):
+        if kwargs.pop("_async", False):
+            if self.clock:
+                promise = qi.Promise()
+                promise.setValue(func(self, *args, **kwargs))
+                return promise.future()
+            return qi.async(functools.partial(func, self, *args, **kwargs))
+        return func(self, *args, **kwargs)
+    return wrapped
+
+class SimMotion(object):
+    "Stand-in for ALMotion, with a kinematic base and drifting odometry."
+    def __init__(self, memory=None, rate=50.0, time_factor=1.0, drift=None,
+                 noise=None, obstacles=None, robot_radius=0.3, seed=None,
+                 clock=None):
+        self.memory = memory or stk.simulation.SimMemory()
+        self.rate = float(rate) # integration steps per simulated second
+        # simulated seconds per wall clock second, 0 for "as fast as possible"
+        self.time_factor = float(time_factor)
+        self.drift = dict(DEFAULT_DRIFT)
+        self.drift.update(drift or {})
+        self.noise = dict(DEFAULT_NOISE)
+        self.noise.update(noise or {})
+        # obstacles are discs (x, y, radius) in the true world frame
+        self.obstacles = list(obstacles or [])
+        self.robot_radius = robot_radius
+        self.random = random.Random(seed)
+        # with a clock (e.g. a stk.clock.VirtualClock), steps are timers on it
+        self.clock = clock
+        self.task = None
+
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.sim_time = 0.0
+        self.true_pose = [0.0, 0.0, 0.0]
+        self.odometry_origin = [0.0, 0.0, 0.0] # true pose at odometry reset
+        self.odometry = [0.0, 0.0, 0.0]
+        self.cumulated_displacement = [0.0, 0.0, 0.0]
+        self.velocity = [0.0, 0.0, 0.0]
+        self.move_target = None # moveTo target, in odometry frame
+        self.move_max_velocity = dict(DEFAULT_MAX_VELOCITY)
+        self.move_count = 0
+        self.move_results = {}
+        self.move_promises = {} # asynchronous moveTo on a clock, by move id
+        self.joints = {"HeadYaw": 0.0, "HeadPitch": 0.0}
+        self.move_failed_count = 0
+
+    ###########################################
+    #            Simulation                   #
+    ###########################################
+
+    def start(self):
+        "Starts integrating in a background thread (or on the clock)."
+        if not self.running:
+            self.running = True
+            if self.clock:
+                period = 1.0 / self.rate
+                self.task = self.clock.periodic_task()
+                self.task.setCallback(lambda: self.step(period))
+                self.task.setUsPeriod(int(period * 1000000))
+                self.task.start(False)
+            else:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stop(self):
+        "Stops the background thread (or the clock task)."
+        self.running = False
+        if self.task:
+            self.task.stop()
+            self.task = None
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def time(self):
+        "Simulated time, in seconds."
+        return self.sim_time
+
+    def reset(self, true_pose=None):
+        "Puts the robot back at the origin (or somewhere), odometry included."
+        with self.condition:
+            self.true_pose = list(true_pose or [0.0, 0.0, 0.0])
+            self.odometry_origin = list(self.true_pose)
+            self.odometry = [0.0, 0.0, 0.0]
+            self.cumulated_displacement = [0.0, 0.0, 0.0]
+            self._abort_move(False)
+
+    def get_true_pose(self):
+        "Ground truth pose of the robot, in the true world frame."
+        with self.condition:
+            return list(self.true_pose)
+
+    def get_odometry_error(self):
+        "Distance and angle between odometry and ground truth poses."
+        with self.condition:
+            error = relative(self.odometry, self._true_in_odometry())
+        return math.hypot(error[0], error[1]), abs(error[2])
+
+    def _run(self):
+        period = 1.0 / self.rate
+        while self.running:
+            self.step(period)
+            if self.time_factor > 0:
+                time.sleep(period / self.time_factor)
+
+    def step(self, duration):
+        "Integrates the current command over duration (simulated seconds)."
+        with self.condition:
+            if self.move_target is not None:
+                self.velocity = self._get_move_to_velocity(duration)
+            v_x, v_y, v_theta = self.velocity
+            delta = [v_x * duration, v_y * duration, v_theta * duration]
+            if any(delta):
+                new_pose = compose(self.true_pose, delta)
+                obstacle = self._get_colliding_obstacle(new_pose)
+                if obstacle:
+                    self._on_collision(obstacle)
+                else:
+                    self.true_pose = new_pose
+                    self._integrate_odometry(delta)
+            self.sim_time += duration
+            self.condition.notify_all()
+
+    def _integrate_odometry(self, delta):
+        "Odometry sees the true displacement through its error model."
+        d_x, d_y, d_theta = delta
+        dist = math.hypot(d_x, d_y)
+        scale_xy = 1.0 + self.drift["scale_xy"]
+        measured = [
+            d_x * scale_xy + self.random.gauss(0, self.noise["xy"]) * math.sqrt(abs(d_x)),
+            d_y * scale_xy + self.random.gauss(0, self.noise["xy"]) * math.sqrt(abs(d_y)),
+            d_theta * (1.0 + self.drift["scale_theta"])
+            + self.drift["theta_per_meter"] * dist
+            + self.random.gauss(0, self.noise["theta"]) * math.sqrt(abs(d_theta))]
+        self.odometry = compose(self.odometry, measured)
+        for i in range(3):
+            self.cumulated_displacement[i] += abs(measured[i])
+
+    def _get_move_to_velocity(self, duration):
+        "Closed loop on odometry toward the moveTo target."
+        error = relative(self.odometry, self.move_target)
+        dist = math.hypot(error[0], error[1])
+        if dist < GOAL_TOLERANCE_XY and abs(error[2]) < GOAL_TOLERANCE_THETA:
+            self._abort_move(True)
+            return [0.0, 0.0, 0.0]
+        speed = min(self.move_max_velocity["MaxVelXY"], dist / duration)
+        v_theta = max(-self.move_max_velocity["MaxVelTheta"],
+                      min(self.move_max_velocity["MaxVelTheta"], error[2] / duration))
+        if dist > 0:
+            return [speed * error[0] / dist, speed * error[1] / dist, v_theta]
+        return [0.0, 0.0, v_theta]
+
+    def _true_in_odometry(self):
+        "True pose expressed in the odometry frame."
+        return relative(self.odometry_origin, self.true_pose)
+
+    def _get_colliding_obstacle(self, new_pose):
+        "Obstacle the robot would enter by going to new_pose, if any."
+        for obstacle in self.obstacles:
+            o_x, o_y, radius = obstacle
+            new_dist = math.hypot(new_pose[0] - o_x, new_pose[1] - o_y)
+            old_dist = math.hypot(self.true_pose[0] - o_x, self.true_pose[1] - o_y)
+            if new_dist < radius + self.robot_radius and new_dist < old_dist:
+                return obstacle
+        return None
+
+    def _on_collision(self, obstacle):
+        "Safety stop, like ALMotion: stop everything and raise MoveFailed."
+        o_x, o_y, radius = obstacle
+        x, y, _ = self.true_pose
+        dist = math.hypot(o_x - x, o_y - y) or 1.0
+        contact = [o_x - radius * (o_x - x) / dist, o_y - radius * (o_y - y) / dist]
+        # the robot reports positions in its (drifted) odometry frame
+        true_to_odom = relative(self.true_pose, [contact[0], contact[1], 0.0])
+        contact_in_odom = compose(self.odometry, true_to_odom)
+        self.velocity = [0.0, 0.0, 0.0]
+        self._abort_move(False)
+        self.move_failed_count += 1
+        qi.async(self.memory.raiseEvent, "ALMotion/MoveFailed",
+                 ["Safety", 1, contact_in_odom])
+
+    def _abort_move(self, result):
+        "Ends the current moveTo, if any, with the given result."
+        if self.move_target is not None:
+            self.move_target = None
+            self.velocity = [0.0, 0.0, 0.0]
+            promise = self.move_promises.pop(self.move_count, None)
+            if promise:
+                # Set on the clock, out of the lock
+                self.clock.call_later(0, promise.setValue, result)
+            else:
+                self.move_results[self.move_count] = result
+            self.condition.notify_all()
+
+    def _wait_until(self, predicate):
+        "Blocks until predicate() is true (needs start(), or someone stepping)."
+        if self.clock:
+            # Sleeping on a virtual clock is what makes the steps happen
+            while True:
+                with self.condition:
+                    if predicate():
+                        return
+                self.clock.sleep(1.0 / self.rate)
+        with self.condition:
+            while not predicate():
+                self.condition.wait(0.1)
+
+    ###########################################
+    #            ALMotion API                 #
+    ###########################################
+
+    @qi_method
+    def getRobotPosition(self, use_sensors):
+        "Odometric position of the robot [x, y, theta]."
+        with self.condition:
+            return list(self.odometry)
+
+    @qi_method
+    def _getCumulatedDisplacement(self):
+        "Sum of absolute odometric displacements [x, y, theta]."
+        with self.condition:
+            return list(self.cumulated_displacement)
+
+    @qi_method
+    def move(self, v_x, v_y, v_theta, *config):
+        "Velocity command in m/s and rad/s, until the next command."
+        with self.condition:
+            self._abort_move(False)
+            self.velocity = [float(v_x), float(v_y), float(v_theta)]
+
+    def moveTo(self, x_coord, y_coord, theta, config=None, _async=False):
+        """Blocking relative move, returns False if interrupted.
+
+        Like with ALMotion, cancelling its future doesn't stop the robot."""
+        with self.condition:
+            self._abort_move(False)
+            self.move_max_velocity = dict(DEFAULT_MAX_VELOCITY)
+            for key, value in config or []:
+                if key in self.move_max_velocity:
+                    self.move_max_velocity[key] = value
+            self.move_count += 1
+            move_id = self.move_count
+            self.move_target = compose(self.odometry,
+                                       [float(x_coord), float(y_coord), float(theta)])
+            if _async and self.clock:
+                # No thread waiting: _abort_move sets the future
+                promise = qi.Promise()
+                self.move_promises[move_id] = promise
+                return promise.future()
+        if _async:
+            return qi.async(self._wait_for_move, move_id)
+        return self._wait_for_move(move_id)
+
+    def _wait_for_move(self, move_id):
+        "Blocks until the moveTo move_id is over; returns its result."
+        self._wait_until(lambda: move_id in self.move_results)
+        return self.move_results.pop(move_id)
+
+    @qi_method
+    def moveIsActive(self):
+        "Is the base moving?"
+        with self.condition:
+            return self.move_target is not None or any(self.velocity)
+
+    @qi_method
+    def stopMove(self):
+        "Stops the base."
+        with self.condition:
+            self._abort_move(False)
+            self.velocity = [0.0, 0.0, 0.0]
+
+    @qi_method
+    def killMove(self):
+        "Stops the base (no difference with stopMove in simulation)."
+        self.stopMove()
+
+    def angleInterpolation(self, names, angles, times, is_absolute,
+                           _async=False):
+        "Moves joints, blocking for the (simulated) duration."
+        if not isinstance(names, list):
+            names, angles, times = [names], [angles], [times]
+        if not isinstance(times, list):
+            # One time for all the joints
+            times = [times] * len(names)
+        durations = [time_list[-1] if isinstance(time_list, list) else time_list
+                     for time_list in times]
+        if _async and self.clock:
+            return self.clock.call_later(max(durations), self._set_angles,
+                                         names, angles, is_absolute)
+        if _async:
+            return qi.async(self.angleInterpolation, names, angles, times,
+                            is_absolute)
+        with self.condition:
+            end = self.sim_time + max(durations)
+        self._wait_until(lambda: self.sim_time >= end)
+        self._set_angles(names, angles, is_absolute)
+
+    def _set_angles(self, names, angles, is_absolute):
+        "Joints at the end of an angleInterpolation."
+        with self.condition:
+            for name, angle in zip(names, angles):
+                if isinstance(angle, list):
+                    angle = angle[-1]
+                if is_absolute:
+                    self.joints[name] = angle
+                else:
+                    self.joints[name] = self.joints.get(name, 0.0) + angle
+
+    @qi_method
+    def getAngles(self, names, use_sensors):
+        "Joint angles (0 for joints never moved)."
+        if not isinstance(names, list):
+            names = [names]
+        with self.condition:
+            return [self.joints.get(name, 0.0) for name in names]
+
+###########################################
+#            Benchmark                    #
+###########################################
+
+def benchmark_odometry_return(cycles=1000, max_distance=3.0, seed=0, **kwargs):
+    """Random wanders, and returns to home with odometry only.
+
+    Home return is done like the managers: turn, go straight, turn.
+    Returns the mean return time (simulated) and final errors.
+    """
+    rand = random.Random(seed)
+    motion = SimMotion(time_factor=0, seed=seed, **kwargs)
+    motion.start()
+    times = []
+    errors_xy = []
+    errors_theta = []
+    try:
+        for _ in range(cycles):
+            motion.reset()
+            for _ in range(rand.randint(1, 4)):
+                motion.moveTo(0, 0, rand.uniform(-math.pi, math.pi))
+                motion.moveTo(rand.uniform(0, max_distance / 2), 0, 0)
+            start = motion.time()
+            x_coord, y_coord, theta = motion.getRobotPosition(True)
+            home_in_robot = relative([x_coord, y_coord, theta], [0.0, 0.0, 0.0])
+            r_theta = math.atan2(home_in_robot[1], home_in_robot[0])
+            motion.moveTo(0, 0, r_theta)
+            motion.moveTo(math.hypot(home_in_robot[0], home_in_robot[1]), 0, 0)
+            motion.moveTo(0, 0, normalize_angle(home_in_robot[2] - r_theta))
+            times.append(motion.time() - start)
+            x_coord, y_coord, theta = motion.get_true_pose()
+            errors_xy.append(math.hypot(x_coord, y_coord))
+            errors_theta.append(abs(theta))
+    finally:
+        motion.stop()
+    return {
+        "cycles": cycles,
+        "mean_return_time": sum(times) / cycles,
+        "mean_error_xy": sum(errors_xy) / cycles,
+        "max_error_xy": max(errors_xy),
+        "mean_error_theta": sum(errors_theta) / cycles,
+    }
+
+# A cancelled motion must not start again for that long
+CANCEL_SETTLE_TIME = 3.0 # in seconds
+
+class _SimPositionManager(object):
+    "Internal - what the approach uses of PositionManager (home at 0, 0)."
+    def __init__(self, motion):
+        self.motion = motion
+
+    def get_home_pos(self):
+        "Home in the odometry frame."
+        return [0.0, 0.0, 0.0]
+
+    def get_dist_from_robot(self, x_coord, y_coord):
+        "Distance from the robot to a position in the home frame."
+        x_robot, y_robot, _ = self.motion.getRobotPosition(True)
+        return math.hypot(x_coord - x_robot, y_coord - y_robot)
+
+    @stk.coroutines.public_async_generator
+    def turn_toward_position(self, position):
+        "Turns like PositionManager.turn_toward_position."
+        import move
+        target = relative(self.motion.getRobotPosition(True),
+                          [position[0], position[1], 0.0])
+        value = yield move.stop_on_cancel(
+                self.motion.moveTo(0, 0, math.atan2(target[1], target[0]),
+                                   _async=True),
+                self.motion.stopMove)
+        yield stk.coroutines.Return(value)
+
+def benchmark_cancel(cycles=50, seed=0):
+    """Cancels going home at a random time, in simulation.
+
+    Measures the (simulated) time from the cancel of the top future to the
+    base being stationary, for a bare moveTo future (what the managers used
+    to wait on) and for the go home paths. Returns, for each, the mean and
+    max latency, and how many times the base moved again after the stop.
+    """
+    import move
+    import podmanager
+    clock = stk.clock.VirtualClock()
+    old_clock = stk.clock.set_clock(clock)
+    motion = SimMotion(clock=clock, rate=100.0, seed=seed)
+    session = stk.simulation.SimSession({
+        "ALMotion": motion,
+        "ALMemory": motion.memory,
+        "PositionManager": stk.simulation.SimService(
+                                            _SimPositionManager(motion)),
+    })
+    pod = podmanager.PodManager(session)
+    scenarios = [
+        ("moveTo", lambda: motion.moveTo(3.0, 0, 0, _async=True)),
+        ("move_to", lambda: move.move_to(session, pod.logger, 2.0, 1.0, 0.5)),
+        ("last_move", lambda: pod.last_move(1.0, 0.5, 1.0)),
+        ("approach_home", pod.approach_home),
+    ]
+    results = {}
+    motion.start()
+    try:
+        for name, start in scenarios:
+            rand = random.Random(seed)
+            latencies, restarts = [], 0
+            for _ in range(cycles):
+                motion.reset([3.0, 1.0, 2.0])
+                future = start()
+                clock.advance(rand.uniform(0.5, 3.0))
+                if future.isFinished():
+                    continue
+                future.cancel()
+                cancel_time = clock.time()
+                while motion.moveIsActive():
+                    clock.advance(1.0 / motion.rate)
+                latencies.append(clock.time() - cancel_time)
+                pose = motion.get_true_pose()
+                clock.advance(CANCEL_SETTLE_TIME)
+                if motion.moveIsActive() or motion.get_true_pose() != pose:
+                    restarts += 1
+                motion.stopMove()
+            results[name] = {
+                "cancelled": len(latencies),
+                "mean_latency": (sum(latencies) / len(latencies)
+                                 if latencies else None),
+                "max_latency": max(latencies) if latencies else None,
+                "restarts": restarts,
+            }
+    finally:
+        motion.stop()
+        stk.clock.set_clock(old_clock)
+    return results
+
+class SimNavigation(object):
+    """What the SLAM manager uses of ALNavigation: localized in a map whose
+    frame is the true world frame."""
+    def __init__(self, motion, uncertainty=0.05):
+        self.motion = motion
+        self.clock = motion.clock
+        self.uncertainty = uncertainty # in meters
+
+    @qi_method
+    def getRobotPositionInMap(self):
+        "True pose, and its uncertainty."
+        return [self.motion.get_true_pose(),
+                [self.uncertainty, self.uncertainty, 0.0]]
+
+    @qi_method
+    def stopNavigateTo(self):
+        "Nothing to stop."
+        return True
+
+def benchmark_slam_return_home(cycles=20, max_distance=3.0, seed=0):
+    """Returns home with SLAMManager.return_home from random places, in
+    simulation (home is the origin of the map).
+
+    Returns the success rate, the mean return time (simulated) and the
+    final errors."""
+    import slammanager
+    rand = random.Random(seed)
+    clock = stk.clock.VirtualClock()
+    old_clock = stk.clock.set_clock(clock)
+    motion = SimMotion(clock=clock, rate=100.0, seed=seed)
+    session = stk.simulation.SimSession({
+        "ALMotion": motion,
+        "ALMemory": motion.memory,
+        "ALNavigation": SimNavigation(motion),
+    })
+    slam = slammanager.SLAMManager(session)
+    slam.slam_pos_in_world = [0.0, 0.0]
+    times, errors_xy, errors_theta, successes = [], [], [], 0
+    motion.start()
+    try:
+        for _ in range(cycles):
+            motion.reset([rand.uniform(-max_distance, max_distance),
+                          rand.uniform(-max_distance, max_distance),
+                          rand.uniform(-math.pi, math.pi)])
+            # Standing still long enough to be localized there
+            clock.advance(1.0)
+            start = clock.time()
+            future = slam.return_home()
+            while not future.isFinished():
+                clock.advance(1.0 / motion.rate)
+            if future.value():
+                successes += 1
+            times.append(clock.time() - start)
+            x_coord, y_coord, theta = motion.get_true_pose()
+            errors_xy.append(math.hypot(x_coord, y_coord))
+            errors_theta.append(abs(theta))
+    finally:
+        motion.stop()
+        stk.clock.set_clock(old_clock)
+    return {
+        "cycles": cycles,
+        "success_rate": float(successes) / cycles,
+        "mean_return_time": sum(times) / cycles,
+        "mean_error_xy": sum(errors_xy) / cycles,
+        "max_error_xy": max(errors_xy),
+        "mean_error_theta": sum(errors_theta) / cycles,
+    }
+
+if __name__ == "__main__":
+    print benchmark_odometry_return()
+    print benchmark_cancel()
+    print benchmark_slam_return_home()
@@ -20,17 +20,39 @@ import stk.logging
 import stk.coroutines
 
 import almath
+import json
 import math
+import os
 
 # Internal libs
 import planeutils as pu
+import gohomestats
+import localizationsampler
 
 import move
 
 RADIUS = 3.0
 
+# Exploration map and home pose of the last home definition, reused by the
+# next one; kept outside of the package so that it survives a reinstall
+if stk.runner.is_on_robot():
+    PATH_MAP_FILE = "/home/nao/.local/share/proactive-mobility/slam_map.json"
+else:
+    PATH_MAP_FILE = "data/slam_map.json"
+
+MAP_VERSION = 1
+
+# A stored map is reused only if ALNavigation is localized in it under that
+RELOCALIZATION_MAX_UNCERTAINTY = 0.3 # in meters
+
+# Time given to the localization to converge in the saved map
+RELOCALIZATION_TIMEOUT = 5.0 # in seconds
+
 MOVE_CONFIG_LOW_SPEED = [["MaxVelXY", 0.1],["MaxAccXY", 0.1],["MaxVelTheta",0.5],["MaxAccTheta",0.325],["MaxJerkXY",0.5],["MaxJerkTheta",1.0]]
 
+# Speed of the way home (the speed Move had when far from home)
+MOVE_CONFIG_TRAJECTORY = {"MaxVelXY": 0.25, "MaxAccXY": 0.3}
+
 class SLAMManager(object):
     """
     Class for saving position
@@ -43,6 +65,11 @@ class SLAMManager(object):
         self.logger = stk.logging.get_logger(self.session, self.APP_ID)
         self.navigation_future = None
         self.slam_pos_in_world = None # We don't know it at start
+        # Pose of home in the map of ALNavigation
+        self.home_pose = almath.Pose2D(0.0, 0.0, 0.0)
+        # Robot pose in the map, sampled while localized
+        self.localization = localizationsampler.LocalizationSampler(
+                                                                self.services)
 
     ###########################################
     #            Public Method                #
@@ -58,6 +85,7 @@ class SLAMManager(object):
     def on_stop(self):
         "Cleanup"
         self.logger.info("Application finished.")
+        self.localization.stop()
         self.events.clear()
 
     @qi.nobind
@@ -79,7 +107,13 @@ class SLAMManager(object):
     
     @stk.coroutines.async_generator
     def init_home(self):
-        future_value = yield self.create_temp_map()
+        future_value = yield self.relocalize_in_saved_map()
+        if not future_value:
+            future_value = yield self.create_temp_map()
+            if future_value:
+                # The map was created here: home is its origin
+                self.home_pose = almath.Pose2D(0.0, 0.0, 0.0)
+                self.save_map()
         if future_value:
             self.slam_pos_in_world = [0, 0]
         yield stk.coroutines.Return(future_value)
@@ -89,17 +123,58 @@ class SLAMManager(object):
 
     def uninit(self):
         self.slam_pos_in_world = None
+        self.localization.stop()
         self.services.ALNavigation._stopTopoMapper()
         self.services.ALNavigation.stopLocalization()
 
+    def get_checkpoint(self):
+        "State to keep across restarts (see restore_checkpoint)"
+        return {"pos_in_world": self.slam_pos_in_world,
+                "home_pose": list(self.home_pose.toVector())}
+
+    def restore_checkpoint(self, checkpoint):
+        """Restores the state of get_checkpoint; returns whether home is known
+
+        The map lives in ALNavigation: it is only usable if ALNavigation is
+        still localized in it."""
+        self.slam_pos_in_world = None
+        self.home_pose = almath.Pose2D(checkpoint.get("home_pose",
+                                                      [0.0, 0.0, 0.0]))
+        if checkpoint.get("pos_in_world") is not None:
+            if self.localization.update():
+                self.slam_pos_in_world = checkpoint["pos_in_world"]
+            else:
+                self.logger.info("No map to restore.")
+        return self.is_init()
+
     @stk.coroutines.async_generator
     def find_home(self):
         if self.slam_pos_in_world:
-            robotPose = almath.Pose2D(
-                     self.services.ALNavigation.getRobotPositionInMap()[0])
-            yield stk.coroutines.Return([robotPose.x, robotPose.y, robotPose.theta])
+            pose = self.localization.get_pose()
+            if pose:
+                # In the frame of home
+                robotPose = self.home_pose.inverse() * almath.Pose2D(pose)
+                yield stk.coroutines.Return([robotPose.x, robotPose.y,
+                                             robotPose.theta])
         yield stk.coroutines.Return(None)
 
+    @stk.coroutines.async_generator
+    def estimate_home(self):
+        """[pose of home in the world frame, error in m] from the localization
+        in the map, or None. Doesn't move the robot."""
+        sample = None
+        if self.slam_pos_in_world:
+            sample = self.localization.get_sample()
+        if not sample:
+            yield stk.coroutines.Return(None)
+            return
+        robot_in_home = self.home_pose.inverse() * almath.Pose2D(sample.pose)
+        robot_in_world = almath.Pose2D(
+                self.services.ALMotion.getRobotPosition(True))
+        home_in_world = robot_in_world * robot_in_home.inverse()
+        yield stk.coroutines.Return([list(home_in_world.toVector()),
+                                     sample.uncertainty])
+
     def get_polar_coord(self, coord_home):
         x , y , theta = coord_home
         object_pos = pu.coords_to_pos(0, 0)
@@ -112,28 +187,43 @@ class SLAMManager(object):
 
     @stk.coroutines.async_generator
     def last_move(self, x, y, theta):
-        value = yield self.services.ALMotion.moveTo(
-                                         x,
-                                         y,
-                                         0,
-                                         MOVE_CONFIG_LOW_SPEED,
-                                         _async=True)
+        value = yield move.stop_on_cancel(
+                self.services.ALMotion.moveTo(x,
+                                              y,
+                                              0,
+                                              MOVE_CONFIG_LOW_SPEED,
+                                              _async=True),
+                self.services.ALMotion.stopMove)
         if value:
-            value = yield self.services.ALMotion.moveTo(
-                                         0,
-                                         0,
-                                         almath.modulo2PI(
-                                                 theta),
-                                        MOVE_CONFIG_LOW_SPEED,
-                                         _async=True)
+            value = yield move.stop_on_cancel(
+                    self.services.ALMotion.moveTo(0,
+                                                  0,
+                                                  almath.modulo2PI(theta),
+                                                  MOVE_CONFIG_LOW_SPEED,
+                                                  _async=True),
+                    self.services.ALMotion.stopMove)
             if value:
                 self.slam_pos_in_world = [0.0,0.0]
                 yield stk.coroutines.Return(True)
         yield stk.coroutines.Return(False)
 
     @stk.coroutines.async_generator
-    def return_home(self, *args, **kwargs):
+    def return_home(self, research_360_activated=False, record=None):
+        "Goes home with the localization in the map."
+        self.localization.start_sampling("return_home")
+        try:
+            value = yield self.__return_home(research_360_activated, record)
+        finally:
+            self.localization.stop_sampling("return_home")
+        yield stk.coroutines.Return(value)
+
+    @stk.coroutines.async_generator
+    def __return_home(self, research_360_activated, record):
+        "Internal - see return_home"
+        if record is None:
+            record = gohomestats.GoHomeRecord("slam", research_360_activated)
         on_home = False
+        record.enter("find")
         self.navigation_future = self.find_home()
         coord_home = yield self.navigation_future
         if coord_home:
@@ -144,29 +234,22 @@ class SLAMManager(object):
                                                             2,
                                                             1,
                                                             _async=True)
-                self.navigation_future = self.services.ALMotion.moveTo(
-                                                    0,
-                                                    0,
-                                                    almath.modulo2PI(
-                                                            r_theta),
-                                                    _async=True)
+                robot_pose = almath.Pose2D(coord_home)
+                center = almath.Pose2D(0.0, 0.0, 0.0)
+                poseDiff = robot_pose.diff(center)
+                record.enter("move")
+                # One smooth move home, with the home orientation
+                self.navigation_future = move.move_to(
+                                                self.session,
+                                                self.logger,
+                                                poseDiff.x,
+                                                poseDiff.y,
+                                                almath.modulo2PI(
+                                                        poseDiff.theta),
+                                                MOVE_CONFIG_TRAJECTORY)
                 yield self.navigation_future
                 if self.navigation_future.value():
-                    move_object = move.Move(self.session, self.logger, r, 1.5)
-                    self.navigation_future = move_object.run()
-                    yield self.navigation_future
-                    if self.navigation_future.value():
-                        on_home = True
-                        robot_pose = almath.Pose2D(coord_home)
-                        center = almath.Pose2D(0.0, 0.0, 0.0)
-                        poseDiff = robot_pose.diff(center)
-                        self.aruco_future = self.services.ALMotion.moveTo(
-                                                    0,
-                                                    0,
-                                                    almath.modulo2PI(
-                                                    poseDiff.theta - r_theta),
-                                                    _async=True)
-                        yield self.aruco_future
+                    on_home = True
             else:
                 on_home = True
         else:
@@ -174,18 +257,28 @@ class SLAMManager(object):
             if self.services.DXHomeFinder:
                 self.services.DXHomeFinder.reason_cant_go_home.setValue("no_target")
         if on_home:
+            record.enter("find")
             self.navigation_future = self.find_home()
             coord_home = yield self.navigation_future
             if coord_home:
                 robot_pose = almath.Pose2D(coord_home)
                 center = almath.Pose2D(0.0, 0.0, 0.0)
                 poseDiff = robot_pose.diff(center)
+                record.enter("move")
                 self.navigation_future = self.last_move(
                         poseDiff.x,
                         poseDiff.y,
                         poseDiff.theta)
                 yield self.navigation_future
-                if not self.navigation_future.value():
+                if self.navigation_future.value():
+                    # Where the robot stopped, from a new localization
+                    pose = self.localization.get_pose(0)
+                    if pose:
+                        robot_pose = self.home_pose.inverse() * \
+                                     almath.Pose2D(pose)
+                        record.residual_error = math.hypot(robot_pose.x,
+                                                           robot_pose.y)
+                else:
                     if self.services.DXHomeFinder:
                         self.services.DXHomeFinder.reason_cant_go_home.setValue("obstacle")
                 yield stk.coroutines.Return(self.navigation_future.value())
@@ -201,33 +294,60 @@ class SLAMManager(object):
 
     @stk.coroutines.async_generator
     def return_home_with_alnavigation(self):
+        "Goes home with navigateToInMap."
+        self.localization.start_sampling("return_home_with_alnavigation")
+        try:
+            value = yield self.__return_home_with_alnavigation()
+        finally:
+            self.localization.stop_sampling("return_home_with_alnavigation")
+        yield stk.coroutines.Return(value)
+
+    @stk.coroutines.async_generator
+    def __return_home_with_alnavigation(self):
+        "Internal - see return_home_with_alnavigation"
         cpt = 0
         if self.slam_pos_in_world:
             for i in range(0, 100):
-                robotPose = almath.Pose2D(
-                    self.services.ALNavigation.getRobotPositionInMap()[0])
+                pose = self.localization.get_pose()
+                if not pose:
+                    break
+                robotPose = self.home_pose.inverse() * almath.Pose2D(pose)
                 center = almath.Pose2D(0.0, 0.0, 0.0)
                 if robotPose.distance(center) > 0.3:
-                    self.navigation_future = self.services.ALNavigation.navigateToInMap(
-                                                                    [0.0, 0.0],
-                                                                    _async=True)
+                    self.navigation_future = move.stop_on_cancel(
+                            self.services.ALNavigation.navigateToInMap(
+                                                        [self.home_pose.x,
+                                                         self.home_pose.y],
+                                                        _async=True),
+                            self.services.ALNavigation.stopNavigateTo)
                     yield self.navigation_future
+                    # Where did it end up?
+                    yield self.localization.wait_for_update(
+                                    localizationsampler.SAMPLE_MAX_AGE)
+                    continue
                 if robotPose.distance(center) < 0.3:
                     poseDiff = robotPose.diff(center)
                     if math.fabs(poseDiff.theta) > 0.2:
-                        self.navigation_future = self.services.ALMotion.moveTo(
+                        self.navigation_future = move.stop_on_cancel(
+                                self.services.ALMotion.moveTo(
                                                         0,
                                                         0,
                                                         almath.modulo2PI(
                                                             poseDiff.theta),
-                                                        _async=True)
+                                                        _async=True),
+                                self.services.ALMotion.stopMove)
                         yield self.navigation_future
+                        yield self.localization.wait_for_update(
+                                    localizationsampler.SAMPLE_MAX_AGE)
                     else:
                         cpt += 1
                         if cpt > 3:
                             self.slam_pos_in_world = [0, 0]
                             yield stk.coroutines.Return(True)
                             return
+                        # Check again on the next localization sample
+                        yield self.localization.wait_for_update(
+                                    localizationsampler.SAMPLE_MAX_AGE)
         self.logger.info("End back home.")
         yield stk.coroutines.Return(False)
 
@@ -245,3 +365,102 @@ class SLAMManager(object):
             yield self.services.ALNavigation._startTopoMapper(_async=True)
         self.logger.info("End mapping")
         yield stk.coroutines.Return(value)
+
+    @qi.nobind
+    def save_map(self):
+        "Saves the exploration map and home pose, for the next definition"
+        try:
+            exploration = self.services.ALNavigation.saveExploration()
+            if not exploration:
+                raise RuntimeError("ALNavigation saved no exploration")
+            self.__write_map({
+                "version": MAP_VERSION,
+                "exploration": exploration,
+                "home_pose": list(self.home_pose.toVector()),
+            })
+            self.logger.info("Map saved: %s", exploration)
+            return True
+        except Exception as error_msg:
+            self.logger.warning("Cannot save map: %s", error_msg)
+        return False
+
+    def __write_map(self, saved_map):
+        "Internal - writes the map file, atomically"
+        folder = os.path.dirname(PATH_MAP_FILE)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        temp_path = PATH_MAP_FILE + ".tmp"
+        with open(temp_path, 'w') as file:
+            file.write(json.dumps(saved_map, separators=(",", ":")))
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(temp_path, PATH_MAP_FILE)
+
+    @qi.nobind
+    def load_map(self):
+        "The map saved by save_map, or None"
+        if not os.path.exists(PATH_MAP_FILE):
+            return None
+        try:
+            with open(PATH_MAP_FILE, 'r') as file:
+                saved_map = json.loads(file.read())
+            if saved_map.get("version") != MAP_VERSION:
+                raise ValueError("unknown version %s" % saved_map.get("version"))
+            if not os.path.exists(saved_map["exploration"]):
+                raise ValueError("missing " + saved_map["exploration"])
+            saved_map["home_pose"] = [float(value)
+                                      for value in saved_map["home_pose"]]
+            return saved_map
+        except (IOError, ValueError, KeyError, TypeError) as error_msg:
+            self.logger.warning("Cannot load map: %s", error_msg)
+        return None
+
+    @stk.coroutines.async_generator
+    def relocalize_in_saved_map(self):
+        """Localizes in the saved map, with the current position as home
+
+        Returns False if there is no map, or if the match is poor."""
+        saved_map = self.load_map()
+        if not saved_map:
+            yield stk.coroutines.Return(False)
+            return
+        self.logger.info("Relocalizing in %s", saved_map["exploration"])
+        value = False
+        try:
+            yield self.services.ALNavigation._stopTopoMapper(_async=True)
+            yield self.services.ALNavigation.stopLocalization(_async=True)
+            loaded = yield self.services.ALNavigation.loadExploration(
+                                saved_map["exploration"], _async=True)
+            if loaded:
+                # Usually defined at the same place: start looking from there
+                yield self.services.ALNavigation.relocalizeInMap(
+                                saved_map["home_pose"], _async=True)
+                yield self.services.ALNavigation.startLocalization(_async=True)
+                sample = self.localization.update()
+                if sample and \
+                        sample.uncertainty > RELOCALIZATION_MAX_UNCERTAINTY:
+                    # Give the localization some time to converge
+                    sample = yield self.localization.wait_for(
+                            self.localization.uncertainty_below(
+                                    RELOCALIZATION_MAX_UNCERTAINTY),
+                            RELOCALIZATION_TIMEOUT)
+                if sample and \
+                        sample.uncertainty <= RELOCALIZATION_MAX_UNCERTAINTY:
+                    self.home_pose = almath.Pose2D(sample.pose)
+                    value = True
+                else:
+                    self.logger.info("Poor match in the saved map.")
+        except Exception as error_msg:
+            self.logger.warning("Cannot relocalize: %s", error_msg)
+        if value:
+            # So that the next definition starts from this home
+            saved_map["home_pose"] = list(self.home_pose.toVector())
+            try:
+                self.__write_map(saved_map)
+            except (IOError, OSError) as error_msg:
+                self.logger.warning("Cannot save home pose: %s", error_msg)
+        else:
+            self.localization.stop()
+            yield self.services.ALNavigation.stopLocalization(_async=True)
+        self.logger.info("End relocalizing")
+        yield stk.coroutines.Return(value)
@@ -22,6 +22,14 @@ start speaking).
 
 As your function now returns a future, it can be used in "yield run_test()" in
 another function wrapped with this decorator.
+
+Yield a list or tuple of futures to wait for all of them, or combine them:
+ - first_of(futures): the first one to finish
+ - first_completed(futures, condition): the first one to succeed
+ - gather(futures): all of them, failing as soon as one fails
+ - cancel_on(future, trigger): give up on it when trigger finishes
+ - with_timeout(future, seconds): give up on it after a while
+Futures that lose are cancelled, and cancelling propagates to all of them.
 """
 
 __version__ = "0.1.2"
@@ -31,11 +39,21 @@ __author__ = 'ekroeger'
 __email__ = 'ekroeger@softbankrobotics.com'
 
 import functools
-import time
+import sys
 import threading
 
 import qi
 
+import stk.clock
+
+def _cancel(future):
+    "Internal - cancels a future, if it can be."
+    try:
+        future.cancel()
+    except RuntimeError:
+        # Not cancelable
+        pass
+
 class _MultiFuture(object):
     """Internal helper for handling lists of futures.
 
@@ -49,35 +67,47 @@ class _MultiFuture(object):
         self.values = [None] * self.expecting
         self.failed = False
         self.futures = futures
-        for i, future in enumerate(futures):
-            future.then(lambda fut: self.__handle_part_done(i, fut))
+        self.lock = threading.Lock()
+        if not futures:
+            callback(returntype(self.values))
+        for index, future in enumerate(futures):
+            future.then(functools.partial(self.__handle_part_done, index))
 
     def __handle_part_done(self, index, future):
         "Internal callback for when a sub-function is done."
-        if self.failed:
-            # We already raised an exception, don't do anything else.
-            return
-        assert self.expecting, "Got more callbacks than expected!"
         try:
-            self.values[index] = future.value()
+            value = future.value()
         except Exception as exception:
-            self.failed = True
+            with self.lock:
+                if self.failed:
+                    # We already raised an exception, don't do anything else.
+                    return
+                self.failed = True
             self.callback(exception=exception)
             return
-        self.expecting -= 1
-        if not self.expecting:
-            # We have all the values
-            self.callback(self.returntype(self.values))
+        with self.lock:
+            if self.failed:
+                return
+            assert self.expecting, "Got more callbacks than expected!"
+            self.values[index] = value
+            self.expecting -= 1
+            if self.expecting:
+                return
+        # We have all the values
+        self.callback(self.returntype(self.values))
 
     def cancel(self):
+        "Cancels all the futures."
         for future in self.futures:
-            future.cancel()
+            _cancel(future)
 
 class FutureWrapper(object):
     "Abstract base class for objects that pretend to be a future."
     def __init__(self):
         self.running = True
-        self.promise = qi.Promise()
+        # Cancelling the future itself (e.g. the one returned by a
+        # public_async_generator) cancels the whole thing
+        self.promise = qi.Promise(lambda promise: self.cancel())
         self.future = self.promise.future()
         self._exception = ""
         self.lock = threading.Lock()
@@ -150,8 +180,7 @@ class FutureWrapper(object):
 
     def cancel(self):
         "Cancel the future, and stop executing the sequence of actions."
-        with self.lock:
-            self.running = False
+        if self._claim():
             self.promise.setCanceled()
 
     def isCanceled(self):
@@ -165,65 +194,131 @@ class FutureWrapper(object):
     # You know what? I'm not implementing unwrap() because I don't see a
     # use case.
 
+    def _claim(self):
+        """Internal - True for the first one to finish the future, who must
+        then set the promise (out of the lock: callbacks run there)."""
+        with self.lock:
+            if not self.running:
+                return False
+            self.running = False
+            return True
+
+    def _set_error(self, exception):
+        "Internal - finishes with an exception (see value)."
+        self._exception = exception
+        self.promise.setError(str(exception))
+
 
 class GeneratorFuture(FutureWrapper):
-    "Future-like object (same interface) made for wrapping a generator."
+    """Future-like object (same interface) made for wrapping a generator.
+
+    The generator is driven by a trampoline: the callback of a sub-future
+    only hands its result over, and a single loop runs the steps one after
+    the other. A long chain of already finished futures is a loop, not a
+    recursion, and a step never runs concurrently with another.
+    """
     def __init__(self, generator):
         FutureWrapper.__init__(self)
         self.generator = generator
-        self.future.addCallback(self.__handle_finished)
         self.sub_future = None
-        self.__ask_for_next()
-
-    def __handle_finished(self, future):
-        if self.running:
-            # promised was directly finished by someone else - cancel what we were doing!
-            self.running = False
-            if self.sub_future:
-                self.sub_future.cancel()
+        # Trampoline state, under step_lock: the result of the last
+        # sub-future (value, exception) waiting to be sent, whether a loop
+        # is running the steps, and the number of the current step
+        self.step_lock = threading.Lock()
+        self.pending = None
+        self.stepping = False
+        self.step_count = 0
+        self.__resume(0)
 
-    def __handle_done(self, future):
+    def cancel(self):
+        "Cancel the sequence of actions, and the one in progress."
+        FutureWrapper.cancel(self)
+        self.__cancel_sub_future()
+
+    def __cancel_sub_future(self):
+        "Internal - cancels what we are waiting for (lists included)."
+        sub_future = self.sub_future
+        if sub_future is not None:
+            _cancel(sub_future)
+
+    def __resume(self, step, value=None, exception=None):
+        """Internal - hands over the result of step, and runs the next steps
+        unless a loop already does."""
+        with self.step_lock:
+            if step != self.step_count:
+                # Late result of a step we are done with
+                return
+            self.step_count += 1
+            self.pending = (value, exception)
+            if self.stepping:
+                return
+            self.stepping = True
+        while True:
+            with self.step_lock:
+                if self.pending is None:
+                    self.stepping = False
+                    return
+                value, exception = self.pending
+                self.pending = None
+            self.__step(value, exception)
+
+    def __handle_done(self, step, future):
         "Internal callback for when the current sub-function is done."
         try:
-            self.__ask_for_next(future.value())
+            value = future.value()
         except Exception as exception:
-            self.__ask_for_next(exception=exception)
+            self.__resume(step, exception=exception)
+        else:
+            self.__resume(step, value)
+
+    def __handle_multi_done(self, step, value=None, exception=None):
+        "Internal callback for when a list of sub-functions is done."
+        self.__resume(step, value, exception)
 
     def __finish(self, value):
         "Finish and return."
-        with self.lock:
-            self.running = False
+        if self._claim():
             self.promise.setValue(value)
 
-    def __ask_for_next(self, arg=None, exception=None):
-        "Internal - get the next function in the generator."
-        if self.running:
+    def __step(self, value, exception):
+        "Internal - sends a result to the generator, and waits for the next."
+        self.sub_future = None
+        if not self.running:
+            # Cancelled: let the generator clean up (finally clauses)
             try:
-                self.sub_future = None # TODO: handle multifuture
-                if exception:
-                    future = self.generator.throw(exception)
-                else:
-                    future = self.generator.send(arg)
-                if isinstance(future, list):
-                    self.sub_future = _MultiFuture(future, self.__ask_for_next, list)
-                elif isinstance(future, tuple):
-                    self.sub_future = _MultiFuture(future, self.__ask_for_next, tuple)
-                elif isinstance(future, Return):
-                    # Special case: we returned a special "Return" object
-                    # in this case, stop execution.
-                    self.__finish(future.value)
-                else:
-                    future.then(self.__handle_done)
-                    self.sub_future = future
-            except StopIteration:
-                self.__finish(None)
-            except Exception as exc:
-                with self.lock:
-                    self._exception = exc
-                    self.running = False
-                    self.promise.setError(str(exc))
-#                   self.__finish(None) # May not be best way of finishing?
-
+                self.generator.close()
+            except RuntimeError:
+                # It ignored GeneratorExit
+                pass
+            return
+        step = self.step_count
+        try:
+            if exception is not None:
+                future = self.generator.throw(exception)
+            else:
+                future = self.generator.send(value)
+        except StopIteration:
+            self.__finish(None)
+            return
+        except Exception as exc:
+            if self._claim():
+                self._set_error(exc)
+            return
+        if isinstance(future, Return):
+            # Special case: we returned a special "Return" object
+            # in this case, stop execution.
+            self.__finish(future.value)
+            return
+        if isinstance(future, (list, tuple)):
+            self.sub_future = _MultiFuture(
+                    future, functools.partial(self.__handle_multi_done, step),
+                    type(future))
+        else:
+            self.sub_future = future
+            future.then(functools.partial(self.__handle_done, step))
+        if not self.running:
+            # Cancelled while the generator was running
+            self.__cancel_sub_future()
 
 def async_generator(func):
     """Decorator that turns a future-generator into a future.
@@ -240,9 +335,9 @@ def async_generator(func):
 
 def public_async_generator(func):
     """Variant of async_generator that returns an actual future.
-    
-    This allows you to expose it through a qi interface (on a service), but
-    that means cancel will not stop the whole chain.
+
+    This allows you to expose it through a qi interface (on a service);
+    cancelling that future still stops the whole chain.
     """
     @functools.wraps(func)
     def function(*args, **kwargs):
@@ -258,20 +353,251 @@ class Return(object):
 @async_generator
 def broken_sleep(t):
     "Helper - async version of time.sleep"
-    time.sleep(t)
+    stk.clock.sleep(t)
     # TODO: instead of blocking a thread do something with qi.async
     yield Return(None)
 
-MICROSECONDS_PER_SECOND = 1000000
-
 class _Sleep(FutureWrapper):
+    "Future finished after a delay on the app clock (see stk.clock)."
     def __init__(self, time_in_secs):
         FutureWrapper.__init__(self)
-        time_in_microseconds = int(MICROSECONDS_PER_SECOND * time_in_secs)
-        self.toto = qi.async(self.set_finished, delay=time_in_microseconds)
+        self.timer = stk.clock.call_later(time_in_secs, self.set_finished)
 
     def set_finished(self):
-        with self.lock:
+        if self._claim():
             self.promise.setValue(None)
 
+    def cancel(self):
+        "Cancel the sleep, and the timer behind it."
+        try:
+            self.timer.cancel()
+        except RuntimeError:
+            pass
+        FutureWrapper.cancel(self)
+
 sleep = _Sleep
+
+class _FirstOf(FutureWrapper):
+    "Future of the first of futures to finish; the others are cancelled."
+    def __init__(self, futures):
+        FutureWrapper.__init__(self)
+        self.futures = list(futures)
+        if not self.futures:
+            self.__finish_with(None)
+        for future in self.futures:
+            future.then(self.__handle_done)
+
+    def __handle_done(self, future):
+        "Internal - the first one wins."
+        if self._claim():
+            try:
+                value = future.value()
+            except Exception as exception:
+                self._set_error(exception)
+            else:
+                self.promise.setValue(value)
+            self.__cancel_all()
+
+    def __finish_with(self, value):
+        "Internal - finishes with value."
+        if self._claim():
+            self.promise.setValue(value)
+
+    def __cancel_all(self):
+        "Internal - cancels the futures (finished ones don't care)."
+        for future in self.futures:
+            _cancel(future)
+
+    def cancel(self):
+        "Cancel the futures."
+        FutureWrapper.cancel(self)
+        self.__cancel_all()
+
+def first_of(futures):
+    """Future of the value (or error) of the first of futures to finish.
+
+    The other futures are then cancelled; cancelling it cancels them all."""
+    return _FirstOf(futures)
+
+class _FirstCompleted(FutureWrapper):
+    "Future of [index, value] of the first of futures to succeed."
+    def __init__(self, futures, condition=None):
+        FutureWrapper.__init__(self)
+        self.futures = list(futures)
+        self.condition = condition
+        self.remaining = len(self.futures)
+        if not self.futures:
+            self.__finish_with(None)
+        for index, future in enumerate(self.futures):
+            future.then(functools.partial(self.__handle_done, index))
+
+    def __handle_done(self, index, future):
+        "Internal - a future is done: does it win?"
+        try:
+            value = future.value()
+        except Exception:
+            # Failed or cancelled: can't win
+            won = False
+        else:
+            won = self.condition is None or self.condition(value)
+        if won:
+            self.__finish_with([index, value])
+            return
+        with self.lock:
+            self.remaining -= 1
+            last = not self.remaining
+        if last:
+            # Nobody won
+            self.__finish_with(None)
+
+    def __finish_with(self, value):
+        "Internal - finishes with value, cancelling the others."
+        if self._claim():
+            self.promise.setValue(value)
+            self.__cancel_all()
+
+    def __cancel_all(self):
+        "Internal - cancels the futures (finished ones don't care)."
+        for future in self.futures:
+            _cancel(future)
+
+    def cancel(self):
+        "Cancel the futures."
+        FutureWrapper.cancel(self)
+        self.__cancel_all()
+
+def first_completed(futures, condition=None):
+    """Future of [index, value] of the first of futures to finish with a
+    value (for which condition(value) is true, if given).
+
+    The other futures are then cancelled. Failed (or cancelled) futures
+    don't count; the value is None if none of them succeeds."""
+    return _FirstCompleted(futures, condition)
+
+class _Gather(FutureWrapper):
+    "Future of the list of the values of futures."
+    def __init__(self, futures):
+        FutureWrapper.__init__(self)
+        self.multi = None
+        self.multi = _MultiFuture(list(futures), self.__handle_done, list)
+
+    def __handle_done(self, values=None, exception=None):
+        "Internal - all done, or one failed."
+        if not self._claim():
+            return
+        if exception is not None:
+            self._set_error(exception)
+            self.multi.cancel()
+        else:
+            self.promise.setValue(values)
+
+    def cancel(self):
+        "Cancel the futures."
+        FutureWrapper.cancel(self)
+        if self.multi:
+            self.multi.cancel()
+
+def gather(futures):
+    """Future of the list of the values of futures, in order.
+
+    If one of them fails, it fails with its error, and the others are
+    cancelled."""
+    return _Gather(futures)
+
+class _CancelOn(FutureWrapper):
+    "Future of future, or of a default value when trigger finishes first."
+    def __init__(self, future, trigger, default=None):
+        FutureWrapper.__init__(self)
+        self.sub_future = future
+        self.trigger = trigger
+        self.default = default
+        future.then(self.__handle_done)
+        trigger.then(self.__handle_trigger)
+
+    def __handle_done(self, future):
+        "Internal - forwards the result, in time."
+        if self._claim():
+            _cancel(self.trigger)
+            try:
+                value = future.value()
+            except Exception as exception:
+                self._set_error(exception)
+            else:
+                self.promise.setValue(value)
+
+    def __handle_trigger(self, trigger):
+        "Internal - too late: cancels the future."
+        if self._claim():
+            _cancel(self.sub_future)
+            self.promise.setValue(self.default)
+
+    def cancel(self):
+        "Cancel the future, and the trigger."
+        FutureWrapper.cancel(self)
+        _cancel(self.trigger)
+        _cancel(self.sub_future)
+
+def cancel_on(future, trigger, default=None):
+    """Future of the value (or error) of future, or of default if trigger
+    (a future, e.g. set by an event) finishes first: future is then
+    cancelled."""
+    return _CancelOn(future, trigger, default)
+
+def with_timeout(future, timeout, default=None):
+    """Future of the value (or error) of future, or of default if it isn't
+    finished after timeout seconds (it is then cancelled)."""
+    return _CancelOn(future, sleep(timeout), default)
+
+###########################################
+#            Benchmark                    #
+###########################################
+
+def _stack_depth():
+    "Internal - number of frames in the stack of the caller."
+    depth = 0
+    frame = sys._getframe(1)
+    while frame:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+def benchmark_steps(steps=1000, cycles=20):
+    """Runs chains of steps generators, like the search routines.
+
+    Chains yield futures either already finished, or finished afterwards
+    (one at a time, by the caller). Returns the mean time per step (in
+    microseconds), and how much deeper the stack is at the last step than
+    at the second one (0: no recursion)."""
+    import time
+    results = {}
+    for mode in ["finished", "pending"]:
+        depths = {}
+        durations = []
+        for _ in range(cycles):
+            promises = [qi.Promise() for _ in range(steps)]
+            if mode == "finished":
+                for promise in promises:
+                    promise.setValue(None)
+            @async_generator
+            def chain():
+                "steps steps, recording the depth of the stack"
+                for index, promise in enumerate(promises):
+                    if index in (1, steps - 1):
+                        depths[index] = _stack_depth()
+                    yield promise.future()
+                yield Return(len(promises))
+            start = time.time()
+            future = chain()
+            if mode == "pending":
+                for promise in promises:
+                    promise.setValue(None)
+            assert future.value() == steps
+            durations.append(time.time() - start)
+        results[mode] = {
+            "us_per_step": 1000000 * sum(durations) / (cycles * steps),
+            "stack_growth": depths[steps - 1] - depths[1],
+        }
+    return results
+
+if __name__ == "__main__":
+    print benchmark_steps()
@@ -11,8 +11,16 @@ __copyright__ = "Copyright 2015, Aldebaran Robotics"
 __author__ = 'ekroeger'
 __email__ = 'ekroeger@aldebaran.com'
 
+import threading
+
 import qi
 
+import stk.clock
+import stk.logging
+
+# Failures of event callbacks are logged there
+_LOGGER = stk.logging.Logger("stk.events")
+
 def on(*keys):
     """Decorator for connecting a callback to one or several events.
 
@@ -35,15 +43,137 @@ def on(*keys):
         return func
     return decorator
 
+class _SharedEvent(object):
+    "Internal - the connection to an event, dispatched to callbacks."
+    def __init__(self, session, source, signal):
+        self.session = session # so that its id isn't reused
+        self.source = source # keeps the subscriber alive
+        self.signal = signal
+        self.signal_connection_id = None
+        self.callbacks = {}
+        # Copied on change, so that dispatching needs no lock
+        self.callback_list = []
+
+    def add(self, connection_id, callback):
+        "Adds a callback (under the lock of the registry)."
+        self.callbacks[connection_id] = callback
+        self.callback_list = [self.callbacks[key]
+                              for key in sorted(self.callbacks)]
+
+    def remove(self, connection_id):
+        "Removes a callback (under the lock of the registry)."
+        del self.callbacks[connection_id]
+        self.callback_list = [self.callbacks[key]
+                              for key in sorted(self.callbacks)]
+
+    def dispatch(self, *args):
+        """Calls all callbacks, each on its own (as separate connections
+        would), so that a slow or failing one doesn't delay the others."""
+        for callback in self.callback_list:
+            stk.clock.call_later(0, _call_callback, callback, args)
+
+    def close(self):
+        "Disconnects from the signal."
+        try:
+            self.signal.disconnect(self.signal_connection_id)
+        except RuntimeError:
+            # Whoops, signal was broken or something, ignore
+            pass
+
+def _call_callback(callback, args):
+    "Internal - calls an event callback, logging its failure."
+    try:
+        callback(*args)
+    except Exception as exc:
+        _LOGGER.warning("Event callback %s failed: %s", callback, exc)
+
+class SubscriberRegistry(object):
+    """ALMemory subscribers and signals shared by all EventHelpers of a
+    process: one connection per event, whatever the number of callbacks, and
+    disconnected with the last one."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {} # (session id, event) -> _SharedEvent
+        self.connections = {} # connection id -> (session id, event)
+        self.next_id = 1
+
+    def connect(self, session, event, callback):
+        "Connects callback to an event or signal; returns a connection id."
+        key = (id(session), event)
+        with self.lock:
+            connection_id = self.next_id
+            self.next_id += 1
+            shared = self.events.get(key)
+            if shared:
+                shared.add(connection_id, callback)
+                self.connections[connection_id] = key
+                return connection_id
+        # Out of the lock: those are calls to other services
+        new_shared = self.__create(session, event)
+        with self.lock:
+            shared = self.events.setdefault(key, new_shared)
+            shared.add(connection_id, callback)
+            self.connections[connection_id] = key
+        if shared is not new_shared:
+            # Someone else connected it in the meantime
+            new_shared.close()
+        return connection_id
+
+    def disconnect(self, connection_id):
+        "Disconnects a callback; returns whether it was connected."
+        with self.lock:
+            key = self.connections.pop(connection_id, None)
+            if key is None:
+                return False
+            shared = self.events[key]
+            shared.remove(connection_id)
+            if shared.callbacks:
+                return True
+            del self.events[key]
+        shared.close()
+        return True
+
+    def get_callback_counts(self):
+        "Number of callbacks of each connected event."
+        with self.lock:
+            return dict((key[1], len(shared.callbacks))
+                        for key, shared in self.events.items())
+
+    @staticmethod
+    def __create(session, event):
+        "Internal - subscribes to the event, or gets the signal."
+        for i in range(2): # ugly hack, so we retry exactly once if it fails
+            if "." in event:
+                # if we have more than one ".":
+                service_name, signal_name = event.split(".")
+                source = session.service(service_name)
+                signal = getattr(source, signal_name)
+            else:
+                # It's a "normal" ALMemory event.
+                source = session.service("ALMemory").subscriber(event)
+                signal = source.signal
+            shared = _SharedEvent(session, source, signal)
+            try:
+                shared.signal_connection_id = signal.connect(shared.dispatch)
+                return shared
+            except RuntimeError:
+                # the signal seems to have died, try again
+                if i:
+                    raise
+
+# Shared by the EventHelpers of the process
+REGISTRY = SubscriberRegistry()
+
 class EventHelper(object):
     "Helper for ALMemory; takes care of event connections so you don't have to"
 
-    def __init__(self, session=None):
+    def __init__(self, session=None, registry=None):
         self.session = None
         self.almemory = None
+        self.registry = registry or REGISTRY
         if session:
             self.init(session)
-        self.handlers = {}  # a handler is (subscriber, connections)
+        self.handlers = {}  # connection ids (see registry) by event
         self.subscriber_names = {}
         self.wait_value = None
         self.wait_promise = None
@@ -68,26 +198,10 @@ class EventHelper(object):
         subscribes to them (such as WordRecognized). Those will *not* be
         triggered by this function, for those, use .subscribe().
         """
-        for i in range(2): # ugly hack, so we retry exactly once if it fails
-            if event not in self.handlers:
-                if "." in event:
-                    # if we have more than one ".":
-                    service_name, signal_name = event.split(".")
-                    service = self.session.service(service_name)
-                    self.handlers[event] = (getattr(service, signal_name), [])
-                else:
-                    # It's a "normal" ALMemory event.
-                    self.handlers[event] = (
-                        self.almemory.subscriber(event).signal, [])
-            signal, connections = self.handlers[event]
-            try:
-                connection_id = signal.connect(callback)
-                connections.append(connection_id)
-                return connection_id
-            except RuntimeError:
-                # the signal seems to have died, try again
-                del self.handlers[event]
-                continue # go a second time though the loop
+        # One connection per event in the process (see SubscriberRegistry)
+        connection_id = self.registry.connect(self.session, event, callback)
+        self.handlers.setdefault(event, []).append(connection_id)
+        return connection_id
 
     def subscribe(self, event, attachedname, callback):
         """Subscribes to an ALMemory event so as to notify providers.
@@ -102,23 +216,15 @@ class EventHelper(object):
     def disconnect(self, event, connection_id=None):
         "Disconnects a connection, or all if no connection is specified."
         if event in self.handlers:
-            signal, connections = self.handlers[event]
+            connections = self.handlers[event]
             if connection_id:
                 if connection_id in connections:
-                    try:
-                        signal.disconnect(connection_id)
-                    except RuntimeError:
-                        # Whoops, signal was broken or something, ignore
-                        pass
+                    self.registry.disconnect(connection_id)
                     connections.remove(connection_id)
             else:
                 # Didn't specify a connection ID: remove all
                 for connection_id in connections:
-                    try:
-                        signal.disconnect(connection_id)
-                    except RuntimeError:
-                        # Whoops, signal was broken or something, ignore
-                        pass
+                    self.registry.disconnect(connection_id)
                 del connections[:]
             if event in self.subscriber_names:
                 name = self.subscriber_names[event]
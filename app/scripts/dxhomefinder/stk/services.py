@@ -2,6 +2,14 @@
 stk.services.py
 
 Syntactic sugar for accessing NAOqi services.
+
+Calls made through a ServiceCache can be profiled (opt-in), to see how many
+calls each code path makes and how long they take:
+
+    profiler = stk.services.enable_profiling(logger, log_period=60.0)
+    ...
+    profiler.dump() # by "Service.method": count, latencies, callers
+    stk.services.disable_profiling()
 """
 
 __version__ = "0.1.2" # Working on smarter subscription
@@ -10,19 +18,209 @@ __copyright__ = "Copyright 2015, Aldebaran Robotics"
 __author__ = 'ekroeger'
 __email__ = 'ekroeger@aldebaran.com'
 
+import bisect
+import os
+import sys
+import threading
+
+import stk.clock
+
+# Upper bounds of the buckets of the latency histograms (the last bucket is
+# for longer calls)
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000] # in ms
+
+# Period of the summary logged by the profiler
+PROFILE_LOG_PERIOD = 60.0 # in seconds
+
+# Methods in the summary, by number of calls
+PROFILE_LOG_TOP = 10
+
+ONE_SECOND_IN_US = 1000000
+
+_PROFILER = [None]
+
+class CallProfiler(object):
+    """Call counts, latency histograms and callers of service methods.
+
+    Latencies of asynchronous calls (_async=True) are measured until their
+    future is done."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.start_time = stk.clock.time()
+        self.logger = None
+        self.task = None
+
+    def record(self, path, caller, duration, error=False):
+        "Adds a call to path (Service.method) from caller, of duration s."
+        with self.lock:
+            stats = self.stats.get(path)
+            if stats is None:
+                stats = {
+                    "count": 0,
+                    "errors": 0,
+                    "total_time": 0.0,
+                    "max_time": 0.0,
+                    "histogram": [0] * (len(LATENCY_BUCKETS) + 1),
+                    "callers": {},
+                }
+                self.stats[path] = stats
+            stats["count"] += 1
+            if error:
+                stats["errors"] += 1
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+            stats["histogram"][bisect.bisect_left(LATENCY_BUCKETS,
+                                                  duration * 1000.0)] += 1
+            stats["callers"][caller] = stats["callers"].get(caller, 0) + 1
+
+    def reset(self):
+        "Forgets all calls."
+        with self.lock:
+            self.stats = {}
+            self.start_time = stk.clock.time()
+
+    def dump(self):
+        "Everything recorded since the last reset (times in seconds)."
+        with self.lock:
+            calls = {}
+            for path, stats in self.stats.items():
+                calls[path] = dict(
+                    stats, mean_time=stats["total_time"] / stats["count"],
+                    histogram=list(stats["histogram"]),
+                    callers=dict(stats["callers"]))
+            return {
+                "duration": stk.clock.time() - self.start_time,
+                "buckets": LATENCY_BUCKETS,
+                "calls": calls,
+            }
+
+    def get_summary(self, top=PROFILE_LOG_TOP):
+        "Text summary of the most called methods, and their main caller."
+        dump = self.dump()
+        duration = max(dump["duration"], 1e-6)
+        calls = sorted(dump["calls"].items(),
+                       key=lambda item: item[1]["count"], reverse=True)
+        lines = ["%d calls in %.0f s" % (sum(stats["count"]
+                                             for _, stats in calls), duration)]
+        for path, stats in calls[:top]:
+            caller, count = max(stats["callers"].items(),
+                                key=lambda item: item[1])
+            lines.append("%s: %d calls (%.2f/s), mean %.1f ms, max %.1f ms, "
+                         "%d errors, mostly from %s (%d)" % (
+                             path, stats["count"], stats["count"] / duration,
+                             stats["mean_time"] * 1000.0,
+                             stats["max_time"] * 1000.0, stats["errors"],
+                             caller, count))
+        return "\n".join(lines)
+
+    def start_logging(self, logger, period=PROFILE_LOG_PERIOD):
+        "Logs the summary every period seconds."
+        self.stop_logging()
+        self.logger = logger
+        self.task = stk.clock.periodic_task(self.log_summary,
+                                            period * ONE_SECOND_IN_US)
+        self.task.start(False)
+
+    def stop_logging(self):
+        "Stops logging the summary."
+        if self.task:
+            self.task.stop()
+            self.task = None
+
+    def log_summary(self):
+        "Logs the summary (see get_summary)."
+        if self.logger:
+            self.logger.info("RPC profile: %s", self.get_summary())
+
+def enable_profiling(logger=None, log_period=PROFILE_LOG_PERIOD):
+    """Profiles the calls made through every ServiceCache from now on, and
+    logs a summary every log_period seconds if there is a logger; returns
+    the profiler."""
+    disable_profiling()
+    profiler = CallProfiler()
+    if logger and log_period:
+        profiler.start_logging(logger, log_period)
+    _PROFILER[0] = profiler
+    return profiler
+
+def disable_profiling():
+    "Stops profiling calls; returns the profiler (or None)."
+    profiler = _PROFILER[0]
+    _PROFILER[0] = None
+    if profiler:
+        profiler.stop_logging()
+    return profiler
+
+def get_profiler():
+    "The current profiler, or None if calls aren't profiled."
+    return _PROFILER[0]
+
+class _ProfiledAttribute(object):
+    "Internal - a service, method or property whose calls are profiled."
+    def __init__(self, path, target):
+        self.path = path
+        self.target = target
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return _ProfiledAttribute(self.path + "." + name,
+                                  getattr(self.target, name))
+
+    def __call__(self, *args, **kwargs):
+        profiler = _PROFILER[0]
+        if profiler is None:
+            # Profiling was disabled since this was fetched
+            return self.target(*args, **kwargs)
+        frame = sys._getframe(1)
+        caller = "%s:%d %s" % (os.path.basename(frame.f_code.co_filename),
+                               frame.f_lineno, frame.f_code.co_name)
+        start = stk.clock.time()
+        try:
+            result = self.target(*args, **kwargs)
+        except Exception:
+            profiler.record(self.path, caller, stk.clock.time() - start, True)
+            raise
+        if kwargs.get("_async"):
+            def on_done(future):
+                "Records the call once done"
+                profiler.record(self.path, caller, stk.clock.time() - start,
+                                future.hasError())
+            result.addCallback(on_done)
+        else:
+            profiler.record(self.path, caller, stk.clock.time() - start)
+        return result
+
 
 class ServiceCache(object):
-    "A helper for accessing NAOqi services."
+    """A helper for accessing NAOqi services.
+
+    Missing services are remembered until they are registered, so checking
+    for an optional service (if services.ALTracker: ...) costs nothing in a
+    loop."""
 
     def __init__(self, session=None):
         self.session = None
         self.services = {}
+        self.missing = set() # services that were not there
+        self.methods = {} # bound methods, by (service, method) (see method)
+        self.registrations = 0 # serviceRegistered count, see __getattr__
+        self.lock = threading.Lock()
         if session:
             self.init(session)
 
     def on_service_unregistered(self, service_id, service_name):
-        if service_name in self.services:
-            del self.services[service_name]
+        with self.lock:
+            self.services.pop(service_name, None)
+            for key in [key for key in self.methods
+                        if key[0] == service_name]:
+                del self.methods[key]
+
+    def on_service_registered(self, service_id, service_name):
+        with self.lock:
+            self.registrations += 1
+            self.missing.discard(service_name)
 
     def init(self, session):
         "Sets the session object, if it wasn't passed to constructor."
@@ -30,12 +228,57 @@ class ServiceCache(object):
         def callback(service_id, service_name):
             self.on_service_unregistered(service_id, service_name)
         session.serviceUnregistered.connect(callback)
+        def registered_callback(service_id, service_name):
+            self.on_service_registered(service_id, service_name)
+        session.serviceRegistered.connect(registered_callback)
 
     def __getattr__(self, servicename):
         "We overload this so (instance).ALMotion returns the service, or None."
-        if not servicename in self.services:
-            try:
-                self.services[servicename] = self.session.service(servicename)
-            except RuntimeError: # Cannot find service - ask again next time.
+        if servicename.startswith("__"):
+            # Behave like a normal python object for those
+            raise AttributeError(servicename)
+        return self.wrap(servicename, self.get_service(servicename))
+
+    def wrap(self, path, target):
+        """What callers get for target, a service or a method at path
+        (Service or Service.method): profiled if profiling is enabled."""
+        if target is None or _PROFILER[0] is None:
+            return target
+        return _ProfiledAttribute(path, target)
+
+    def get_service(self, servicename):
+        """The service itself (not wrapped, see wrap), or None if it's
+        missing."""
+        service = self.services.get(servicename)
+        if service is not None:
+            return service
+        with self.lock:
+            if servicename in self.missing:
+                # Until it is registered (see on_service_registered)
+                return None
+            registrations = self.registrations
+        try:
+            service = self.session.service(servicename)
+        except RuntimeError: # Cannot find service - ask again once registered.
+            with self.lock:
+                if registrations == self.registrations:
+                    self.missing.add(servicename)
+            return None
+        with self.lock:
+            self.services[servicename] = service
+        return service
+
+    def method(self, servicename, methodname):
+        """The bound method of a service (or None if it's missing), cached
+        until the service is unregistered; for calls in a loop. Like
+        attributes, it is profiled while profiling is enabled."""
+        key = (servicename, methodname)
+        method = self.methods.get(key)
+        if method is None:
+            service = self.get_service(servicename)
+            if service is None:
                 return None
-        return self.services[servicename]
+            method = getattr(service, methodname)
+            with self.lock:
+                self.methods[key] = method
+        return self.wrap(servicename + "." + methodname, method)
@@ -0,0 +1,90 @@
+"""
+Tests of the occupancy grid and of plan_route, on small synthetic maps.
+
+Usage (no robot needed):
+
+python test_occupancygrid.py
+"""
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2018, Softbank Robotics"
+
+# Basic libs
+import math
+import unittest
+import numpy as np
+
+import occupancygrid
+
+def make_wall(start, end, resolution=occupancygrid.GRID_RESOLUTION):
+    "Points every half cell on the segment from start to end, as (N, 2)."
+    length = math.hypot(end[0] - start[0], end[1] - start[1])
+    fractions = np.linspace(0, 1, int(2 * length / resolution) + 1)
+    return np.column_stack([start[0] + fractions * (end[0] - start[0]),
+                            start[1] + fractions * (end[1] - start[1])])
+
+class OccupancyGridTest(unittest.TestCase):
+    "Grid bookkeeping."
+    def test_obstacles_fade(self):
+        grid = occupancygrid.OccupancyGrid(4.0, half_life=10.0)
+        grid.add_obstacles([[1.0, 1.0]], 0.0, 1.0)
+        self.assertEqual(len(grid.get_obstacle_points()), 1)
+        np.testing.assert_allclose(grid.get_obstacle_points()[0], [1.0, 1.0],
+                                   atol=grid.resolution)
+        grid.decay(20.0)
+        self.assertEqual(len(grid.get_obstacle_points()), 0)
+
+    def test_scan_clears_the_ray(self):
+        grid = occupancygrid.OccupancyGrid(4.0)
+        grid.add_obstacles([[0.5, 0.0]], 0.0, 1.0)
+        for _ in range(3):
+            grid.add_scan([0.0, 0.0], [[1.5, 0.0]], 0.0)
+        occupied = grid.get_obstacle_points()
+        self.assertEqual(len(occupied), 1)
+        np.testing.assert_allclose(occupied[0], [1.5, 0.0],
+                                   atol=grid.resolution)
+
+class PlanRouteTest(unittest.TestCase):
+    "Routes on synthetic maps."
+    def setUp(self):
+        self.grid = occupancygrid.OccupancyGrid(4.0)
+
+    def assert_route_is_free(self, start, route):
+        "No segment of the route goes through an obstacle."
+        blocked = self.grid.get_blocked(occupancygrid.ROBOT_RADIUS -
+                                        self.grid.resolution)
+        rows, cols, inside = self.grid.to_cells([start] + route)
+        self.assertTrue(inside.all())
+        cells = zip(rows, cols)
+        for begin, end in zip(cells[:-1], cells[1:]):
+            self.assertTrue(occupancygrid.is_line_free(blocked, begin, end))
+
+    def test_straight_route(self):
+        self.grid.add_obstacles(make_wall([-1.0, 1.0], [1.0, 1.0]), 0.0, 1.0)
+        route = occupancygrid.plan_route(self.grid, [1.5, -1.0], [0.0, 0.0])
+        self.assertEqual(route, [[0.0, 0.0]])
+
+    def test_detour_around_obstacle(self):
+        start = [1.5, 0.0]
+        self.grid.add_obstacles(make_wall([0.75, -0.75], [0.75, 0.75]), 0.0,
+                                1.0)
+        route = occupancygrid.plan_route(self.grid, start, [0.0, 0.0])
+        self.assertTrue(route)
+        self.assertGreater(len(route), 1)
+        self.assertEqual(route[-1], [0.0, 0.0])
+        self.assert_route_is_free(start, route)
+        # Around the end of the wall, not through it
+        self.assertTrue(any(abs(point[1]) > 0.75 for point in route[:-1]))
+
+    def test_blocked_goal(self):
+        # A closed box around home
+        corners = [[-0.5, -0.5], [0.5, -0.5], [0.5, 0.5], [-0.5, 0.5]]
+        for index, corner in enumerate(corners):
+            self.grid.add_obstacles(make_wall(corner, corners[index - 1]),
+                                    0.0, 1.0)
+        route = occupancygrid.plan_route(self.grid, [1.5, 1.5], [0.0, 0.0])
+        self.assertIsNone(route)
+
+if __name__ == "__main__":
+    unittest.main()
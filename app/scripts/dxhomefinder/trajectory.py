@@ -0,0 +1,164 @@
+"""
+Trajectory of the robot: timestamped poses and odometric errors.
+
+The latest samples are kept in memory in a fixed size ring buffer, and
+every sample is appended to a compact binary file, rotated when it gets
+too big (trajectory.bin, trajectory.bin.1, ... trajectory.bin.N).
+
+Read the files back with load_trajectory, e.g.:
+
+python trajectory.py data/trajectory.bin.1 data/trajectory.bin out.csv
+"""
+# pylint: disable=E1101
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2018, Softbank Robotics"
+
+# Basic libs
+import os
+import struct
+import sys
+import threading
+import numpy as np
+
+# Columns of a sample
+FIELDS = ["timestamp", "x", "y", "theta", "error_xy", "error_theta"]
+
+# On disk: timestamp as a double, the rest as floats (28 bytes a sample)
+RECORD_FORMAT = "<d5f"
+RECORD_DTYPE = np.dtype([("timestamp", "<f8")] +
+                        [(field, "<f4") for field in FIELDS[1:]])
+
+class TrajectoryBuffer(object):
+    "The last capacity samples, in a numpy array."
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.samples = np.zeros((self.capacity, len(FIELDS)))
+        self.next_index = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, sample):
+        "Adds a sample (a sequence in the order of FIELDS)."
+        with self.lock:
+            self.samples[self.next_index] = sample
+            self.next_index = (self.next_index + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def to_array(self):
+        "All samples, oldest first, as a (count, len(FIELDS)) array."
+        with self.lock:
+            if self.count < self.capacity:
+                return self.samples[:self.count].copy()
+            return np.roll(self.samples, -self.next_index, axis=0)
+
+    def get_window(self, start_time=None, end_time=None):
+        "Samples with start_time <= timestamp <= end_time, oldest first."
+        samples = self.to_array()
+        timestamps = samples[:, 0]
+        first, last = 0, len(samples)
+        # Samples are in time order
+        if start_time is not None:
+            first = np.searchsorted(timestamps, start_time, side="left")
+        if end_time is not None:
+            last = np.searchsorted(timestamps, end_time, side="right")
+        return samples[first:last]
+
+class TrajectoryFile(object):
+    "Appends samples to a binary file, rotated over max_size bytes."
+    def __init__(self, path, max_size, backup_count):
+        self.path = path
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.lock = threading.Lock()
+        self.file = None
+
+    def append(self, sample):
+        "Writes a sample (a sequence in the order of FIELDS)."
+        with self.lock:
+            if self.file is None:
+                self._open()
+            self.file.write(struct.pack(RECORD_FORMAT, *sample))
+            if self.file.tell() >= self.max_size:
+                self._rotate()
+
+    def flush(self):
+        "Pushes the written samples to disk."
+        with self.lock:
+            if self.file:
+                self.file.flush()
+
+    def close(self):
+        "Closes the file (it is reopened by the next append)."
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def get_paths(self):
+        "Files with samples, oldest first."
+        paths = [self.path] + ["%s.%d" % (self.path, index)
+                               for index in range(1, self.backup_count + 1)]
+        return [path for path in reversed(paths) if os.path.exists(path)]
+
+    def _open(self):
+        "Internal - opens for appending, dropping a partial last sample."
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        if os.path.exists(self.path):
+            partial = os.path.getsize(self.path) % RECORD_DTYPE.itemsize
+            if partial:
+                with open(self.path, "r+b") as trajectory_file:
+                    trajectory_file.seek(-partial, os.SEEK_END)
+                    trajectory_file.truncate()
+        self.file = open(self.path, "ab")
+
+    def _rotate(self):
+        "Internal - file.bin becomes file.bin.1, file.bin.1 file.bin.2..."
+        self.file.close()
+        self.file = None
+        for index in range(self.backup_count - 1, 0, -1):
+            source = "%s.%d" % (self.path, index)
+            if os.path.exists(source):
+                os.rename(source, "%s.%d" % (self.path, index + 1))
+        if self.backup_count:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+def load_trajectory(paths):
+    "Samples of binary files, as a (count, len(FIELDS)) array."
+    arrays = []
+    for path in paths:
+        with open(path, "rb") as trajectory_file:
+            data = trajectory_file.read()
+        # A crash may leave a partial sample at the end
+        data = data[:len(data) - len(data) % RECORD_DTYPE.itemsize]
+        records = np.frombuffer(data, dtype=RECORD_DTYPE)
+        arrays.append(np.column_stack([records[field].astype(float)
+                                       for field in FIELDS]))
+    if not arrays:
+        return np.zeros((0, len(FIELDS)))
+    return np.concatenate(arrays)
+
+def save_trajectory(samples, path):
+    "Saves samples as .npy (numpy) or, for any other extension, as csv."
+    if path.endswith(".npy"):
+        np.save(path, samples)
+    else:
+        np.savetxt(path, samples, delimiter=",", fmt="%.6f",
+                   header=",".join(FIELDS), comments="")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print "usage: python trajectory.py trajectory.bin[.N] [...] " \
+              "output.csv|npy"
+        sys.exit(1)
+    SAMPLES = load_trajectory(sys.argv[1:-1])
+    save_trajectory(SAMPLES, sys.argv[-1])
+    print "Saved %d samples to %s" % (len(SAMPLES), sys.argv[-1])
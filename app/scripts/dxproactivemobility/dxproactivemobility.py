@@ -27,17 +27,18 @@ __author__ = 'ekroeger and mcaniot'
 __email__ = 'ekroeger@softbankrobotics.com and mcaniot@softbankrobotics.com'
 
 import math
-import time
 import threading
 
 import almath
 import qi
 
 import stk.runner
+import stk.clock
 import stk.events
 import stk.services
 import stk.logging
 
+import journal
 import preferences
 import translate
 import tablet
@@ -46,6 +47,10 @@ TRACKING_MODE_NAVIGATE = "Navigate"
 
 TIMEOUT_BEFORE_RETRY_GO_HOME = 60.0 # in seconds
 
+# FaceDetected and MoveFailed come several times a second; they are logged
+# at most once per period
+EVENT_LOG_PERIOD = 5.0 # in seconds
+
 NAV_EPSILON_POS = 0.1 # 10 cm
 NAV_EPSILON_ANGLE_RAD = math.radians(10) # 10 degrees in radians
 
@@ -59,13 +64,20 @@ class StrollState(object):
     GOING_HOME = "GOING_HOME"
     SAFEGUARD_GOING_HOME = "SAFEGUARD_GOING_HOME"
 
+# In those states the robot moves: PositionManager samples the obstacles and
+# the trajectory (see update_position_sampling)
+MOVING_STATES = [StrollState.WANDERING, StrollState.GO_ENGAGE,
+                 StrollState.GOING_HOME, StrollState.SAFEGUARD_GOING_HOME]
+
 # Behaviors
 DEFINE_HOME_BEHAVIOR = "proactive-mobility/sethome"
 GO_HOME_BEHAVIOR = "proactive-mobility/gohome"
 GO_ENGAGE_BEHAVIOR = "proactive-mobility/goengage"
 
 MAX_DISTANCE = 3.0
-MAX_ERROR = 0.5
+# Odometric uncertainty (see PositionManager.get_position_uncertainty)
+MAX_ERROR = 0.5 # in meters
+MAX_ERROR_THETA = 0.5 # in radians
 
 ENGAGEMENT_DISTANCE = 0.6 # in meters
 
@@ -191,7 +203,7 @@ class DXProactiveMobility(object):
         self.qiapp = qiapp
         self.session = qiapp.session
         self.events = stk.events.EventHelper(qiapp.session)
-        self.s = stk.services.ServiceCache(qiapp.session)
+        self.s = journal.RecordingServiceCache(qiapp.session)
         self.logger = stk.logging.get_logger(qiapp.session, self.APP_ID)
 
         # Wait some services
@@ -201,8 +213,8 @@ class DXProactiveMobility(object):
         self.session.waitForService("ALFaceDetection")
 
         # Internal variable
-        self.last_time_at_home = time.time()
-        self.started_solitary_wandering_time = time.time()
+        self.last_time_at_home = stk.clock.time()
+        self.started_solitary_wandering_time = stk.clock.time()
         self.state = StrollState.WANDERING
         self.life_state = "unknown"
         self.time_last_define_home = 0
@@ -211,17 +223,18 @@ class DXProactiveMobility(object):
         self.research_360_activated = False
         self.last_obstacle = None
         self.notifications = []
+        self.recorder = None # see start_recording
 
         # subscribe face detection
         self.s.ALFaceDetection.subscribe(self.APP_ID, 500 ,0)
 
         # periodic task
-        self.update_task = qi.PeriodicTask()
+        self.update_task = stk.clock.periodic_task()
         self.update_task.setCallback(self.update)
         self.update_task.setUsPeriod(ONE_SECOND_IN_US)
 
         # periodic task
-        self.reset_body_task = qi.PeriodicTask()
+        self.reset_body_task = stk.clock.periodic_task()
         self.reset_body_task.setCallback(self.reset_angle)
         self.reset_body_task.setUsPeriod(HUNDRED_SECOND_IN_US)
 
@@ -263,6 +276,7 @@ class DXProactiveMobility(object):
         # Start update if needed
         if self.is_proactive_activated and not self.update_task.isRunning():
             self.update_task.start(True)
+        self.update_position_sampling()
 
     ########################################
     # life cycle
@@ -279,8 +293,69 @@ class DXProactiveMobility(object):
         self.s.ALFaceDetection.unsubscribe(self.APP_ID)
         if self.reset_body_task.isRunning():
             self.reset_body_task.stop()
+        self.stop_recording()
+        self.stop_rpc_profiling()
+        self.update_position_sampling(False)
+        self.configuration_reader.close()
+        self.events.clear()
         self.logger.info("DXProactiveMobility finished.")
 
+    ########################################
+    # Journal (see journal.py and replay.py)
+
+    def start_recording(self, path):
+        "Records events, service calls and decisions in a journal file."
+        self.stop_recording()
+        snapshot = {
+            "state": self.state,
+            "life_state": self.life_state,
+            "prefs": self.prefs,
+            "research_360_activated": self.research_360_activated,
+        }
+        self.recorder = journal.JournalRecorder(self.session, path, snapshot)
+        self.s.recorder = self.recorder
+        self.logger.info("Recording journal in %s", path)
+        return True
+
+    def stop_recording(self):
+        "Stops recording the journal, if there was one."
+        recorder = self.recorder
+        if recorder:
+            self.recorder = None
+            self.s.recorder = None
+            recorder.stop()
+            self.logger.info("Stopped recording journal in %s", recorder.path)
+            return True
+        return False
+
+    def set_verbose_logs(self, enabled):
+        """Logs the verbose messages too (see stk.logging), for debugging;
+        they are dropped by default."""
+        stk.logging.set_level(stk.logging.VERBOSE if enabled
+                              else stk.logging.INFO)
+        self.logger.info("Verbose logs: %s", bool(enabled))
+        return bool(enabled)
+
+    def start_rpc_profiling(self, log_period):
+        """Profiles the calls made to other services (see stk.services), and
+        logs a summary every log_period seconds (0 for never)."""
+        stk.services.enable_profiling(self.logger, log_period)
+        self.logger.info("Profiling service calls")
+        return True
+
+    def stop_rpc_profiling(self):
+        "Stops profiling the calls made to other services."
+        if stk.services.disable_profiling():
+            self.logger.info("Stopped profiling service calls")
+            return True
+        return False
+
+    def get_rpc_profile(self):
+        """Calls made to other services since profiling started, by
+        "Service.method": count, latencies, histogram and callers."""
+        profiler = stk.services.get_profiler()
+        return profiler.dump() if profiler else {}
+
     ########################################
     # Home management
 
@@ -328,6 +403,9 @@ class DXProactiveMobility(object):
     def activate_proactive_mobility(self):
         # Check pref and activate if pref allows
         self.remove_notifications()
+        # A new reader notifies the current preferences; the old one must
+        # not stay connected
+        self.configuration_reader.close()
         self.configuration_reader = preferences.ConfigurationReader(\
             self.session, self.s, self.on_prefs)
     
@@ -363,7 +441,7 @@ class DXProactiveMobility(object):
             for coord in coord_to_check:
                 self.logger.info("enter in check human")
                 self.s.ALTracker.lookAt(coord, 1, 0.2, 0)
-                time.sleep(1.0)
+                stk.clock.sleep(1.0)
                 if len(self.s.ALMemory.getData("FaceDetected")) > 0:
                     self.logger.info("find human")
                     return True
@@ -374,10 +452,12 @@ class DXProactiveMobility(object):
     def mark_here_as_home(self):
         "Pepper is now at home."
         self.logger.info("DBG - mark_here_as_home")
+        if self.recorder:
+            self.recorder.record_incoming("mark_here_as_home")
         self.tablet_helper.display("DEFINING_HOME")
         if self.s.DXHomeFinder:
             self.stop_awareness()
-            time.sleep(1.0)
+            stk.clock.sleep(1.0)
             if self.s.DXHomeFinder.set_current_pos_as_home():
                 self.logger.info("successfully set home.")
                 self.events.set(SHOULD_DEFINE_HOME_KEY, 0)
@@ -394,7 +474,7 @@ class DXProactiveMobility(object):
                                         1)
                 self.logger.info("successfully set home.")
                 if self.prefs[preferences.PREF_TABLETFEEDBACK]:
-                    time.sleep(4)
+                    stk.clock.sleep(4)
             else:
                 self.logger.info("Failed to define home!")
                 self.reset_body_task.start(True)
@@ -412,16 +492,18 @@ class DXProactiveMobility(object):
                         self.s.DXHomeFinder.get_mode())
                     self.notifications.append(notification)
                 if self.prefs[preferences.PREF_TABLETFEEDBACK]:
-                    time.sleep(4)
-            self.time_last_define_home = time.time()
+                    stk.clock.sleep(4)
+            self.time_last_define_home = stk.clock.time()
             self.start_awareness()
-            self.last_time_at_home = time.time()
+            self.last_time_at_home = stk.clock.time()
         else:
             self.logger.info("No DXHomeFinder, not defining home.")
 
     @stk.logging.log_exceptions
     def go_home(self):
         "Goes home. should only be called from the associated app."
+        if self.recorder:
+            self.recorder.record_incoming("go_home")
         self.set_state(StrollState.GOING_HOME, "from_behavior") # Normal
         self.stop_awareness()
         if not self.is_human():
@@ -440,7 +522,7 @@ class DXProactiveMobility(object):
     def _on_go_home_done(self, future):
         "Callback when go_home is done."
         if future.hasError():
-            self.time_last_failed_go_gome = time.time()
+            self.time_last_failed_go_gome = stk.clock.time()
             self.reset_body_task.start(True)
             if self.state == StrollState.GOING_HOME:
                 self.set_state(StrollState.WANDERING, "FutureError")
@@ -455,7 +537,7 @@ class DXProactiveMobility(object):
                                         2,
                                         1)
             self.set_state(StrollState.AT_HOME, "future_success")
-            self.last_time_at_home = time.time()
+            self.last_time_at_home = stk.clock.time()
         else:
             print "DBG cant go home"
             do_loop = True
@@ -468,14 +550,14 @@ class DXProactiveMobility(object):
                         self.tablet_helper.display("CANT_GO_TO_HOME_NOTARGET")
                     else:
                         self.tablet_helper.display("CANT_GO_TO_HOME_OBSTACLE")
-                    if self.prefs[preferences.PREF_VOCALFEEDBACK] and time.time() - last_speech_obstacle > 15:
-                            last_speech_obstacle = time.time()
+                    if self.prefs[preferences.PREF_VOCALFEEDBACK] and stk.clock.time() - last_speech_obstacle > 15:
+                            last_speech_obstacle = stk.clock.time()
                             translate.say_audio_text(self.s.ALAnimatedSpeech,
                                 self.s.ALTextToSpeech,
                                 translate.CANT_GO_TO_HOME,
                                 reason)
                     if self.prefs[preferences.PREF_TABLETFEEDBACK]:
-                        time.sleep(4)
+                        stk.clock.sleep(4)
                     if self.s.PositionManager:
                         if self.s.PositionManager.reset_angle():
                             stop_loop_reason = "reset_angle_done"
@@ -486,7 +568,7 @@ class DXProactiveMobility(object):
                     do_loop = False
                     break
             if stop_loop_reason != "human":
-                self.time_last_failed_go_gome = time.time()
+                self.time_last_failed_go_gome = stk.clock.time()
             self.s.ALMemory.raiseEvent("ALMotion/MoveFailed",0)
             self.set_state(StrollState.WANDERING, "future_failure")
         self.start_awareness()
@@ -516,14 +598,11 @@ class DXProactiveMobility(object):
                     self.events.set(ALLOW_ENGAGE_KEY, False)
                     # Maybe change it for a getting reason with is_in_allowed_range
                     # But easier to do like that
-                    odom_error = self.s.PositionManager.get_odometric_position_error()
-                    mode = "unknown"
-                    if self.s.DXHomeFinder:
-                        mode = self.s.DXHomeFinder.get_mode()
-                    if odom_error[0] >= 0.5 or odom_error[1] >= 0.5 and mode != "slam":
+                    snapshot = self.s.PositionManager.get_snapshot()
+                    if self.is_position_uncertain(snapshot):
                         self.research_360_activated = True
                         self.set_state(StrollState.WANDERING, "move_too_much")
-                        time.sleep(3)
+                        stk.clock.sleep(3)
                         self.tablet_helper.display("CANT_REACH_HUMAN_DISTANCE")
                         if self.prefs[preferences.PREF_VOCALFEEDBACK]:
                             translate.say_audio_text(self.s.ALAnimatedSpeech,
@@ -532,7 +611,7 @@ class DXProactiveMobility(object):
                                 "distance")
                     else:
                         self.set_state(StrollState.WANDERING, "went_outside_range")
-                        time.sleep(3)
+                        stk.clock.sleep(3)
                         self.tablet_helper.display("CANT_REACH_HUMAN_AREA")
                         if self.prefs[preferences.PREF_VOCALFEEDBACK]:
                             translate.say_audio_text(self.s.ALAnimatedSpeech,
@@ -540,10 +619,10 @@ class DXProactiveMobility(object):
                                 translate.CANT_REACH_HUMAN,
                                 "area")
                     if self.prefs[preferences.PREF_TABLETFEEDBACK]:
-                        time.sleep(4)
+                        stk.clock.sleep(4)
                 else:
-                    # self.started_solitary_wandering_time = time.time()
-                    time_wandering = time.time() - self.started_solitary_wandering_time
+                    # self.started_solitary_wandering_time = stk.clock.time()
+                    time_wandering = stk.clock.time() - self.started_solitary_wandering_time
                     if time_wandering > self.prefs[preferences.PREF_BOREDTIMEOUT]:
                         self.set_state(StrollState.WANDERING, "no_human_tracked")
 
@@ -555,11 +634,9 @@ class DXProactiveMobility(object):
         "In a state where going home would make sense."
         far_from_home = True
         if self.s.PositionManager:
-            robot_x, robot_y, _ = self.s.PositionManager.get_robot_pos()
-            odom_error = self.s.PositionManager.get_odometric_position_error()
-            dist_from_home = math.hypot(robot_x, robot_y) + odom_error[0]
-            robot_theta = self.s.PositionManager.get_orientation()
-            if dist_from_home < 0.2 and abs(robot_theta) < math.radians(24):
+            snapshot = self.s.PositionManager.get_snapshot()
+            dist_from_home = snapshot["distance_to_home"] + snapshot["error_xy"]
+            if dist_from_home < 0.2 and abs(snapshot["theta"]) < math.radians(24):
                 far_from_home = False
         return (self.life_state == "solitary") and \
                self.prefs[preferences.PREF_ISACTIVE] and far_from_home
@@ -567,14 +644,25 @@ class DXProactiveMobility(object):
     def is_lost(self):
         "Have I moved so much that my odometry is unreliable."
         if self.s.PositionManager:
-            odom_error = self.s.PositionManager.get_odometric_position_error()
-            return odom_error[0] > MAX_ERROR
+            snapshot = self.s.PositionManager.get_snapshot()
+            return snapshot["error_xy"] > MAX_ERROR
         return False
 
+    def is_position_uncertain(self, snapshot):
+        "Is the odometric error of that position snapshot too big."
+        # error in xy in m, error in theta in rad
+        mode = "unknown"
+        if self.s.DXHomeFinder:
+            mode = self.s.DXHomeFinder.get_mode()
+        return snapshot["error_xy"] >= MAX_ERROR or \
+            (snapshot["error_theta"] >= MAX_ERROR_THETA and mode != "slam")
+
     def is_still_home(self):
         "Are we still right at home"
         if self.s.PositionManager:
-            robot_x, robot_y, theta = self.s.PositionManager.get_robot_pos()
+            snapshot = self.s.PositionManager.get_snapshot()
+            robot_x, robot_y, theta = \
+                snapshot["x"], snapshot["y"], snapshot["theta"]
             print "DBG HOME", robot_x, robot_y, math.degrees(theta)
             if max(abs(robot_x), abs(robot_y)) > NAV_EPSILON_POS:
                 return False
@@ -591,20 +679,15 @@ class DXProactiveMobility(object):
     def is_in_allowed_range(self):
         "Am I still in the range around home defined by the preferences?"
         if self.s.PositionManager:
-            robot_x, robot_y, _ = self.s.PositionManager.get_robot_pos()
-            odom_error = self.s.PositionManager.get_odometric_position_error()
-            dist_from_home = math.hypot(robot_x, robot_y) + odom_error[0]
+            snapshot = self.s.PositionManager.get_snapshot()
+            dist_from_home = snapshot["distance_to_home"] + snapshot["error_xy"]
             angle_range_degrees = self.prefs[preferences.PREF_MAXANGLE]
             max_angle_from_home_deg = angle_range_degrees / 2.0
-            angle_degrees = math.degrees(math.atan2(robot_y, robot_x))
-            #print "DBG x=%f y=%f angle=%f / %f" % (robot_x, robot_y,
+            angle_degrees = math.degrees(snapshot["angle_from_home"])
+            #print "DBG x=%f y=%f angle=%f / %f" % (snapshot["x"], snapshot["y"],
             #                        angle_degrees,  max_angle_from_home_deg)
 
-            # odom[0] => error in xy in m, odom[1] => error in theta in rad
-            mode = "unknown"
-            if self.s.DXHomeFinder:
-                mode = self.s.DXHomeFinder.get_mode()
-            if odom_error[0] >= 0.5 or odom_error[1] >= 0.5 and mode != "slam":
+            if self.is_position_uncertain(snapshot):
                 # the robot move a lot and is lost
                 return False
             if dist_from_home > self.prefs[preferences.PREF_MAXDISTANCE]:
@@ -626,10 +709,10 @@ class DXProactiveMobility(object):
     def get_reasons_to_go_home(self):
         "Should I go home RIGHT NOW?"
         reasons = []
-        time_wandering = time.time() - self.started_solitary_wandering_time
+        time_wandering = stk.clock.time() - self.started_solitary_wandering_time
         print "DBG I've been wandering for", time_wandering
         
-        time_since_try_to_go_home = time.time() - self.time_last_failed_go_gome
+        time_since_try_to_go_home = stk.clock.time() - self.time_last_failed_go_gome
         if time_since_try_to_go_home > TIMEOUT_BEFORE_RETRY_GO_HOME:
             if time_wandering > self.prefs[preferences.PREF_BOREDTIMEOUT]:
                 reasons.append("bored")
@@ -644,6 +727,8 @@ class DXProactiveMobility(object):
 
     def go_engage(self):
         "Called by 'go engage' behavior"
+        if self.recorder:
+            self.recorder.record_incoming("go_engage")
         self.set_state(StrollState.GO_ENGAGE, "from_behavior")
         # Until we get close to that person.
 
@@ -665,6 +750,8 @@ class DXProactiveMobility(object):
         else:
             # Stop old state
             old_state = self.state
+            if self.recorder:
+                self.recorder.record_transition(old_state, new_state, reason)
             if old_state == StrollState.GOING_HOME:
                 self.stop_activity(GO_HOME_BEHAVIOR)
                 self.events.set(SHOULD_GO_HOME_KEY, 0)
@@ -675,11 +762,11 @@ class DXProactiveMobility(object):
                 print "done go engage"
                 self.go_engage_state.stop()
                 self.stop_activity(GO_ENGAGE_BEHAVIOR)
-                self.started_solitary_wandering_time = time.time()
+                self.started_solitary_wandering_time = stk.clock.time()
                 print "now reset time after go engage"
             # start new state
             if new_state == StrollState.DEFINING_HOME:
-                elapsed = time.time() - self.time_last_define_home
+                elapsed = stk.clock.time() - self.time_last_define_home
                 if elapsed > TIME_RETRY_DEFINE_HOME:
                     self.events.set(SHOULD_DEFINE_HOME_KEY, 1)
             elif new_state == StrollState.AT_HOME:
@@ -687,11 +774,11 @@ class DXProactiveMobility(object):
                 self.events.set(SHOULD_GO_HOME_KEY, 0)
                 self.events.set(ALLOW_ENGAGE_KEY,
                                 self.prefs[preferences.PREF_ISACTIVE])
-                self.last_time_at_home = time.time()
+                self.last_time_at_home = stk.clock.time()
                 if self.prefs[preferences.PREF_TABLETFEEDBACK]:
-                    time.sleep(4)
+                    stk.clock.sleep(4)
             elif new_state == StrollState.WANDERING:
-                self.started_solitary_wandering_time = time.time()
+                self.started_solitary_wandering_time = stk.clock.time()
             elif new_state == StrollState.GO_ENGAGE and \
               self.s.DXHomeFinder.is_init():
                 self.tablet_helper.display("GO_ENGAGE")
@@ -701,9 +788,21 @@ class DXProactiveMobility(object):
                 self.events.set(SHOULD_GO_HOME_KEY, 1)
             # Done setting state
             self.state = new_state
+            self.update_position_sampling()
             self.logger.info("State transition done: %s -> %s (reason: %s)" % \
                 (old_state, new_state, reason))
 
+    @qi.nobind
+    def update_position_sampling(self, running=True):
+        "PositionManager samples the obstacles only while the robot moves."
+        if not self.s.PositionManager:
+            return
+        if running and self.is_proactive_activated and \
+                self.state in MOVING_STATES:
+            self.s.PositionManager.start_sampling(self.APP_ID)
+        else:
+            self.s.PositionManager.stop_sampling(self.APP_ID)
+
     def set_state(self, new_state, reason="unknown"):
         "Guarantees only the last state set is taken into account."
         if not self.is_proactive_activated:
@@ -747,13 +846,15 @@ class DXProactiveMobility(object):
 
     @stk.events.on("FaceDetected")
     def on_face_detected(self, value):
-        self.logger.info(" focus what ??? " + repr(self.s.ALAutonomousLife.focusedActivity()))
         if value:
-            self.started_solitary_wandering_time = time.time()
-            if self.s.ALAutonomousLife.focusedActivity() != GO_ENGAGE_BEHAVIOR:
+            self.started_solitary_wandering_time = stk.clock.time()
+            focused_activity = self.s.ALAutonomousLife.focusedActivity()
+            self.logger.every(EVENT_LOG_PERIOD).info(" focus what ??? %r",
+                                                     focused_activity)
+            if focused_activity != GO_ENGAGE_BEHAVIOR:
                 self.logger.info("#### stop engage")
                 self.go_engage_state.stop()
-            if self.s.ALAutonomousLife.focusedActivity() == GO_ENGAGE_BEHAVIOR:
+            if focused_activity == GO_ENGAGE_BEHAVIOR:
                 self.logger.info("#### start engage")
                 self.go_engage_state.start()
             elif self.is_in_allowed_range() and self.is_proactive_activated:
@@ -761,7 +862,7 @@ class DXProactiveMobility(object):
 
     @stk.events.on("ALMotion/MoveFailed")
     def on_move_failed(self, value):
-        self.logger.info("move failed " + repr(value))
+        self.logger.every(EVENT_LOG_PERIOD).info("move failed %r", value)
         if value:
             if isinstance(value, list):
                 if "Safety" in value:
@@ -780,7 +881,7 @@ class DXProactiveMobility(object):
         if self.could_go_home():
             return # why?
         if life_state == "solitary":
-            self.started_solitary_wandering_time = time.time()
+            self.started_solitary_wandering_time = stk.clock.time()
             if not self.s.DXHomeFinder:
                 self.logger.info("(no DXHomeFinder, not going home.)")
             elif not self.s.DXHomeFinder.is_init():
@@ -799,7 +900,7 @@ class DXProactiveMobility(object):
                 self.set_state(StrollState.SAFEGUARD_GOING_HOME)
         elif life_state == "interactive":
             if self.state == StrollState.AT_HOME:
-                self.last_time_at_home = time.time()
+                self.last_time_at_home = stk.clock.time()
                 if not self.is_still_home():
                     self.logger.info("Starting wandering - start timer")
                     self.set_state(StrollState.WANDERING,
@@ -0,0 +1,199 @@
+"""
+Journal of what DXProactiveMobility sees and does, for replaying it later.
+
+A journal is a text file (gzipped if its name ends with .gz) with one JSON
+header, then one JSON list per line:
+
+    [t, "e", key, value]                   ALMemory event received
+    [t, "c", path, args, result, duration] call made to a service
+    [t, "x", path, args, error, duration]  call made to a service that failed
+    [t, "i", method, args]                 call made to DXProactiveMobility
+    [t, "s", old_state, new_state, reason] state transition decided
+
+t is in seconds since the start of the recording (see stk.clock).
+
+Record on the robot with:
+
+qicli call DXProactiveMobility.start_recording /home/nao/journal.jsonl.gz
+qicli call DXProactiveMobility.stop_recording
+
+and replay it with replay.py.
+"""
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2018, Softbank Robotics"
+
+import gzip
+import json
+import threading
+
+import stk.clock
+import stk.events
+import stk.services
+
+JOURNAL_VERSION = 1
+
+# The events the state machine reacts to
+JOURNALED_EVENTS = [
+    "FaceDetected",
+    "AutonomousLife/State",
+    "AutonomousLife/FocusedActivity",
+    "ALMotion/MoveFailed",
+    "BatteryTrapIsOpen",
+    "Launchpad/DistanceOfTrackedHuman",
+]
+
+# Calls to those are not worth keeping (ALMemory is rebuilt from events)
+UNJOURNALED_SERVICES = ["ALMemory"]
+
+# Only whether a face is seen matters, not the (big) detection itself
+EVENT_COMPACTORS = {
+    "FaceDetected": lambda value: [1] if value else [],
+}
+
+# Flush the file every that many entries
+FLUSH_EVERY = 100
+
+def open_journal(path, mode="r"):
+    "Opens a journal file, gzipped if the name ends with .gz."
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "b")
+    return open(path, mode)
+
+def load_journal(path):
+    "Returns the header, and the entries sorted by time."
+    with open_journal(path) as journal_file:
+        header = json.loads(journal_file.readline())
+        if header.get("version") != JOURNAL_VERSION:
+            raise ValueError("Unsupported journal version: %s" % \
+                             header.get("version"))
+        entries = [json.loads(line) for line in journal_file if line.strip()]
+    # asynchronous calls are written when done, but stamped when started
+    entries.sort(key=lambda entry: entry[0])
+    return header, entries
+
+class RecordingServiceCache(stk.services.ServiceCache):
+    """ServiceCache whose services are journaled when there is a recorder.
+
+    The recorder is anything with a call(path, target, args, kwargs) method.
+    """
+    def __init__(self, session=None):
+        self.recorder = None
+        stk.services.ServiceCache.__init__(self, session)
+
+    def wrap(self, path, target):
+        target = stk.services.ServiceCache.wrap(self, path, target)
+        recorder = self.recorder
+        if target is None or recorder is None or \
+                path.split(".")[0] in UNJOURNALED_SERVICES:
+            return target
+        return _RecordedAttribute(recorder, path, target)
+
+class _RecordedAttribute(object):
+    "Internal - a service, method or property seen through a recorder."
+    def __init__(self, recorder, path, target):
+        self.recorder = recorder
+        self.path = path
+        self.target = target
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return _RecordedAttribute(self.recorder, self.path + "." + name,
+                                  getattr(self.target, name))
+
+    def __call__(self, *args, **kwargs):
+        return self.recorder.call(self.path, self.target, args, kwargs)
+
+class JournalRecorder(object):
+    "Writes the inputs and outputs of the service to a journal."
+    def __init__(self, session, path, snapshot=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.start_time = stk.clock.time()
+        self.count = 0
+        self.journal_file = open_journal(path, "w")
+        self._write_line({
+            "version": JOURNAL_VERSION,
+            "start": self.start_time,
+            "snapshot": snapshot or {},
+        })
+        self.events = stk.events.EventHelper(session)
+        for key in JOURNALED_EVENTS:
+            self.events.connect(key, self._make_event_callback(key))
+
+    def stop(self):
+        "Stops recording, and closes the file."
+        self.events.clear()
+        with self.lock:
+            if self.journal_file:
+                self.journal_file.close()
+                self.journal_file = None
+
+    def _make_event_callback(self, key):
+        "Internal - callback writing an event."
+        compactor = EVENT_COMPACTORS.get(key)
+        def callback(value):
+            if compactor:
+                value = compactor(value)
+            self._write([self._now(), "e", key, value])
+        return callback
+
+    def _now(self):
+        "Internal - journal time."
+        return round(stk.clock.time() - self.start_time, 3)
+
+    def _write_line(self, data):
+        "Internal - writes a line, without locking."
+        self.journal_file.write(json.dumps(data, separators=(",", ":"),
+                                           default=repr) + "\n")
+
+    def _write(self, entry):
+        "Internal - writes an entry."
+        with self.lock:
+            if not self.journal_file:
+                return
+            self._write_line(entry)
+            self.count += 1
+            if self.count % FLUSH_EVERY == 0:
+                self.journal_file.flush()
+
+    ########################################
+    # Hooks
+
+    def call(self, path, target, args, kwargs):
+        "Calls target, and writes the call and its result."
+        start = stk.clock.time()
+        t_start = self._now()
+        try:
+            result = target(*args, **kwargs)
+        except Exception as exc:
+            self._write([t_start, "x", path, list(args), str(exc),
+                         round(stk.clock.time() - start, 3)])
+            raise
+        if kwargs.get("_async"):
+            def on_done(future):
+                duration = round(stk.clock.time() - start, 3)
+                if future.hasError():
+                    self._write([t_start, "x", path, list(args),
+                                 future.error(), duration])
+                elif future.isCanceled():
+                    self._write([t_start, "x", path, list(args),
+                                 "canceled", duration])
+                else:
+                    self._write([t_start, "c", path, list(args),
+                                 future.value(), duration])
+            result.addCallback(on_done)
+        else:
+            self._write([t_start, "c", path, list(args), result,
+                         round(stk.clock.time() - start, 3)])
+        return result
+
+    def record_incoming(self, method, *args):
+        "Writes a call made to the service."
+        self._write([self._now(), "i", method, list(args)])
+
+    def record_transition(self, old_state, new_state, reason):
+        "Writes a state transition."
+        self._write([self._now(), "s", old_state, new_state, reason])
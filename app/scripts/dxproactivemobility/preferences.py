@@ -79,7 +79,7 @@ def is_valid(key, value):
     if key == PREF_ISACTIVE:
         return value in [0, 1, True, False, "on", "off"]
     if key == PREF_TECHNOLOGY:
-        return value in ["slam", "pod", "aruco"]
+        return value in ["slam", "pod", "aruco", "fusion"]
     if key == PREF_MAXDISTANCE:
         return 0.0 <= value <= 3.0
     if key == PREF_MAXANGLE:
@@ -128,6 +128,7 @@ def _test_pref_validation():
     assert _get_valid_value(PREF_ISACTIVE, "false") == False
     assert _get_valid_value(PREF_TECHNOLOGY, None) == "slam"
     assert _get_valid_value(PREF_TECHNOLOGY, "aruco") == "aruco"
+    assert _get_valid_value(PREF_TECHNOLOGY, "fusion") == "fusion"
     assert _get_valid_value(PREF_TECHNOLOGY, "Broccoli") == "slam"
     assert _get_valid_value(PREF_MAXDISTANCE, None) == 3.0
     assert _get_valid_value(PREF_MAXDISTANCE, -1.0) == 3.0
@@ -158,6 +159,10 @@ class ConfigurationReader(object):
         self.read_values_and_notify()
         self.events.connect_decorators(self)
 
+    def close(self):
+        "Stops listening to preference changes."
+        self.events.clear()
+
     def read_values_and_notify(self):
         "Get the preferences, and notify listeners if they changed."
         pref_dic = {}
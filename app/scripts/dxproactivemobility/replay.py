@@ -0,0 +1,430 @@
+"""
+Replays a journal (see journal.py) through DXProactiveMobility, offline.
+
+The service runs against stand-in services answering what the real ones
+answered at that time, on a virtual clock (see stk.clock), so a day of
+recorded traffic replays in seconds, always the same way.
+
+Since the go home and define home behaviors are launched by life when
+the service asks for them, those are simulated ("closed loop"), so that a
+change in the decisions shows in the trips. Other calls to the service
+(go engage) are replayed as recorded.
+
+Usage (no robot needed):
+
+python replay.py journal.jsonl.gz
+
+prints the metrics of the recording, and those of the replay.
+"""
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2018, Softbank Robotics"
+
+import bisect
+import json
+import math
+import time
+import traceback
+
+import stk.clock
+import stk.simulation
+
+import journal
+import preferences
+import dxproactivemobility
+
+# Transitions this soon after an input are counted as decided by it
+DECISION_HORIZON = 5.0 # in seconds
+
+# Time for life to launch a behavior after the service asked for it
+BEHAVIOR_LAUNCH_DELAY = 2.0 # in seconds
+
+# Time replayed after the last entry
+REPLAY_TAIL = 60.0 # in seconds
+
+# Services the service waits for at startup
+REQUIRED_SERVICES = ["ALMotion", "DXHomeFinder", "ALBasicAwareness",
+                     "ALFaceDetection", "ALPreferenceManager"]
+
+# Behaviors that are simulated, with the key that triggers them
+CLOSED_LOOP_BEHAVIORS = {
+    "go_home": dxproactivemobility.SHOULD_GO_HOME_KEY,
+    "mark_here_as_home": dxproactivemobility.SHOULD_DEFINE_HOME_KEY,
+}
+
+###########################################
+#            Stand-in services            #
+###########################################
+
+class ReplayFuture(object):
+    """Minimal qi.Future, finished by the replay clock, in the replay thread.
+
+    Waiting for it finishes it at once: the clock can't be moved by a timer
+    it is running."""
+    def __init__(self, result, error_message=None):
+        self.finished = False
+        self.result = result
+        self.error_message = error_message
+        self.callbacks = []
+
+    def set_result(self):
+        "Finishes the future (if it wasn't already)."
+        if self.finished:
+            return
+        self.finished = True
+        for callback in self.callbacks:
+            callback(self)
+        self.callbacks = []
+
+    def then(self, callback):
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+        return self
+
+    addCallback = then
+
+    def isFinished(self):
+        return self.finished
+
+    def isCanceled(self):
+        return False
+
+    def hasError(self):
+        return self.error_message is not None
+
+    def error(self):
+        return self.error_message
+
+    def wait(self, timeout=None):
+        self.set_result()
+
+    def value(self):
+        self.wait()
+        if self.error_message is not None:
+            raise RuntimeError(self.error_message)
+        return self.result
+
+class CallIndex(object):
+    "Recorded results of the calls, to answer with the latest known one."
+    def __init__(self):
+        self.calls = {} # path -> {args: (times, records)}
+
+    @staticmethod
+    def _args_key(args):
+        return json.dumps(list(args), sort_keys=True, default=repr)
+
+    def add(self, timestamp, path, args, record):
+        "Adds a record (is_error, result, duration), entries added in order."
+        by_args = self.calls.setdefault(path, {})
+        times, records = by_args.setdefault(self._args_key(args), ([], []))
+        times.append(timestamp)
+        records.append(record)
+
+    def find(self, timestamp, path, args):
+        """Latest record at timestamp for these args (or any args), or None.
+
+        Before the first record, the first one is used."""
+        by_args = self.calls.get(path)
+        if not by_args:
+            return None
+        candidates = by_args.get(self._args_key(args))
+        if candidates is not None:
+            return self._latest(candidates, timestamp)[1]
+        # Never called like this: the latest call with any arguments
+        return max(self._latest(candidates, timestamp)
+                   for candidates in by_args.values())[1]
+
+    @staticmethod
+    def _latest(candidates, timestamp):
+        "Internal - (time, record) of the latest record, or the first one."
+        times, records = candidates
+        index = max(bisect.bisect_right(times, timestamp) - 1, 0)
+        return times[index], records[index]
+
+class ReplayService(object):
+    "A service answering like the recorded one did."
+    def __init__(self, name, index, stats):
+        self.name = name
+        self.index = index
+        self.stats = stats
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return _ReplayAttribute(self, self.name + "." + name)
+
+    def call(self, path, args, kwargs):
+        """Answers a call; asynchronous ones take as long as the recorded one.
+
+        Synchronous calls are answered at once, as they are made from the
+        timers of the virtual clock, that can't move it."""
+        record = self.index.find(stk.clock.time(), path, args)
+        if record is None:
+            self.stats.unmatched_calls += 1
+            is_error, result, duration = False, None, 0.0
+        else:
+            is_error, result, duration = record
+        if kwargs.get("_async"):
+            future = ReplayFuture(result, result if is_error else None)
+            stk.clock.call_later(duration, future.set_result)
+            return future
+        if is_error:
+            raise RuntimeError(result)
+        return result
+
+class _ReplayAttribute(object):
+    "Internal - a method or property of a ReplayService."
+    def __init__(self, service, path):
+        self.service = service
+        self.path = path
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return _ReplayAttribute(self.service, self.path + "." + name)
+
+    def __call__(self, *args, **kwargs):
+        return self.service.call(self.path, args, kwargs)
+
+###########################################
+#            Metrics                      #
+###########################################
+
+class ReplayStats(object):
+    "Plays the recorder for the replayed service, and keeps what it sees."
+    def __init__(self):
+        self.inputs = [] # times of events and incoming calls
+        self.transitions = [] # (time, old_state, new_state, reason)
+        self.rpc_count = 0
+        self.unmatched_calls = 0
+        self.errors = 0
+
+    def call(self, path, target, args, kwargs):
+        "Recorder hook - counts the calls made by the service."
+        self.rpc_count += 1
+        return target(*args, **kwargs)
+
+    def record_incoming(self, method, *args):
+        "Recorder hook."
+        self.inputs.append(stk.clock.time())
+
+    def record_transition(self, old_state, new_state, reason):
+        "Recorder hook."
+        self.transitions.append((stk.clock.time(), old_state, new_state,
+                                 reason))
+
+def _percentile(values, ratio):
+    "Nearest-rank percentile of sorted values."
+    return values[min(len(values) - 1, int(math.ceil(ratio * len(values))) - 1)]
+
+def compute_metrics(inputs, transitions):
+    """Decision latencies, transitions counts and go home trips.
+
+    A go home trip is wasted when it ends anywhere but at home.
+    """
+    inputs = sorted(inputs)
+    latencies = []
+    counts = {}
+    trips = wasted_trips = 0
+    in_trip = False
+    for timestamp, old_state, new_state, _ in transitions:
+        transition = "%s->%s" % (old_state, new_state)
+        counts[transition] = counts.get(transition, 0) + 1
+        index = bisect.bisect_right(inputs, timestamp) - 1
+        if index >= 0 and timestamp - inputs[index] <= DECISION_HORIZON:
+            latencies.append(timestamp - inputs[index])
+        if new_state == dxproactivemobility.StrollState.GOING_HOME:
+            if not in_trip:
+                trips += 1
+            in_trip = True
+        elif in_trip and \
+                new_state != dxproactivemobility.StrollState.SAFEGUARD_GOING_HOME:
+            if new_state != dxproactivemobility.StrollState.AT_HOME:
+                wasted_trips += 1
+            in_trip = False
+    latencies.sort()
+    metrics = {
+        "transitions": len(transitions),
+        "transition_counts": counts,
+        "go_home_trips": trips,
+        "wasted_go_home_trips": wasted_trips,
+        "decision_latency": {"count": len(latencies)},
+    }
+    if latencies:
+        metrics["decision_latency"].update({
+            "mean": sum(latencies) / len(latencies),
+            "p95": _percentile(latencies, 0.95),
+            "max": latencies[-1],
+        })
+    return metrics
+
+def recorded_metrics(header, entries):
+    "Metrics of the recording itself, to compare with a replay."
+    start = header["start"]
+    inputs = [start + entry[0] for entry in entries if entry[1] in "ei"]
+    transitions = [(start + entry[0],) + tuple(entry[2:5])
+                   for entry in entries if entry[1] == "s"]
+    return compute_metrics(inputs, transitions)
+
+###########################################
+#            Replay                       #
+###########################################
+
+def _build_index(header, entries):
+    "Index of the recorded calls, prefs from the snapshot included."
+    index = CallIndex()
+    start = header["start"]
+    prefs = header["snapshot"].get("prefs") or {}
+    for key, value in prefs.items():
+        index.add(start, "ALPreferenceManager.getValue",
+                  [preferences.PREF_DOMAIN, key], (False, value, 0.0))
+    for entry in entries:
+        if entry[1] in "cx":
+            timestamp, kind, path, args, result, duration = entry
+            index.add(start + timestamp, path, args,
+                      (kind == "x", result, duration))
+    return index
+
+class ReplayDriver(object):
+    "Runs a DXProactiveMobility on a journal."
+    def __init__(self, header, entries, closed_loop=True):
+        self.header = header
+        self.entries = entries
+        self.closed_loop = closed_loop
+        self.start = header["start"]
+        self.clock = stk.clock.VirtualClock(self.start)
+        self.stats = ReplayStats()
+        self.memory = stk.simulation.SimMemory()
+        self.service = None
+        self.launching = set() # behaviors about to be launched
+
+    def _make_session(self):
+        "Session with ALMemory, and stand-ins for all the recorded services."
+        index = _build_index(self.header, self.entries)
+        names = set(REQUIRED_SERVICES)
+        names.update(path.split(".")[0] for path in index.calls)
+        services = dict((name, ReplayService(name, index, self.stats))
+                        for name in names)
+        services["ALMemory"] = self.memory
+        return stk.simulation.SimSession(services)
+
+    def _safe(self, func, *args):
+        "Internal - runs a step, counting errors instead of stopping."
+        try:
+            func(*args)
+        except Exception:
+            self.stats.errors += 1
+            traceback.print_exc()
+
+    def _inject_event(self, key, value):
+        self.stats.inputs.append(stk.clock.time())
+        self._safe(self.memory.raiseEvent, key, value)
+
+    def _call_service(self, method, args):
+        self._safe(getattr(self.service, method), *args)
+
+    def _on_behavior_key(self, method, value):
+        "Life launches the behavior when the service asks for it."
+        if value and method not in self.launching:
+            self.launching.add(method)
+            self.clock.call_later(BEHAVIOR_LAUNCH_DELAY,
+                                  self._launch_behavior, method)
+
+    def _launch_behavior(self, method):
+        self.launching.discard(method)
+        key = CLOSED_LOOP_BEHAVIORS[method]
+        try:
+            still_asked = self.memory.getData(key)
+        except RuntimeError:
+            still_asked = False
+        if still_asked and self.service.life_state == "solitary":
+            if method != "go_home" or self.service.state != \
+                    dxproactivemobility.StrollState.GOING_HOME:
+                self._call_service(method, [])
+
+    def _setup(self):
+        "Creates the service as it was when recording started."
+        qiapp = stk.simulation.SimApplication(self._make_session())
+        self.memory.insertData("FaceDetected", [])
+        self.service = dxproactivemobility.DXProactiveMobility(qiapp)
+        snapshot = self.header["snapshot"]
+        self.service.state = snapshot.get("state", self.service.state)
+        self.service.life_state = snapshot.get("life_state",
+                                               self.service.life_state)
+        self.service.research_360_activated = \
+            snapshot.get("research_360_activated", False)
+        self.service.recorder = self.stats
+        self.service.s.recorder = self.stats
+        self.service.on_start()
+        if self.closed_loop:
+            for method, key in CLOSED_LOOP_BEHAVIORS.items():
+                self.memory.subscriber(key).signal.connect(
+                    self._make_behavior_callback(method))
+
+    def _make_behavior_callback(self, method):
+        def callback(value):
+            self._on_behavior_key(method, value)
+        return callback
+
+    def _schedule_entries(self):
+        "Schedules the recorded inputs; returns the last time."
+        last_time = self.start
+        for entry in self.entries:
+            timestamp = self.start + entry[0]
+            last_time = max(last_time, timestamp)
+            if entry[1] == "e":
+                self.clock.call_later(timestamp - self.start,
+                                      self._inject_event, entry[2], entry[3])
+            elif entry[1] == "i":
+                if self.closed_loop and entry[2] in CLOSED_LOOP_BEHAVIORS:
+                    continue
+                self.clock.call_later(timestamp - self.start,
+                                      self._call_service, entry[2], entry[3])
+        return last_time
+
+
+    def run(self):
+        "Replays everything, returns the metrics."
+        old_clock = stk.clock.set_clock(self.clock)
+        wall_start = time.time()
+        try:
+            self._setup()
+            last_time = self._schedule_entries()
+            self.clock.run_until(last_time + REPLAY_TAIL)
+            self.service.update_task.stop()
+            self.service.reset_body_task.stop()
+        finally:
+            stk.clock.set_clock(old_clock)
+        wall_time = time.time() - wall_start
+        metrics = compute_metrics(self.stats.inputs, self.stats.transitions)
+        duration = self.clock.time() - self.start
+        metrics.update({
+            "duration": duration,
+            "wall_time": wall_time,
+            "speedup": duration / wall_time if wall_time else None,
+            "rpc_count": self.stats.rpc_count,
+            "unmatched_calls": self.stats.unmatched_calls,
+            "errors": self.stats.errors,
+        })
+        return metrics
+
+def replay(path, closed_loop=True):
+    "Replays a journal file; returns the recorded and replayed metrics."
+    header, entries = journal.load_journal(path)
+    return {
+        "recorded": recorded_metrics(header, entries),
+        "replayed": ReplayDriver(header, entries, closed_loop).run(),
+    }
+
+if __name__ == "__main__":
+    import argparse
+    import pprint
+    PARSER = argparse.ArgumentParser(description="Replay a journal.")
+    PARSER.add_argument("journal", help="journal file (.jsonl or .jsonl.gz)")
+    PARSER.add_argument("--open-loop", action="store_true",
+                        help="replay behavior launches as recorded")
+    ARGS = PARSER.parse_args()
+    pprint.pprint(replay(ARGS.journal, not ARGS.open_loop))
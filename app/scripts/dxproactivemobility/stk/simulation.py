@@ -0,0 +1,185 @@
+"""
+stk.simulation.py
+
+Minimal stand-ins for a NAOqi session and ALMemory, for running services
+and helpers without a robot (benchmarks, simulations, replays).
+
+Only the parts used by stk and the apps are implemented.
+"""
+
+__version__ = "0.1.0"
+
+__copyright__ = "Copyright 2018, Softbank Robotics"
+
+import inspect
+import threading
+
+import qi
+
+class SimSignal(object):
+    "Pure python equivalent of a qi.Signal."
+    def __init__(self):
+        self.callbacks = {}
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def connect(self, callback):
+        "Connects a callback; returns the connection id."
+        with self.lock:
+            connection_id = self.next_id
+            self.next_id += 1
+            self.callbacks[connection_id] = callback
+        return connection_id
+
+    def disconnect(self, connection_id):
+        "Disconnects a callback; returns whether it was connected."
+        with self.lock:
+            return self.callbacks.pop(connection_id, None) is not None
+
+    def __call__(self, *args):
+        with self.lock:
+            callbacks = [self.callbacks[key] for key in sorted(self.callbacks)]
+        for callback in callbacks:
+            callback(*args)
+
+class SimSubscriber(object):
+    "What ALMemory.subscriber returns."
+    def __init__(self, signal):
+        self.signal = signal
+
+class SimMemory(object):
+    "Stand-in for ALMemory: a dictionary, and a signal per key."
+    def __init__(self):
+        self.data = {}
+        self.signals = {}
+        self.subscribed = {}
+        self.lock = threading.Lock()
+
+    def _get_signal(self, key):
+        with self.lock:
+            if key not in self.signals:
+                self.signals[key] = SimSignal()
+            return self.signals[key]
+
+    def subscriber(self, key):
+        "Returns an object with the signal of the key."
+        return SimSubscriber(self._get_signal(key))
+
+    def getData(self, key):
+        "Value of the key, RuntimeError if unknown (like ALMemory)."
+        with self.lock:
+            if key not in self.data:
+                raise RuntimeError("ALMemory::getData: key %s not found" % key)
+            return self.data[key]
+
+    def getListData(self, keys):
+        "Values of several keys (None for unknown ones, like ALMemory)."
+        with self.lock:
+            return [self.data.get(key) for key in keys]
+
+    def getDataList(self, filter_string):
+        "Keys containing the filter."
+        with self.lock:
+            return [key for key in self.data if filter_string in key]
+
+    def insertData(self, key, value):
+        "Sets the value without notifying."
+        with self.lock:
+            self.data[key] = value
+
+    def raiseEvent(self, key, value):
+        "Sets the value and notifies the subscribers."
+        self.insertData(key, value)
+        self._get_signal(key)(value)
+
+    def removeData(self, key):
+        "Removes the key (RuntimeError if unknown)."
+        with self.lock:
+            if key not in self.data:
+                raise RuntimeError("ALMemory::removeData: key %s not found" % key)
+            del self.data[key]
+
+    def subscribeToEvent(self, key, module_name, callback_name):
+        "Only remembers the subscription."
+        self.subscribed[(key, module_name)] = callback_name
+
+    def unsubscribeToEvent(self, key, module_name):
+        "Forgets the subscription."
+        self.subscribed.pop((key, module_name), None)
+
+class SimService(object):
+    """Serves a python object like a service proxy: its methods accept
+    _async=True, and futures they return are waited for in synchronous
+    calls (e.g. methods decorated with stk.coroutines.public_async_generator)."""
+    def __init__(self, instance):
+        self.instance = instance
+
+    def __getattr__(self, name):
+        attribute = getattr(self.instance, name)
+        if not inspect.isroutine(attribute):
+            # Properties and signals
+            return attribute
+        def call(*args, **kwargs):
+            is_async = kwargs.pop("_async", False)
+            result = attribute(*args, **kwargs)
+            is_future = hasattr(result, "isFinished")
+            if is_async and not is_future:
+                promise = qi.Promise()
+                promise.setValue(result)
+                return promise.future()
+            if is_future and not is_async:
+                return result.value()
+            return result
+        return call
+
+class SimSession(object):
+    "Stand-in for a qi.Session serving python objects as services."
+    def __init__(self, services=None):
+        self.services = {}
+        self.service_ids = {}
+        self.next_id = 1
+        self.serviceRegistered = SimSignal()
+        self.serviceUnregistered = SimSignal()
+        for name, instance in (services or {}).items():
+            self.registerService(name, instance)
+
+    def service(self, name):
+        "Returns the service, RuntimeError if it's not registered."
+        if name not in self.services:
+            raise RuntimeError("Cannot find service '%s' in index" % name)
+        return self.services[name]
+
+    def waitForService(self, name):
+        "Services are registered up front in simulation: fail if missing."
+        self.service(name)
+
+    def registerService(self, name, instance):
+        "Registers a service and returns its id."
+        service_id = self.next_id
+        self.next_id += 1
+        self.services[name] = instance
+        self.service_ids[service_id] = name
+        self.serviceRegistered(service_id, name)
+        return service_id
+
+    def unregisterService(self, service_id):
+        "Unregisters a service by id."
+        name = self.service_ids.pop(service_id, None)
+        if name:
+            del self.services[name]
+            self.serviceUnregistered(service_id, name)
+
+class SimApplication(object):
+    "Stand-in for a qi.Application: holds the session, and runs nothing."
+    def __init__(self, session=None):
+        self.session = session or SimSession()
+        self.stopped = threading.Event()
+
+    def start(self):
+        pass
+
+    def run(self):
+        self.stopped.wait()
+
+    def stop(self):
+        self.stopped.set()